@@ -16,6 +16,7 @@ from tqdm import tqdm
 
 from preprocessing.tissue_preprocessing import create_subframes, concat_frames, remove_nonprotein_coding_genes
 from utils import mkdir_p
+from utils.count_store import write_count_store
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger(__name__)
@@ -91,6 +92,11 @@ def create_paired_tissues(root_dir):
                     # Create dataframe of just protein-coding genes
                     gencode_path = os.path.join(root_dir, 'metadata/gencode.v23.annotation.gtf')
                     remove_nonprotein_coding_genes(df_path=combined_path, gencode_path=gencode_path)
+                # Binary copy of the protein-coding dataframe for memory-mapped column access
+                store_dir = os.path.join(tissue_dir, 'counts-protein-coding')
+                if not os.path.exists(store_dir):
+                    pc_path = os.path.join(tissue_dir, 'combined-gtex-tcga-counts-protein-coding.tsv')
+                    write_count_store(df_path=pc_path, store_dir=store_dir)
 
 
 def synpase_download(blob):
@@ -106,6 +112,7 @@ def main():
         - Creates dataframes for GTEx and TCGA separated by body site or disease name
         - Pairs matching tissues together
         - Creates a subset of the combined dataframes containing only protein-coding genes
+        - Writes a binary count store of each protein-coding dataframe
 
     REQUIRED: Your Synapse password must be stored in the environment variable: SYNAPSE_PASSWORD
     e.g.
@@ -118,8 +125,12 @@ def main():
     parser.add_argument('--location', type=str, help='Directory to create project.')
     parser.add_argument('--username', type=str, help='Synapse username (email). Create account at Synpase.org and set '
                                                      'the password in the environment variable "SYNAPSE_PASSWORD".')
-    parser.add_argument('--cores', type=int, help='Number of cores to use when running R.', default=1)
+    parser.add_argument('--cores', type=int, default=1,
+                        help='Number of cores to use when downloading and creating tissue dataframes.')
     parser.add_argument('--no-download', action='store_true', help='Flag for disabling downloading from Synapse')
+    parser.add_argument('--chunksize', type=int, default=None,
+                        help='Stream the Xena tables this many genes at a time instead of loading them whole. '
+                             'Bounds memory use when creating tissue dataframes.')
     params = parser.parse_args()
 
     # If no arguments provided, print full help menu
@@ -144,7 +155,8 @@ def main():
     tissue_dataframe_path = os.path.join(root_dir, 'data/tissue-dataframes')
     log.info('Creating tissue dataframes at: ' + tissue_dataframe_path)
     create_subframes(gtex_metadata=gtex_metadata_path, tcga_metadata=tcga_metadata_path,
-                     tcga_expression=tcga_xena_path, gtex_expression=gtex_xena_path, output_dir=tissue_dataframe_path)
+                     tcga_expression=tcga_xena_path, gtex_expression=gtex_xena_path, output_dir=tissue_dataframe_path,
+                     chunksize=params.chunksize, cores=params.cores)
     # Create paired tissue directories
     create_paired_tissues(root_dir)
 
@@ -18,7 +18,7 @@ from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 
 from utils import mkdir_p
-from utils.gtf_parser import GTFRecord
+from utils.gtf_index import load_gtf_index
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger(__name__)
@@ -94,14 +94,7 @@ class PairwiseAnalysis(object):
         Removes non-protein coding genes which can skew normalization
         """
         log.info('Creating dataframe with non-protein coding genes removed.')
-        pc_genes = set()
-        with open(gencode_path, 'r') as f:
-            for line in f.readlines():
-                if not line.startswith('#'):
-                    line = line.split()
-                    if line[line.index('gene_type') + 1] == '"protein_coding";':
-                        pc_genes.add(line[line.index('gene_id') + 1].split('"')[1])
-        pc_genes = list(pc_genes)
+        pc_genes = load_gtf_index(gencode_path).protein_coding_genes()
         df = df.ix[pc_genes]
         if output_path:
             df.to_csv(output_path, sep='\t')
@@ -218,12 +211,8 @@ class PairwiseAnalysis(object):
 
     def _add_chromsome_position(self, df):
         log.info('Creating dictionary from GTF')
-        with open(self.gencode_path, 'r') as f:
-            for line in f:
-                if not line.startswith('#'):
-                    line = GTFRecord(line)
-                    if line.gene_type == 'protein_coding':
-                        self.positions[line.gene_id] = (line.seqname, line.start, line.end)
+        positions = load_gtf_index(self.gencode_path).gene_positions(gene_type='protein_coding')
+        self.positions = {gene: (seqname, start, end) for gene, (seqname, start, end, _) in positions.items()}
         chromsome, start, end = [], [], []
         for gene in self.genes:
             chromsome.append(self.positions[gene][0])
@@ -2,7 +2,7 @@ import logging
 import os
 from abc import abstractmethod, ABCMeta
 
-from utils import mkdir_p
+from utils import mkdir_p, write_script
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger(__name__)
@@ -21,10 +21,16 @@ class AbstractExperiment(object):
         self.tissue_pair_dir = os.path.join(root_dir, 'data/tissue-pairs')
         self.tissues = os.listdir(os.path.join(root_dir, 'data/tissue-pairs'))
         self.gene_map = os.path.join(root_dir, 'metadata/gene_map.pickle')
+        self.time_test_results = os.path.join(root_dir, 'experiments/deseq2-time-test/results.tsv')
 
         self.protein_coding_paths = [
             os.path.join(self.tissue_pair_dir, x, 'combined-gtex-tcga-counts-protein-coding.tsv')
             for x in self.tissues]
+        self.count_store_dirs = [os.path.join(self.tissue_pair_dir, x, 'counts-protein-coding') for x in self.tissues]
+        self._count_stores = {}
+        self._result_stores = {}
+        # DE backend: 'deseq2' runs the generated R scripts, 'nbinom' the NumPy engine in utils.nbinom
+        self.engine = 'deseq2'
 
     def create_directories(self, dirtree):
         """
@@ -37,6 +43,286 @@ class AbstractExperiment(object):
             log.debug(path)
             mkdir_p(path)
 
+    def count_store(self, tissue):
+        """
+        Returns the memory-mapped protein-coding count store for a tissue, writing it if it's missing
+
+        :param str tissue: Name of tissue pair
+        :return: Count store
+        :rtype: CountStore
+        """
+        from utils.count_store import CountStore
+
+        if tissue not in self._count_stores:
+            df_path = os.path.join(self.tissue_pair_dir, tissue, 'combined-gtex-tcga-counts-protein-coding.tsv')
+            self._count_stores[tissue] = CountStore(self.ensure_count_store(df_path))
+        return self._count_stores[tissue]
+
+    def ensure_count_store(self, df_path):
+        """
+        Returns the count store next to a tissue's protein-coding dataframe, writing it if it's missing
+
+        :param str df_path: Path to protein-coding dataframe
+        :return: Path to store
+        :rtype: str
+        """
+        from utils.count_store import write_count_store
+
+        store_dir = os.path.join(os.path.dirname(df_path), 'counts-protein-coding')
+        if not os.path.exists(store_dir):
+            write_count_store(df_path, store_dir)
+        return store_dir
+
+    @property
+    def annotation(self):
+        """Gene ID / gene name annotation, loaded once per process"""
+        from utils.gene_annotation import load_gene_annotation
+
+        return load_gene_annotation(self.gene_map, gtf_path=self.gencode_path)
+
+    def result_store(self, results_dir):
+        """
+        Returns the result store of a directory of DESeq2 results
+
+        :param str results_dir: Directory DESeq2 writes result tables to
+        :return: Result store
+        :rtype: ResultStore
+        """
+        from utils.result_store import ResultStore, result_store_dir
+
+        store_dir = result_store_dir(results_dir)
+        if store_dir not in self._result_stores:
+            self._result_stores[store_dir] = ResultStore(store_dir)
+        return self._result_stores[store_dir]
+
+    def stored(self, job):
+        """
+        :param Job job: Job
+        :return: True if the job's result has been moved into its result store
+        :rtype: bool
+        """
+        from utils.result_store import result_store_dir
+
+        if not job.output:
+            return False
+        results_dir = os.path.dirname(job.output)
+        return os.path.isdir(result_store_dir(results_dir)) and \
+            os.path.basename(job.output) in self.result_store(results_dir)
+
+    def store_results(self, results_dirs):
+        """
+        Moves the DESeq2 result tables of each directory into its result store
+
+        :param list[str] results_dirs: Directories DESeq2 writes result tables to
+        """
+        from utils.result_store import MODE_SUFFIX
+
+        for results_dir in results_dirs:
+            tables = sorted(os.path.join(results_dir, x) for x in os.listdir(results_dir)
+                            if not x.endswith(('.tmp', MODE_SUFFIX)))
+            self.result_store(results_dir).ingest(tables, remove=True)
+
+    def export_results(self, output_dir, results_dirs):
+        """
+        Writes the results in each directory's result store back out as DESeq2 tables
+
+        :param str output_dir: Directory to write to, with a subdirectory per tissue
+        :param list[str] results_dirs: Directories DESeq2 writes result tables to
+        """
+        from utils.result_store import result_store_dir
+
+        for results_dir in results_dirs:
+            if os.path.isdir(result_store_dir(results_dir)):
+                tissue = os.path.basename(os.path.dirname(os.path.normpath(results_dir)))
+                paths = self.result_store(results_dir).export_tables(os.path.join(output_dir, tissue))
+                log.info('Exported {} results for {}'.format(len(paths), tissue))
+
+    def run_deseq2_jobs(self, jobs, cores, max_attempts=3, memory=None):
+        """
+        Runs DESeq2 jobs through a journaled scheduler, so an interrupted run only resubmits unfinished jobs.
+        The journal is kept at jobs.jsonl in the experiment directory. Jobs run longest-first, with runtime
+        predicted from the deseq2-time-test results when they exist. Jobs are only started while their
+        predicted memory fits in the budget; the peak resident memory of past jobs is kept in memory-rss.json.
+        With the nbinom engine the jobs are instead run by utils.nbinom across `cores` processes.
+        Jobs given a count store are handed only their vector's columns, written to matrices/ as they start.
+        Jobs whose result is already in a result store are skipped.
+
+        :param list[Job] jobs: Jobs to run
+        :param int cores: Number of R workers
+        :param int max_attempts: Number of times a job is run before it is left as failed
+        :param float memory: Memory budget for concurrent jobs in GB. Defaults to 80% of physical memory
+        :return: Jobs that did not finish
+        :rtype: list[Job]
+        """
+        jobs = [x for x in jobs if not self.stored(x)]
+        if self.engine == 'nbinom':
+            # The nbinom engine needs scipy, so it's only imported by the experiments that use it
+            from utils.nbinom import run_nbinom_jobs
+            return run_nbinom_jobs(jobs, {x.job_id: self.conditions(x) for x in jobs}, cores=cores)
+        from utils.scheduler import DESeq2Scheduler, CostModel, MemoryModel
+
+        journal = os.path.join(self.experiment_dir, 'jobs.jsonl')
+        scheduler = DESeq2Scheduler(journal, cores=cores, directory=self.experiment_dir, max_attempts=max_attempts,
+                                    cost_model=CostModel.from_time_test(self.time_test_results),
+                                    memory_mb=memory * 1000 if memory else None,
+                                    memory_model=MemoryModel(os.path.join(self.experiment_dir, 'memory-rss.json')))
+        return scheduler.run(jobs)
+
+    def conditions(self, job):
+        """
+        Condition of each sample in a job's vector, as the experiment's R script assigns them.
+        Needed to run the experiment with the nbinom engine.
+
+        :param Job job: Job
+        :return: One condition label per sample
+        :rtype: list[str]
+        """
+        raise NotImplementedError('{} does not support the nbinom engine'.format(type(self).__name__))
+
+    def covariates(self, job):
+        """
+        Factors of the design other than the condition, e.g. patient, as the experiment's R script assigns them
+
+        :param Job job: Job
+        :return: One list of labels per factor, or None if the design is ~ condition
+        :rtype: list[list[str]]
+        """
+        return None
+
+    def run_permutations(self, jobs, n, cores, seed=0, alpha=0.05):
+        """
+        Builds a null distribution for each job by testing n shuffles of its condition labels with the nbinom engine.
+        For each job, three tables are written to null/ in the experiment directory:
+        <job>-null-genes.tsv (how often each gene was called significant), <job>-null-permutations.tsv
+        (significant genes per permutation) and <job>-null-calls.tsv (genes by number of significant calls).
+
+        :param list[Job] jobs: Jobs of the experiment
+        :param int n: Number of permutations per job
+        :param int cores: Number of processes
+        :param int seed: Seed of the first permutation
+        :param float alpha: padj cutoff for a significant call
+        """
+        from utils.nbinom import read_counts
+        from utils.permutation import permutation_null, call_distribution
+        from utils.scheduler import job_vector
+
+        null_dir = os.path.join(self.experiment_dir, 'null')
+        mkdir_p(null_dir)
+        for job in jobs:
+            prefix = os.path.join(null_dir, job.job_id.replace(os.sep, '--') + '-null-')
+            if os.path.exists(prefix + 'genes.tsv'):
+                log.info('Null distribution for {} already exists, skipping'.format(job.job_id))
+                continue
+            log.info('Permuting {} {} times'.format(job.job_id, n))
+            counts = read_counts(job_vector(job), store=job.store, df_path=job.matrix or job.args[0])
+            genes, permutations = permutation_null(counts, self.conditions(job), n, cores=cores,
+                                                   covariates=self.covariates(job), seed=seed, alpha=alpha)
+            permutations.to_csv(prefix + 'permutations.tsv', sep='\t')
+            call_distribution(genes, n).to_csv(prefix + 'calls.tsv', sep='\t')
+            genes.to_csv(prefix + 'genes.tsv', sep='\t')
+            log.info('{}: median of {:.0f} significant genes per permutation, {} genes called at least once'.format(
+                job.job_id, permutations['significant_genes'].median(), (genes['significant_calls'] > 0).sum()))
+
+    def check_concordance(self, jobs, n=10):
+        """
+        Reruns up to n jobs that have DESeq2 results with the nbinom engine and compares the two tables.
+        Tables and a summary (concordance.tsv) are written to nbinom-concordance in the experiment directory.
+
+        :param list[Job] jobs: Jobs of the experiment
+        :param int n: Number of jobs to compare
+        :return: One row of concordance statistics per job
+        :rtype: pd.DataFrame
+        """
+        import pandas as pd
+        from utils.nbinom import run_job, concordance
+
+        done = [x for x in jobs if x.output and (os.path.exists(x.output) or self.stored(x))][:n]
+        out_dir = os.path.join(self.experiment_dir, 'nbinom-concordance')
+        mkdir_p(out_dir)
+        log.info('Comparing the nbinom engine with DESeq2 on {} jobs'.format(len(done)))
+        rows = []
+        for job in done:
+            prefix = os.path.join(out_dir, job.job_id.replace(os.sep, '--'))
+            deseq2_path = job.output
+            if not os.path.exists(deseq2_path):
+                store = self.result_store(os.path.dirname(job.output))
+                deseq2_path = store.export(os.path.basename(job.output), prefix + '-deseq2')
+            output = run_job(job, self.conditions(job), output=prefix)
+            rows.append(dict(concordance(deseq2_path, output), job_id=job.job_id))
+        df = pd.DataFrame(rows).set_index('job_id') if rows else pd.DataFrame()
+        df.to_csv(os.path.join(out_dir, 'concordance.tsv'), sep='\t')
+        if rows:
+            log.info('Median log2FoldChange r: {:.3f}, pvalue rho: {:.3f}, significant gene Jaccard: {:.3f}'.format(
+                df['log2fc_pearson'].median(), df['pvalue_spearman'].median(), df['jaccard'].median()))
+        return df
+
+    def check_shared_reference(self, jobs, n=5, cores=1):
+        """
+        Reruns up to n queries whose stored result is from a shared-reference fit with the experiment's
+        per-vector DESeq2 script, and compares the two tables. Tables and a summary (concordance.tsv) are written
+        to shared-reference-concordance in the experiment directory.
+
+        :param list[Job] jobs: Per-vector jobs of the experiment
+        :param int n: Number of queries to compare
+        :param int cores: Number of R workers
+        :return: One row of concordance statistics per query
+        :rtype: pd.DataFrame
+        """
+        import pandas as pd
+        from utils.deseq2_pool import run_deseq2_pool
+        from utils.nbinom import concordance
+        from utils.one_vs_many import SHARED_REFERENCE
+        from utils.scheduler import job_vector
+
+        done = [x for x in jobs if self.stored(x) and
+                self.result_store(os.path.dirname(x.output)).mode(os.path.basename(x.output)) == SHARED_REFERENCE][:n]
+        out_dir = os.path.join(self.experiment_dir, 'shared-reference-concordance')
+        mkdir_p(out_dir)
+        log.info('Comparing shared-reference results with per-vector DESeq2 on {} queries'.format(len(done)))
+        script_path = write_script(self.deseq2_script, directory=out_dir)
+
+        # The per-vector script writes its table to results/ next to the vector's directory, so each query gets
+        # a directory of its own here rather than overwriting the experiment's results
+        blob, paths = [], []
+        for job in done:
+            query_dir = os.path.join(out_dir, job.job_id.replace(os.sep, '--'))
+            mkdir_p(os.path.join(query_dir, 'vectors'))
+            mkdir_p(os.path.join(query_dir, 'results'))
+            query = os.path.basename(job.output)
+            vector_path = os.path.join(query_dir, 'vectors', query)
+            with open(vector_path, 'w') as f:
+                f.write('\n'.join(job_vector(job)))
+            blob.append((script_path, [job.args[0], vector_path]))
+            paths.append(os.path.join(query_dir, 'results', query))
+        if blob:
+            run_deseq2_pool(blob, cores=cores, directory=out_dir)
+
+        rows = []
+        for job, per_vector in zip(done, paths):
+            if not os.path.exists(per_vector):
+                log.error('Per-vector DESeq2 failed on {}'.format(job.job_id))
+                continue
+            store = self.result_store(os.path.dirname(job.output))
+            shared = store.export(os.path.basename(job.output), per_vector + '-shared-reference')
+            rows.append(dict(concordance(per_vector, shared, labels=('per_vector', 'shared_reference')),
+                             job_id=job.job_id))
+        df = pd.DataFrame(rows).set_index('job_id') if rows else pd.DataFrame()
+        df.to_csv(os.path.join(out_dir, 'concordance.tsv'), sep='\t')
+        if rows:
+            log.info('Median log2FoldChange r: {:.3f}, pvalue rho: {:.3f}, significant gene Jaccard: {:.3f}'.format(
+                df['log2fc_pearson'].median(), df['pvalue_spearman'].median(), df['jaccard'].median()))
+        return df
+
+    @staticmethod
+    def read_vector(path):
+        """
+        :param str path: Path to a vector
+        :return: Samples in the vector
+        :rtype: list[str]
+        """
+        with open(path, 'r') as f:
+            return [x.strip() for x in f if x.strip()]
+
     @abstractmethod
     def setup(self):
         raise NotImplementedError
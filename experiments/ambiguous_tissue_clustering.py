@@ -17,16 +17,26 @@ from tissue_clustering.tsne_clustering import run_pca
 from tissue_clustering.tsne_clustering import run_tsne
 from tissue_clustering.tsne_clustering import split_tcga_tumor_normal
 from tissue_clustering.tsne_clustering import tissues
-from experiments.AbstractExperiment import AbstractExperiment
+from experiments.abstractExperiment import AbstractExperiment
+from utils import mkdir_p
+from utils.cluster_diagnostics import load_diagnostics
+from utils.scheduler import budget_map
 import logging
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger(__name__)
 class AmbiguousTissueClustering(AbstractExperiment):
 
-    def __init__(self, root_dir):
+    def __init__(self, root_dir, cores=1, memory=None):
+        """
+        :param str root_dir: Path to project directory
+        :param int cores: Number of tissues embedded concurrently
+        :param float memory: Memory budget for concurrent tissues in GB. Defaults to 80% of physical memory
+        """
         super(AmbiguousTissueClustering, self).__init__(root_dir)
         self.root_dir = root_dir
+        self.cores = cores
+        self.memory = memory
         self.experiment_dir = os.path.join(root_dir, 'experiments/ambiguous-tissue-clustering')
         self.tsne_dir = os.path.join(self.experiment_dir, 'tsne')
         self.pca_dir = os.path.join(self.experiment_dir, 'pca')
@@ -51,26 +61,28 @@ class AmbiguousTissueClustering(AbstractExperiment):
 
     def run_clustering(self, cluster_dir, name='tsne'):
         tsne_output = os.path.join(cluster_dir, name + '-cluster-data.pickle')
+        pickle_dir = os.path.join(cluster_dir, 'pickles')
+        mkdir_p(pickle_dir)
         if os.path.exists(tsne_output):
             log.info('Pickle file found, loading: ' + tsne_output)
             tsne = pickle.load(open(tsne_output, 'rb'))
         else:
+            # Tissues are independent, so those without a pickle are embedded concurrently
             pc_genes = find_protein_coding_genes(self.gencode_path)
+            pickle_paths = {x: os.path.join(pickle_dir, x + '.pickle') for x in tissues}
+            pending = [x for x in sorted(tissues) if not os.path.exists(pickle_paths[x])]
+            tissue_dirs = [os.path.join(self.experiment_dir, x) for x in pending]
+            budget_map(embed_tissue, [(x, pc_genes, name, pickle_paths[y]) for x, y in zip(tissue_dirs, pending)],
+                       [embedding_memory_mb(x) for x in tissue_dirs], cores=self.cores,
+                       memory_mb=self.memory * 1000 if self.memory else None)
             tsne = {}
-            for tissue in tqdm(tissues):
-                files = split_tcga_tumor_normal(os.path.join(self.experiment_dir, tissue))
-                vector, label = create_classification_vector(files)
-                df = create_combined_df(files, pc_genes)
-
-                # Log-normalizing expression data for PCA / t-SNE
-                ln_df = df.apply(lambda y: np.log(y + 1))
-                if name == 'tsne':
-                    x = run_tsne(ln_df)
-                else:
-                    x = run_pca(ln_df)
-                tsne[tissue] = (x, files, label)
-            with open(tsne_output, 'w') as f:
+            for tissue in tissues:
+                with open(pickle_paths[tissue], 'rb') as f:
+                    tsne[tissue] = pickle.load(f)
+            tmp_path = tsne_output + '.tmp'
+            with open(tmp_path, 'wb') as f:
                 pickle.dump(tsne, f)
+            os.rename(tmp_path, tsne_output)
 
         log.info('Creating one large subplot')
         f, axes = plt.subplots(len(tissues), figsize=(8, 72))
@@ -90,6 +102,48 @@ class AmbiguousTissueClustering(AbstractExperiment):
         for tissue in tsne:
             f, ax = plt.subplots()
             x, files, label = tsne[tissue]
+            names = [os.path.basename(z).split('.tsv')[0] for z in files]
+            load_diagnostics(os.path.join(pickle_dir, tissue + '.diagnostics.npz'), x, label, names=names,
+                             source=tsne_output)
             plot_dimensionality_reduction(ax, x, files, label, title=tissue)
             f.savefig(os.path.join(cluster_dir, tissue + '-' + name + '.png'), format='png', dpi=300)
             plt.close()
+
+
+def embed_tissue(blob):
+    """
+    Map function that embeds one tissue and atomically pickles (x, files, label), so an interrupted run resumes
+
+    :param tuple blob: Tissue directory, protein-coding genes, method ('tsne' or 'pca'), pickle path
+    :return: Pickle path
+    :rtype: str
+    """
+    tissue_dir, pc_genes, name, pickle_path = blob
+    files = split_tcga_tumor_normal(tissue_dir)
+    vector, label = create_classification_vector(files)
+    df = create_combined_df(files, pc_genes)
+
+    # Log-normalizing expression data for PCA / t-SNE
+    ln_df = df.apply(lambda y: np.log(y + 1))
+    if name == 'tsne':
+        x = run_tsne(ln_df)
+    else:
+        x = run_pca(ln_df)
+    tmp_path = pickle_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump((x, files, label), f)
+    os.rename(tmp_path, pickle_path)
+    return pickle_path
+
+
+def embedding_memory_mb(tissue_dir):
+    """
+    Predicted peak memory of embedding a tissue: its dataframes are read, split, combined and log-normalized
+    with pandas, which holds several float64 copies, about 4x their size on disk
+
+    :param str tissue_dir: Directory of the tissue's dataframes
+    :return: Predicted peak memory in MB
+    :rtype: float
+    """
+    size = sum(os.path.getsize(os.path.join(tissue_dir, x)) for x in os.listdir(tissue_dir))
+    return size / 1e6 * 4 + 128
@@ -1,17 +1,13 @@
 import logging
 import os
-import pickle
 import textwrap
-from collections import defaultdict
 
-import numpy as np
-import pandas as pd
-from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 
-from experiments.AbstractExperiment import AbstractExperiment
-from utils import run_deseq2
+from experiments.abstractExperiment import AbstractExperiment
 from utils import write_script
+from utils.manifest import VectorManifest
+from utils.scheduler import Job
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger(__name__)
@@ -19,79 +15,82 @@ log = logging.getLogger(__name__)
 
 class PairwiseGTEx(AbstractExperiment):
 
-    def __init__(self, root_dir, cores):
+    def __init__(self, root_dir, cores, memory=None, engine='deseq2'):
         super(PairwiseGTEx, self).__init__(root_dir)
+        self.memory = memory
+        self.engine = engine
         self.cores = int(cores)
         self.experiment_dir = os.path.join(root_dir, 'experiments/pairwise-gtex')
         self.tissue_dirs = [os.path.join(self.experiment_dir, x) for x in self.tissues]
         self.output_df = os.path.join(self.experiment_dir, 'gtex-combined.tsv')
+        self.output_store = os.path.join(self.experiment_dir, 'gtex-combined-counts')
+        self.manifest_path = os.path.join(self.experiment_dir, 'manifest.json')
         self.script_path = None
 
     def setup(self):
-        dirtree = [os.path.join(x, 'samples') for x in self.tissue_dirs] + \
-                  [os.path.join(x, 'results') for x in self.tissue_dirs]
+        import pandas as pd
+        from utils.count_store import write_count_store
+
+        dirtree = [os.path.join(x, 'results') for x in self.tissue_dirs]
         self.create_directories(dirtree)
 
         self.script_path = write_script(self.deseq2_script, self.experiment_dir)
 
         log.info('Writing out combined GTEx dataframe')
         if not os.path.exists(self.output_df):
-            dfs = [pd.read_csv(x, sep='\t', index_col=0).filter(regex=('GTEX')) for x in self.protein_coding_paths]
+            stores = [self.count_store(x) for x in self.tissues]
+            dfs = [store.subset([x for x in store.samples if 'GTEX' in x]) for store in stores]
             df = pd.concat(dfs, axis=1)
             df.to_csv(self.output_df, sep='\t')
             all_samples_vector = set(df.columns)
         else:
             all_samples_vector = set(open(self.output_df, 'r').readline().strip().split('\t'))
+        if not os.path.exists(self.output_store):
+            write_count_store(self.output_df, self.output_store)
 
         # A vector consists of all current tissue samples + one for each sample NOT in this set
-        log.info('Writing out vectors')
-        for df in tqdm(self.protein_coding_paths):
-            tissue = os.path.basename(os.path.dirname(df))
-            tissue_set = {x for x in open(df, 'r').readline().strip().split('\t') if 'GTEX' in x}
+        log.info('Writing out vector manifest')
+        manifest = VectorManifest(self.manifest_path)
+        for tissue in tqdm(self.tissues):
+            tissue_set = {x for x in self.count_store(tissue).samples if 'GTEX' in x}
+            manifest.add_reference(tissue, [x.replace('-', '.') for x in tissue_set])
             for sample in (all_samples_vector - tissue_set):
-                sample_vector = [x.replace('-', '.') for x in list(tissue_set) + [sample]]
-                with open(os.path.join(self.experiment_dir, tissue, 'samples', sample), 'w') as f:
-                    f.write('\n'.join(sample_vector))
+                manifest.add_vector(os.path.join(tissue, sample), tissue, tissue, sample.replace('-', '.'))
+        manifest.save()
 
     def run_experiment(self):
-        vectors = [[os.path.join(x, 'samples', y)] for x in self.tissue_dirs
-                   for y in os.listdir(os.path.join(x, 'samples'))]
-        blob = zip([self.script_path for _ in xrange(len(vectors))], vectors)
-
         log.info('Starting DESeq2 Runs using {} cores'.format(self.cores))
-        with ThreadPoolExecutor(max_workers=self.cores) as executor:
-            executor.map(run_deseq2, blob)
+        self.run_deseq2_jobs(self.vector_jobs(), cores=self.cores, memory=self.memory)
+        self.store_results([os.path.join(x, 'results') for x in self.tissue_dirs])
 
         self.reduce()
 
+    def vector_jobs(self):
+        """
+        One DESeq2 job per vector in the manifest. The vector path passed to the script only names the sample
+        and locates the results directory; the vector itself is read from the job's pre-subset matrix.
+
+        :return: One DESeq2 job per sample vector
+        :rtype: list[Job]
+        """
+        manifest = VectorManifest(self.manifest_path)
+        return [Job(job_id=x.job_id, script_path=self.script_path,
+                    args=[os.path.join(self.experiment_dir, x.tissue, 'samples', x.job_id.split(os.sep)[-1])],
+                    output=os.path.join(self.experiment_dir, x.tissue, 'results', x.job_id.split(os.sep)[-1]),
+                    matrix=self.output_df, vector=manifest.vector(x.job_id), store=self.output_store)
+                for x in manifest]
+
+    def conditions(self, job):
+        return ['A'] * (len(job.vector) - 1) + ['B']
+
     def reduce(self):
         """Reduce results for each tissue into a single dataframe with p-value counts"""
+        from utils.reduction import reduce_store
+
         log.info('Reducing results for each tissue into a single dataframe of p-value counts')
-        gene_map = pickle.load(open(self.gene_map, 'rb'))
         for tissue_dir in tqdm(self.tissue_dirs):
             results_path = os.path.join(tissue_dir, 'results.tsv')
-            ranked = pd.DataFrame()
-            pvals = defaultdict(list)
-            fc = defaultdict(list)
-            results = [os.path.join(tissue_dir, 'results', x) for x in os.listdir(os.path.join(tissue_dir, 'results'))]
-            for result in tqdm(results):
-                df = pd.read_csv(result, index_col=0, sep='\t')
-                for gene in df.index:
-                    pvals[gene].append(df.loc[gene]['padj'])
-                    fc[gene].append(df.loc[gene]['log2FoldChange'])
-
-            genes = pvals.keys()
-            ranked['num_samples'] = [len(pvals[x]) for x in genes]
-            ranked['pval_counts'] = [sum([1 for y in pvals[x] if y < 0.001]) for x in genes]
-            ranked['pval'] = [np.median(pvals[x]) for x in genes]
-            ranked['pval_std'] = [round(np.std(pvals[x]), 4) for x in genes]
-            ranked['fc'] = [round(np.median(fc[x]), 4) for x in genes]
-            ranked['fc_std'] = [round(np.std(fc[x]), 4) for x in genes]
-
-            gene_names = [gene_map[x] if x in gene_map.keys() else x for x in genes]
-            ranked['gene_id'] = genes
-            ranked.index = gene_names
-            ranked.sort_values('pval_counts', inplace=True, ascending=False)
+            ranked = reduce_store(self.result_store(os.path.join(tissue_dir, 'results')), self.annotation)
 
             ranked.to_csv(results_path)
 
@@ -1,18 +1,14 @@
 import logging
 import os
-import pickle
 import textwrap
-from collections import defaultdict
-from collections import Counter
 
 import numpy as np
-import pandas as pd
-from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 
-from experiments.AbstractExperiment import AbstractExperiment
-from utils import run_deseq2
+from experiments.abstractExperiment import AbstractExperiment
 from utils import write_script
+from utils.manifest import VectorManifest
+from utils.scheduler import Job, job_vector
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger(__name__)
@@ -20,52 +16,55 @@ log = logging.getLogger(__name__)
 
 class PairwiseTcgaVsGtex(AbstractExperiment):
 
-    def __init__(self, root_dir, cores):
+    def __init__(self, root_dir, cores, memory=None, shared_reference=False, engine='deseq2'):
         super(PairwiseTcgaVsGtex, self).__init__(root_dir)
+        self.memory = memory
+        self.shared_reference = shared_reference
+        self.engine = engine
         self.cores = cores
         self.experiment_dir = os.path.join(root_dir, 'experiments/pairwise-tcga-vs-gtex')
         self.tissue_dirs = [os.path.join(self.experiment_dir, x) for x in self.tissues]
-        self.vector_dirs = [os.path.join(x, 'vectors') for x in self.tissue_dirs]
+        self.manifest_path = os.path.join(self.experiment_dir, 'manifest.json')
         self.results_dirs = [os.path.join(x, 'results') for x in self.tissue_dirs]
         self.script_path = None
 
     def setup(self):
-        for subdir in ['vectors', 'results', 'masked-results', 'masked-genes', 'masks']:
+        for subdir in ['results', 'masked-genes', 'masks']:
             self.create_directories([os.path.join(x, subdir) for x in self.tissue_dirs])
 
-        self.script_path = write_script(self.deseq2_script, directory=self.experiment_dir)
+        if self.shared_reference and self.engine == 'deseq2':
+            self.script_path = write_script(self.shared_reference_script, directory=self.experiment_dir,
+                                            name='deseq2-shared-reference.R')
+        else:
+            self.script_path = write_script(self.deseq2_script, directory=self.experiment_dir)
 
-        log.info('Writing out vectors')
+        log.info('Writing out vector manifest')
+        manifest = VectorManifest(self.manifest_path)
         for df in tqdm(self.protein_coding_paths):
             tissue = os.path.basename(os.path.dirname(df))
-            tissue_dir = os.path.join(self.experiment_dir, tissue)
             with open(df, 'r') as f:
                 samples = [x for x in f.readline().strip().split('\t')]
                 gtex = [x.replace('-', '.') for x in samples if 'GTEX-' in x]
                 tcga = [x.replace('-', '.') for x in samples if 'TCGA-' in x]
                 if gtex and tcga:
+                    manifest.add_reference(tissue, gtex)
                     for sample in tcga:
-                        vector = gtex + [sample]
-                        with open(os.path.join(tissue_dir, 'vectors', sample), 'w') as f_out:
-                            f_out.write('\n'.join(vector))
+                        manifest.add_vector(os.path.join(tissue, sample), tissue, tissue, sample)
+        manifest.save()
 
     def run_experiment(self):
-        df_vector_pairs = []
-        for df in self.protein_coding_paths:
-            tissue = os.path.basename(os.path.dirname(df))
-            vector_dir = os.path.join(self.experiment_dir, tissue, 'vectors')
-            vectors = [os.path.join(vector_dir, x) for x in os.listdir(vector_dir)]
-            for vector in vectors:
-                df_vector_pairs.append([df, vector])
+        from utils.one_vs_many import shared_reference_jobs
 
-        blob = zip([self.script_path for _ in xrange(len(df_vector_pairs))], df_vector_pairs)
-
-        if not os.listdir(self.results_dirs[0]):
-            log.info('Starting DESeq2 Runs using {} cores'.format(self.cores))
-            with ThreadPoolExecutor(max_workers=self.cores) as executor:
-                executor.map(run_deseq2, blob)
+        if self.shared_reference and self.engine == 'deseq2':
+            log.info('Testing each sample against a shared reference fit, one job per tissue')
+            jobs = shared_reference_jobs(self.script_path, self.protein_coding_paths, self.experiment_dir,
+                                         VectorManifest(self.manifest_path))
         else:
-            log.info('Results detected, skipping DESeq2 Run')
+            jobs = self.vector_jobs()
+
+        log.info('Starting DESeq2 Runs using {} cores'.format(self.cores))
+        self.run_deseq2_jobs(jobs, cores=self.cores, memory=self.memory)
+        self.store_results(self.results_dirs)
 
         self.create_masks()
 
@@ -76,73 +75,78 @@ class PairwiseTcgaVsGtex(AbstractExperiment):
         log.info('Reducing masked reuslts for each tissue into a single dataframe sorted by p-value counts')
         self.combine_results(output_name='results-masked.tsv', result_dir='masked-results')
 
-    def create_masks(self):
+    def create_masks(self, cutoff=0.001):
+        """
+        Masks genes significant in a patient's normal result out of their tumor result. For each tissue the
+        masked results go to the masked-results store, the masked gene names of each patient to masked-genes/,
+        and the genes x patients mask to masks/matched.npz.
+
+        :param float cutoff: padj cutoff for a gene to be masked
+        """
+        from utils.masking import mask_matched
+
         log.info('Creating masks for matched samples')
         for result_dir in tqdm(self.results_dirs):
-            masked_result_dir = os.path.join(os.path.dirname(result_dir), 'masked-results')
-            masked_gene_dir = os.path.join(os.path.dirname(result_dir), 'masked-genes')
-            results = [os.path.join(result_dir, x) for x in os.listdir(result_dir)]
-            result_names = [os.path.basename(x) for x in results]
-
-            # Trim last 3 characters to get TCGA barcode without the tumor / normal tag
-            barcodes = [x[:-3]for x in result_names]
-            matches = {item for item, count in Counter(barcodes).items() if count == 2}
-            matches = {x for x in matches if x + '.01' in result_names and x + '.11' in result_names}
-
-            # For each match, produce a masked result file in the masked-results directory
-            for match in matches:
-                df_norm = pd.read_csv(os.path.join(result_dir, match + '.11'), sep='\t', index_col=0)
-                df_tumor = pd.read_csv(os.path.join(result_dir, match + '.01'), sep='\t', index_col=0)
-                masked_genes = df_norm[df_norm.padj < 0.001].index
-                for gene in masked_genes:
-                    try:
-                        df_tumor.drop(gene, inplace=True)
-                    except ValueError:  # DE gene in normal didn't show up in tumor
-                        pass
-                df_tumor.to_csv(os.path.join(masked_result_dir, match + '.01'), sep='\t')
-
-                # Convert genes from ensembl to gene names and add to masked-genes directory
-                gene_map = pickle.load(open(self.gene_map, 'rb'))
-                gene_names = [gene_map[x] if x in gene_map.keys() else x for x in masked_genes]
-
-                with open(os.path.join(masked_gene_dir, match + '.01'), 'w') as f:
-                    f.write('\n'.join(gene_names))
+            tissue_dir = os.path.dirname(result_dir)
+            store = self.result_store(result_dir)
+            masked_store = self.result_store(os.path.join(tissue_dir, 'masked-results'))
+            patients, mask = mask_matched(store, masked_store, cutoff=cutoff, cores=self.cores)
+
+            tmp_path = os.path.join(tissue_dir, 'masks', 'matched.tmp.npz')
+            np.savez(tmp_path, genes=np.array(store.genes), patients=np.array(patients), mask=mask)
+            os.rename(tmp_path, os.path.join(tissue_dir, 'masks', 'matched.npz'))
+
+            # Convert genes from ensembl to gene names and add to masked-genes directory
+            gene_names = self.annotation.map_ids(store.genes)
+            for j, patient in enumerate(patients):
+                with open(os.path.join(tissue_dir, 'masked-genes', patient + '.01'), 'w') as f:
+                    f.write('\n'.join(gene_names[mask[:, j]]))
 
     def combine_results(self, output_name='results.tsv', result_dir='results', normal=True):
-        gene_map = pickle.load(open(self.gene_map, 'rb'))
+        from utils.reduction import reduce_store
+
         for tissue_dir in sorted(self.tissue_dirs):
             log.info('Processing ' + os.path.basename(tissue_dir))
             results_path = os.path.join(tissue_dir, output_name)
-            ranked = pd.DataFrame()
-            pvals = defaultdict(list)
-            fc = defaultdict(list)
             sample_suffix = '.11' if normal else '.01'
-            results = [os.path.join(tissue_dir, 'results', x) for x in
-                       os.listdir(os.path.join(tissue_dir, result_dir)) if x.endswith(sample_suffix)]
-            for result in tqdm(results):
-                df = pd.read_csv(result, index_col=0, sep='\t')
-                for gene in df.index:
-                    pvals[gene].append(df.loc[gene]['padj'])
-                    fc[gene].append(df.loc[gene]['log2FoldChange'])
-
-            genes = pvals.keys()
-            ranked['num_samples'] = [len(pvals[x]) for x in genes]
-            ranked['pval_counts'] = [sum([1 for y in pvals[x] if y < 0.001]) for x in genes]
-            ranked['pval'] = [np.median(pvals[x]) for x in genes]
-            ranked['pval_std'] = [round(np.std(pvals[x]), 4) for x in genes]
-            ranked['fc'] = [round(np.median(fc[x]), 4) for x in genes]
-            ranked['fc_std'] = [round(np.std(fc[x]), 4) for x in genes]
-
-            gene_names = [gene_map[x] if x in gene_map.keys() else x for x in genes]
-            ranked['gene_id'] = genes
-            ranked.index = gene_names
-            ranked.sort_values('pval_counts', inplace=True, ascending=False)
+            store = self.result_store(os.path.join(tissue_dir, result_dir))
+            samples = [x for x in store.samples if x.endswith(sample_suffix)]
+            ranked = reduce_store(store, self.annotation, samples=samples,
+                                  name='normal-reduction' if normal else 'tumor-reduction')
 
             ranked.to_csv(results_path, sep='\t')
 
     def teardown(self):
         pass
 
+    def vector_jobs(self):
+        """
+        One DESeq2 job per vector in the manifest. The vector path passed to the script only names the sample
+        and locates the results directory; the vector itself is read from the job's pre-subset matrix.
+
+        :return: One DESeq2 job per vector
+        :rtype: list[Job]
+        """
+        manifest = VectorManifest(self.manifest_path)
+        jobs = []
+        for df in self.protein_coding_paths:
+            tissue = os.path.basename(os.path.dirname(df))
+            store = self.ensure_count_store(df)
+            for vector in manifest.tissue(tissue):
+                jobs.append(Job(job_id=vector.job_id, script_path=self.script_path,
+                                args=[df, os.path.join(self.experiment_dir, tissue, 'vectors', vector.query)],
+                                output=os.path.join(self.experiment_dir, tissue, 'results', vector.query),
+                                vector=manifest.vector(vector.job_id), store=store))
+        return jobs
+
+    def conditions(self, job):
+        return ['G'] * (len(job_vector(job)) - 1) + ['T']
+
+    def shared_reference_script(self):
+        from utils.one_vs_many import one_vs_many_script
+
+        return one_vs_many_script(reference_level='G')
+
     def deseq2_script(self):
         return textwrap.dedent("""
             suppressMessages(library('DESeq2'))
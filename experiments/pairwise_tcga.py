@@ -1,17 +1,13 @@
 import logging
 import os
-import pickle
 import textwrap
-from collections import defaultdict
 
-import numpy as np
-import pandas as pd
-from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 
-from experiments.AbstractExperiment import AbstractExperiment
-from utils import run_deseq2
+from experiments.abstractExperiment import AbstractExperiment
 from utils import write_script
+from utils.manifest import VectorManifest
+from utils.scheduler import Job, job_vector
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger(__name__)
@@ -19,92 +15,104 @@ log = logging.getLogger(__name__)
 
 class PairwiseTCGA(AbstractExperiment):
 
-    def __init__(self, root_dir, cores):
+    def __init__(self, root_dir, cores, memory=None, shared_reference=False, engine='deseq2'):
         super(PairwiseTCGA, self).__init__(root_dir)
+        self.memory = memory
+        self.shared_reference = shared_reference
+        self.engine = engine
         self.cores = cores
         self.experiment_dir = os.path.join(root_dir, 'experiments/pairwise-tcga')
         self.tissue_dirs = [os.path.join(self.experiment_dir, x) for x in self.tissues]
-        self.vector_dirs = [os.path.join(x, 'vectors') for x in self.tissue_dirs]
+        self.manifest_path = os.path.join(self.experiment_dir, 'manifest.json')
         self.results_dirs = [os.path.join(x, 'results') for x in self.tissue_dirs]
         self.script_path = None
 
     def setup(self):
-        for subdir in ['vectors', 'results', 'masked-results', 'masked-genes', 'masks']:
+        for subdir in ['results', 'masked-results', 'masked-genes', 'masks']:
             self.create_directories([os.path.join(x, subdir) for x in self.tissue_dirs])
 
-        self.script_path = write_script(self.deseq2_script, directory=self.experiment_dir)
+        if self.shared_reference and self.engine == 'deseq2':
+            self.script_path = write_script(self.shared_reference_script, directory=self.experiment_dir,
+                                            name='deseq2-shared-reference.R')
+        else:
+            self.script_path = write_script(self.deseq2_script, directory=self.experiment_dir)
 
-        log.info('Writing out vectors')
+        log.info('Writing out vector manifest')
+        manifest = VectorManifest(self.manifest_path)
         for df in tqdm(self.protein_coding_paths):
             tissue = os.path.basename(os.path.dirname(df))
-            tissue_dir = os.path.join(self.experiment_dir, tissue)
             with open(df, 'r') as f:
                 samples = [x for x in f.readline().strip().split('\t')]
                 tcga = [x.replace('-', '.') for x in samples if 'TCGA-' in x]
                 tcga_t = [x for x in tcga if x.endswith('01')]
                 tcga_n = [x for x in tcga if x.endswith('11')]
                 if tcga_t and tcga_n:
+                    manifest.add_reference(tissue, tcga_n)
                     for sample in tcga_t:
-                        vector = tcga_n + [sample]
-                        with open(os.path.join(tissue_dir, 'vectors', sample), 'w') as f_out:
-                            f_out.write('\n'.join(vector))
+                        manifest.add_vector(os.path.join(tissue, sample), tissue, tissue, sample)
                 else:
                     self.results_dirs.remove(os.path.join(self.experiment_dir, tissue, 'results'))
+        manifest.save()
 
     def run_experiment(self):
-        df_vector_pairs = []
-        for df in self.protein_coding_paths:
-            tissue = os.path.basename(os.path.dirname(df))
-            vector_dir = os.path.join(self.experiment_dir, tissue, 'vectors')
-            vectors = [os.path.join(vector_dir, x) for x in os.listdir(vector_dir)]
-            for vector in vectors:
-                df_vector_pairs.append([df, vector])
-
-        blob = zip([self.script_path for _ in xrange(len(df_vector_pairs))], df_vector_pairs)
+        from utils.one_vs_many import shared_reference_jobs
 
-        if not os.listdir(self.results_dirs[0]):
-            log.info('Starting DESeq2 Runs using {} cores'.format(self.cores))
-            with ThreadPoolExecutor(max_workers=self.cores) as executor:
-                executor.map(run_deseq2, blob)
+        if self.shared_reference and self.engine == 'deseq2':
+            log.info('Testing each sample against a shared reference fit, one job per tissue')
+            jobs = shared_reference_jobs(self.script_path, self.protein_coding_paths, self.experiment_dir,
+                                         VectorManifest(self.manifest_path))
         else:
-            log.info('Results detected, skipping DESeq2 Run')
+            jobs = self.vector_jobs()
+
+        log.info('Starting DESeq2 Runs using {} cores'.format(self.cores))
+        self.run_deseq2_jobs(jobs, cores=self.cores, memory=self.memory)
+        self.store_results(self.results_dirs)
 
         log.info('Reducing results for each tissue into a single dataframe sorted by p-value counts')
         self.combine_results()
 
     def combine_results(self):
-        gene_map = pickle.load(open(self.gene_map, 'rb'))
-        for tissue_dir in sorted(self.tissue_dirs):
+        from utils.reduction import reduce_store
+
+        for results_dir in sorted(self.results_dirs):
+            tissue_dir = os.path.dirname(results_dir)
             log.info('Processing ' + os.path.basename(tissue_dir))
             results_path = os.path.join(tissue_dir, 'results.tsv')
-            ranked = pd.DataFrame()
-            pvals = defaultdict(list)
-            fc = defaultdict(list)
-            results = [os.path.join(tissue_dir, 'results', x) for x in os.listdir(os.path.join(tissue_dir, 'results'))]
-            for result in tqdm(results):
-                df = pd.read_csv(result, index_col=0, sep='\t')
-                for gene in df.index:
-                    pvals[gene].append(df.loc[gene]['padj'])
-                    fc[gene].append(df.loc[gene]['log2FoldChange'])
-
-            genes = pvals.keys()
-            ranked['num_samples'] = [len(pvals[x]) for x in genes]
-            ranked['pval_counts'] = [sum([1 for y in pvals[x] if y < 0.001]) for x in genes]
-            ranked['pval'] = [np.median(pvals[x]) for x in genes]
-            ranked['pval_std'] = [round(np.std(pvals[x]), 4) for x in genes]
-            ranked['fc'] = [round(np.median(fc[x]), 4) for x in genes]
-            ranked['fc_std'] = [round(np.std(fc[x]), 4) for x in genes]
-
-            gene_names = [gene_map[x] if x in gene_map.keys() else x for x in genes]
-            ranked['gene_id'] = genes
-            ranked.index = gene_names
-            ranked.sort_values('pval_counts', inplace=True, ascending=False)
+            ranked = reduce_store(self.result_store(results_dir), self.annotation)
 
             ranked.to_csv(results_path, sep='\t')
 
     def teardown(self):
         pass
 
+    def vector_jobs(self):
+        """
+        One DESeq2 job per vector in the manifest. The vector path passed to the script only names the sample
+        and locates the results directory; the vector itself is read from the job's pre-subset matrix.
+
+        :return: One DESeq2 job per vector
+        :rtype: list[Job]
+        """
+        manifest = VectorManifest(self.manifest_path)
+        jobs = []
+        for df in self.protein_coding_paths:
+            tissue = os.path.basename(os.path.dirname(df))
+            store = self.ensure_count_store(df)
+            for vector in manifest.tissue(tissue):
+                jobs.append(Job(job_id=vector.job_id, script_path=self.script_path,
+                                args=[df, os.path.join(self.experiment_dir, tissue, 'vectors', vector.query)],
+                                output=os.path.join(self.experiment_dir, tissue, 'results', vector.query),
+                                vector=manifest.vector(vector.job_id), store=store))
+        return jobs
+
+    def conditions(self, job):
+        return ['N'] * (len(job_vector(job)) - 1) + ['T']
+
+    def shared_reference_script(self):
+        from utils.one_vs_many import one_vs_many_script
+
+        return one_vs_many_script(reference_level='N')
+
     def deseq2_script(self):
         return textwrap.dedent("""
             suppressMessages(library('DESeq2'))
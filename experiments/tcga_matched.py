@@ -3,9 +3,10 @@ import os
 import shutil
 import textwrap
 
-from experiments.AbstractExperiment import AbstractExperiment
-from utils import run_deseq2, add_gene_names
+from experiments.abstractExperiment import AbstractExperiment
+from utils import add_gene_names
 from utils import write_script
+from utils.scheduler import Job
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger(__name__)
@@ -48,16 +49,32 @@ class TcgaMatched(AbstractExperiment):
                     shutil.rmtree(os.path.join(self.plots_dir, tissue))
 
     def run_experiment(self):
-        vectors = []
+        # One worker, since each script parallelizes DESeq2 itself through BiocParallel
+        log.info('Starting DESeq2 Runs using {} cores'.format(self.cores))
+        self.run_deseq2_jobs(self.vector_jobs(), cores=1)
+
+    def vector_jobs(self):
+        """
+        :return: One DESeq2 job per tissue with matched samples
+        :rtype: list[Job]
+        """
+        jobs = []
         for df in self.protein_coding_paths:
-            tissue_vector = os.path.join(self.vector_dir, os.path.basename(os.path.dirname(df)) + '-vector')
+            tissue = os.path.basename(os.path.dirname(df))
+            tissue_vector = os.path.join(self.vector_dir, tissue + '-vector')
             if tissue_vector in self.vectors:
-                vectors.append([df, tissue_vector])
-        blob = zip([self.script_path for _ in xrange(len(vectors))], vectors)
-
-        log.info('Starting DESeq2 Runs using {} cores'.format(self.cores))
-        for b in blob:
-            run_deseq2(b)
+                jobs.append(Job(job_id=tissue, script_path=self.script_path, args=[df, tissue_vector],
+                                output=os.path.join(self.results_dir, tissue + '-results.tsv'),
+                                store=os.path.join(os.path.dirname(df), 'counts-protein-coding')))
+        return jobs
+
+    def conditions(self, job):
+        # Vectors alternate tumor and normal samples of each patient
+        return ['T', 'N'] * (len(self.read_vector(job.args[-1])) // 2)
+
+    def covariates(self, job):
+        # Patient barcode, without the sample type suffix
+        return [[x[:-3] for x in self.read_vector(job.args[-1])]]
 
     def teardown(self):
         log.info('Adding gene names to results.')
@@ -2,9 +2,10 @@ import logging
 import os
 import textwrap
 
-from experiments.AbstractExperiment import AbstractExperiment
-from utils import run_deseq2, add_gene_names
+from experiments.abstractExperiment import AbstractExperiment
+from utils import add_gene_names
 from utils import write_script
+from utils.scheduler import Job
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger(__name__)
@@ -12,9 +13,10 @@ log = logging.getLogger(__name__)
 
 class TcgaTumorVsNormal(AbstractExperiment):
 
-    def __init__(self, root_dir, cores):
+    def __init__(self, root_dir, cores, engine='deseq2'):
         super(TcgaTumorVsNormal, self).__init__(root_dir)
         self.cores = cores
+        self.engine = engine
         self.experiment_dir = os.path.join(root_dir, 'experiments/tcga-tumor-vs-normal')
         self.vector_dir = os.path.join(self.experiment_dir, 'vectors')
         self.results_dir = os.path.join(self.experiment_dir, 'results')
@@ -45,17 +47,28 @@ class TcgaTumorVsNormal(AbstractExperiment):
                         f.write('\n'.join(disease_vector))
 
     def run_experiment(self):
-        vectors = []
+        # One worker, since each script parallelizes DESeq2 itself through BiocParallel
+        log.info('Starting DESeq2 Runs using {} cores'.format(self.cores))
+        self.run_deseq2_jobs(self.vector_jobs(), cores=self.cores if self.engine == 'nbinom' else 1)
+
+    def vector_jobs(self):
+        """
+        :return: One DESeq2 job per tissue
+        :rtype: list[Job]
+        """
+        jobs = []
         for df in self.protein_coding_paths:
-            tissue_vector = os.path.join(self.vector_dir, os.path.basename(os.path.dirname(df)) + '-vector')
+            tissue = os.path.basename(os.path.dirname(df))
+            tissue_vector = os.path.join(self.vector_dir, tissue + '-vector')
             disease_vector = tissue_vector.replace('-vector', '-disease')
             if os.path.exists(tissue_vector):
-                vectors.append([df, tissue_vector, disease_vector])
-        blob = zip([self.script_path for _ in xrange(len(vectors))], vectors)
+                jobs.append(Job(job_id=tissue, script_path=self.script_path, args=[df, tissue_vector, disease_vector],
+                                output=os.path.join(self.results_dir, tissue + '-results.tsv'), vector=tissue_vector,
+                                store=os.path.join(os.path.dirname(df), 'counts-protein-coding')))
+        return jobs
 
-        log.info('Starting DESeq2 Runs using {} cores'.format(self.cores))
-        for b in blob:
-            run_deseq2(b)
+    def conditions(self, job):
+        return self.read_vector(job.args[2])
 
     def teardown(self):
         log.info('Adding gene names to results.')
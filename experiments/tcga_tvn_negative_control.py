@@ -10,8 +10,10 @@ log = logging.getLogger(__name__)
 
 class TcgaNegativeControl(TcgaTumorVsNormal):
 
-    def __init__(self, root_dir, cores):
+    def __init__(self, root_dir, cores, permutations=None, seed=0):
         super(TcgaNegativeControl, self).__init__(root_dir, cores)
+        self.permutations = permutations
+        self.seed = seed
         self.experiment_dir = os.path.join(root_dir, 'experiments/tcga-tvn-negative-control')
         self.vector_dir = os.path.join(self.experiment_dir, 'vectors')
         self.results_dir = os.path.join(self.experiment_dir, 'results')
@@ -19,6 +21,16 @@ class TcgaNegativeControl(TcgaTumorVsNormal):
         self.script_path = None
         self.vectors = []
 
+    def run_experiment(self):
+        """
+        With permutations set, runs that many shuffles of the disease labels per tissue with the nbinom engine
+        and writes aggregated null statistics, instead of one DESeq2 run with a single shuffle
+        """
+        if self.permutations:
+            self.run_permutations(self.vector_jobs(), n=self.permutations, cores=self.cores, seed=self.seed)
+        else:
+            super(TcgaNegativeControl, self).run_experiment()
+
     def deseq2_script(self):
         return textwrap.dedent("""
             suppressMessages(library('DESeq2'))
@@ -1,17 +1,19 @@
+import glob
 import logging
 import os
 import pickle
-from itertools import combinations
 
 import matplotlib
 import numpy as np
-import pandas as pd
 from scipy.stats import gmean
-from sklearn.decomposition import PCA
-from sklearn.manifold import TSNE
 from tqdm import tqdm
 
-from experiments.AbstractExperiment import AbstractExperiment
+from experiments.abstractExperiment import AbstractExperiment
+from utils.cluster_diagnostics import ClusterDiagnostics, load_diagnostics
+from utils.log_matrix import load_log_matrix
+from utils.pca import RandomizedPCA
+from utils.scheduler import budget_map
+from utils.tsne import load_pca_scores, run_tsne
 # Force matplotlib to not use any Xwindows backend.
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
@@ -22,12 +24,31 @@ log = logging.getLogger(__name__)
 
 class TissueClustering(AbstractExperiment):
 
-    def __init__(self, root_dir):
+    def __init__(self, root_dir, perplexity=30.0, n_iter=1000, seed=1, pca_components=50, cores=1, memory=None,
+                 silhouette=False):
+        """
+        :param str root_dir: Path to project directory
+        :param float perplexity: t-SNE perplexity
+        :param int n_iter: Number of t-SNE iterations
+        :param int seed: Seed of the t-SNE embedding
+        :param int pca_components: Number of principal components t-SNE is run on
+        :param int cores: Number of tissues embedded concurrently
+        :param float memory: Memory budget for concurrent tissues in GB. Defaults to 80% of physical memory
+        :param bool silhouette: Also compute the silhouette of each group of samples
+        """
         super(TissueClustering, self).__init__(root_dir)
+        self.silhouette = silhouette
+        self.cores = cores
+        self.memory = memory
+        self.perplexity = perplexity
+        self.n_iter = n_iter
+        self.seed = seed
+        self.pca_components = pca_components
         self.experiment_dir = os.path.join(root_dir, 'experiments/tissue-clustering')
         self.tsne_dir = os.path.join(self.experiment_dir, 'tsne')
         self.pca_dir = os.path.join(self.experiment_dir, 'pca')
         self.pickles = os.path.join(self.experiment_dir, 'pickles')
+        self.matrix_dir = os.path.join(self.pickles, 'log-matrices')
         self.tcga = os.path.join(self.experiment_dir, 'tcga-only')
         self.tcga_matched = os.path.join(self.experiment_dir, 'tcga-matched')
 
@@ -50,59 +71,117 @@ class TissueClustering(AbstractExperiment):
         self.run_clustering(mode='tcga-matched')
 
     def run_clustering(self, mode='tsne'):
-        for tissue_path in tqdm(sorted(self.protein_coding_paths)):
+        # Tissues are independent, so those without a pickle are embedded concurrently
+        tissue_paths = sorted(self.protein_coding_paths)
+        params = dict(perplexity=self.perplexity, n_iter=self.n_iter, random_state=self.seed,
+                      pca_components=self.pca_components)
+        pending = [x for x in tissue_paths if not os.path.exists(self.pickle_path(mode, x))]
+        blobs = [(x, mode, self.matrix_dir, self.pickle_path(mode, x), params) for x in pending]
+        budget_map(embed_tissue, blobs, [clustering_memory_mb(x, self.matrix_dir) for x in pending],
+                   cores=self.cores, memory_mb=self.memory * 1000 if self.memory else None)
+
+        for tissue_path in tqdm(tissue_paths):
             tissue = os.path.basename(os.path.dirname(tissue_path))
-            pickle_path = os.path.join(self.pickles, mode, tissue + '.pickle')
-            if os.path.exists(pickle_path):
-                log.info('Pickle file found, loading: ' + pickle_path)
-                x, label = pickle.load(open(pickle_path, 'rb'))
-            else:
-                df = pd.read_csv(tissue_path, sep='\t', index_col=0)
-                if mode == 'tcga-only':
-                    tcga_cols = [x for x in df.columns if 'TCGA-' in x]
-                    df = df[tcga_cols]
-                elif mode == 'tcga-matched':
-                    samples = list(df.columns)
-                    barcodes = [x[:-3] for x in samples]
-                    matched = list(set(x for x in barcodes if x + '-11' in samples and x + '-01' in samples))
-                    if matched:
-                        matched_vector = [f(x) for x in matched for f in (lambda f1: f1 + '-01', lambda f2: f2 + '-11')]
-                        df = df[matched_vector]
-                    else:
-                        continue
-
-                label = get_label(df)
-                df = df.T  # Transpose so dataframe is samples x genes
-
-                # Normalization via log normalization
-                # Also experimented with Size Factor Rescaling (from DESeq2) and Quantile Normalization
-                # Log normalization seemed sufficient, is fast, and straight forward
-                df = df.apply(lambda y: np.log(y + 1))
-
-                # Cluster by method
-                if mode == 'pca':
-                    x = run_pca(df)
-                else:
-                    x = run_tsne(df)
-
-                # Save relavant info in pickle
-                info = (x, label)
-                with open(pickle_path, 'w') as f:
-                    pickle.dump(info, f)
+            pickle_path = self.pickle_path(mode, tissue_path)
+            if not os.path.exists(pickle_path):
+                continue
+            log.info('Loading: ' + pickle_path)
+            with open(pickle_path, 'rb') as f:
+                x, label = pickle.load(f)
+
+            # Centroid distances (and silhouettes) are saved next to the pickle
+            diagnostics = load_diagnostics(pickle_path[:-len('.pickle')] + '.diagnostics.npz', x, label,
+                                           names=LABELS, silhouette=self.silhouette, source=pickle_path)
+            if diagnostics.silhouette is not None:
+                log.info('Silhouette for: {}: {}'.format(tissue, ', '.join(
+                    '{} {:.3f}'.format(a, b) for a, b in zip(diagnostics.names, diagnostics.silhouette))))
 
             # Plot
             f, ax = plt.subplots()
-            plot_dimensionality_reduction(ax, x, label, title=tissue)
+            plot_dimensionality_reduction(ax, x, label, title=tissue, diagnostics=diagnostics)
             f.savefig(os.path.join(self.experiment_dir, mode, tissue + '.png'), format='png', dpi=300)
             plt.close()
 
+    def pickle_path(self, mode, tissue_path):
+        """
+        :param str mode: Clustering mode
+        :param str tissue_path: Path to tissue's dataframe
+        :return: Path to the pickle of the tissue's embedding
+        :rtype: str
+        """
+        return os.path.join(self.pickles, mode, os.path.basename(os.path.dirname(tissue_path)) + '.pickle')
+
     def teardown(self):
         pass
 
 
-def get_label(df):
+def embed_tissue(blob):
+    """
+    Map function that embeds one tissue and atomically pickles (x, label), so an interrupted run resumes safely
+
+    :param tuple blob: Path to tissue's dataframe, mode, log matrix cache directory, pickle path, t-SNE parameters
+    :return: Pickle path, or None if the tissue has no samples for the mode
+    :rtype: str
+    """
+    tissue_path, mode, matrix_dir, pickle_path, params = blob
+    tissue = os.path.basename(os.path.dirname(tissue_path))
+
+    # Normalization via log normalization, cached as a samples x genes matrix shared by every mode
+    # Also experimented with Size Factor Rescaling (from DESeq2) and Quantile Normalization
+    # Log normalization seemed sufficient, is fast, and straight forward
+    matrix = load_log_matrix(tissue_path, matrix_dir, name=tissue)
+    samples = matrix.samples
+    if mode == 'tcga-only':
+        samples = [x for x in samples if 'TCGA-' in x]
+    elif mode == 'tcga-matched':
+        barcodes = [x[:-3] for x in samples]
+        matched = list(set(x for x in barcodes if x + '-11' in samples and x + '-01' in samples))
+        if matched:
+            samples = [f(x) for x in matched for f in (lambda f1: f1 + '-01', lambda f2: f2 + '-11')]
+        else:
+            return None
+
+    label = get_label(samples)
+
+    # Cluster by method. PCA reads the memory-mapped matrix a block of samples at a time, and the
+    # t-SNE modes share one PCA basis of all the tissue's samples
+    if mode == 'pca':
+        x = run_pca(matrix.values, rows=matrix.rows(samples))
+    else:
+        scores = load_pca_scores(matrix, n_components=params['pca_components'])
+        x = run_tsne(scores[matrix.rows(samples)], **params)
+
+    # Save relavant info in pickle
+    tmp_path = pickle_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump((x, label), f)
+    os.rename(tmp_path, pickle_path)
+    return pickle_path
+
+
+def clustering_memory_mb(tissue_path, matrix_dir):
+    """
+    Predicted peak memory of embedding a tissue. Parsing the dataframe into a log matrix dominates: pandas holds
+    the counts as float64 next to their log transpose and its float32 copy, about 4x the dataframe's size on
+    disk. Once the matrix is cached, PCA reads it a block at a time and t-SNE works on the small score matrix.
+
+    :param str tissue_path: Path to tissue's dataframe
+    :param str matrix_dir: Log matrix cache directory
+    :return: Predicted peak memory in MB
+    :rtype: float
+    """
+    tissue = os.path.basename(os.path.dirname(tissue_path))
+    cached = glob.glob(os.path.join(matrix_dir, tissue + '.*.npy'))
+    return os.path.getsize(tissue_path) / 1e6 * (0.5 if cached else 4) + 128
+
+
+# Name of each label returned by get_label
+LABELS = ['GTEX', 'TCGA-T', 'TCGA-N', 'TCGA-O']
+
+
+def get_label(samples):
     labels = []
-    for sample in df.columns:
+    for sample in samples:
         if 'GTEX-' in sample:
             labels.append(0)
         elif sample.endswith('01'):
@@ -125,8 +204,8 @@ def size_factor_scale(df):
     return df.divide(size_factors, axis=1).apply(lambda x: np.log2(x))
 
 
-def plot_dimensionality_reduction(ax, x, label, title, alpha=0.5):
-    names = ['GTEX', 'TCGA-T', 'TCGA-N', 'TCGA-O']
+def plot_dimensionality_reduction(ax, x, label, title, alpha=0.5, diagnostics=None):
+    names = LABELS
     length = [0, 1, 2, 3]
     cm = plt.get_cmap('Accent')
     color_set = (cm(1. * i / len(names)) for i in xrange(len(names)))
@@ -137,27 +216,27 @@ def plot_dimensionality_reduction(ax, x, label, title, alpha=0.5):
     log.info('Plotting: ' + title)
 
     # Cluster distance measurements
-    tcga_tn_dist = None
-    tcga_gtex_dist = None
-    for a, b in combinations(set(label), 2):
-        dist = np.sqrt((x[label == a, 0].mean() - x[label == b, 0].mean()) ** 2 +
-                       (x[label == a, 1].mean() - x[label == b, 1].mean()) ** 2)
-        log.info('Distance for: {:>8} {:>8} {:>8}'.format(names[a], names[b], dist))
-        if sum([a, b]) == 2:  # GTEX / TCGA-N
-            tcga_gtex_dist = dist
-        elif sum([a, b]) == 3:  # TCGA-T / TCGA-N
-            tcga_tn_dist = dist
+    diagnostics = diagnostics or ClusterDiagnostics.from_embedding(x, label, names=names)
+    for a, b, dist in diagnostics.pairs():
+        log.info('Distance for: {:>8} {:>8} {:>8}'.format(a, b, dist))
+    tcga_gtex_dist = diagnostics.distance(0, 2)  # GTEX / TCGA-N
+    tcga_tn_dist = diagnostics.distance(1, 2)  # TCGA-T / TCGA-N
+    if tcga_gtex_dist is None or tcga_tn_dist is None:
+        return
     if tcga_gtex_dist < tcga_tn_dist:
         log.info('GTEx and TCGA Normal are more similar!')
     else:
         log.info('TCGA tumor / normal are more similar')
 
 
-def run_pca(df):
-    pca = PCA(n_components=2, random_state=1)
-    return pca.fit(df).transform(df)
-
+def run_pca(df, rows=None, n_components=2):
+    """
+    :param np.array df: samples x genes matrix, in memory or memory-mapped
+    :param np.array rows: Rows of the matrix to use. Defaults to all
+    :param int n_components: Number of components
+    :return: samples x n_components scores
+    :rtype: np.array
+    """
+    pca = RandomizedPCA(n_components=n_components, random_state=1)
+    return pca.fit_transform(np.asarray(df), rows=rows)
 
-def run_tsne(df):
-    model = TSNE(n_components=2)
-    return model.fit_transform(np.array(df))
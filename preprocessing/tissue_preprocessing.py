@@ -5,11 +5,17 @@ September, 2016
 """
 import logging
 import os
+import shutil
+import tempfile
+import time
 
 import numpy as np
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
 
+from utils.gtf_index import load_gtf_index
+
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger(__name__)
 
@@ -57,7 +63,8 @@ def create_subframe(df, samples, name, output_dir):
         sub.to_csv(output_path, sep='\t')
 
 
-def create_subframes(gtex_metadata, tcga_metadata, gtex_expression, tcga_expression, output_dir):
+def create_subframes(gtex_metadata, tcga_metadata, gtex_expression, tcga_expression, output_dir, chunksize=None,
+                     cores=1):
     """
     Create subframes for every tissue
 
@@ -66,16 +73,34 @@ def create_subframes(gtex_metadata, tcga_metadata, gtex_expression, tcga_express
     :param str gtex_expression: Path to GTEx expression table
     :param str tcga_expression: Path to TCGA expression table
     :param str output_dir: Path to output directory for tables
+    :param int chunksize: If set, stream the expression tables this many genes at a time instead of loading them
+    :param int cores: Number of processes used to write tissue dataframes concurrently
     """
     # GTEx metadata
     gtex_meta = pd.read_csv(gtex_metadata, delimiter='\t')
     gtex_meta.replace('<not provided>', np.nan, inplace=True)
     gtex_meta.columns = [x[:-2] for x in gtex_meta.columns]
+    gtex_tissues = tissue_samples(gtex_meta, tissue_column='body_site', sample_column='Sample_Name')
 
     # TCGA metadata
     # Fix naming convention - Xena's barcode consists of only 15 characters
     tcga_meta = pd.read_csv(tcga_metadata, delimiter='\t')
     tcga_meta.barcode = [x[:15] for x in tcga_meta.barcode]
+    tcga_tissues = tissue_samples(tcga_meta, tissue_column='disease_name', sample_column='barcode')
+
+    if chunksize:
+        log.info('Streaming GTEx expression table into tissue dataframes')
+        stream_subframes(gtex_expression, gtex_tissues, output_dir, chunksize=chunksize)
+        log.info('Streaming TCGA expression table into tissue dataframes')
+        stream_subframes(tcga_expression, tcga_tissues, output_dir, chunksize=chunksize)
+        return
+
+    if cores > 1:
+        log.info('Creating GTEx tissue dataframes using {} cores'.format(cores))
+        parallel_subframes(gtex_expression, gtex_tissues, output_dir, cores=cores)
+        log.info('Creating TCGA tissue dataframes using {} cores'.format(cores))
+        parallel_subframes(tcga_expression, tcga_tissues, output_dir, cores=cores)
+        return
 
     log.info('Reading in in GTEx expression table')
     gt = pd.read_csv(gtex_expression, delimiter='\t')
@@ -86,16 +111,131 @@ def create_subframes(gtex_metadata, tcga_metadata, gtex_expression, tcga_express
     tc = process_raw_xena_df(tc)
 
     log.info('Creating GTEx tissue dataframes')
-    for tissue in tqdm(gtex_meta.body_site.unique()):
-        subtype = gtex_meta[gtex_meta.body_site == tissue]
-        name = '_'.join(' '.join(tissue.split('-')).split())
-        create_subframe(gt, samples=subtype.Sample_Name, name=name, output_dir=output_dir)
+    for name in tqdm(sorted(gtex_tissues)):
+        create_subframe(gt, samples=gtex_tissues[name], name=name, output_dir=output_dir)
 
     log.info('Creating TCGA tissue dataframes')
-    for tissue in tqdm(tcga_meta.disease_name.unique()):
-        subtype = tcga_meta[tcga_meta.disease_name == tissue]
-        name = '_'.join(' '.join(tissue.split('-')).split())
-        create_subframe(tc, samples=subtype.barcode, name=name, output_dir=output_dir)
+    for name in tqdm(sorted(tcga_tissues)):
+        create_subframe(tc, samples=tcga_tissues[name], name=name, output_dir=output_dir)
+
+
+def tissue_samples(meta, tissue_column, sample_column):
+    """
+    Groups samples by tissue
+
+    :param pd.DataFrame meta: Metadata dataframe
+    :param str tissue_column: Column containing the body site or disease name
+    :param str sample_column: Column containing the sample name
+    :return: Output dataframe name mapped to the samples for that tissue
+    :rtype: dict(str, list[str])
+    """
+    return {'_'.join(' '.join(tissue.split('-')).split()): list(group[sample_column])
+            for tissue, group in meta.groupby(tissue_column)}
+
+
+def stream_subframes(expression_path, tissues, output_dir, chunksize=1000):
+    """
+    Creates tissue subframes from a raw Xena table without loading the whole table.
+
+    The table is read a block of genes at a time and each block's sample columns are appended to
+    their tissue's output, so memory is bounded by the chunksize rather than the size of the table.
+    Outputs are written to a temporary file and moved into place once the table has been read.
+
+    :param str expression_path: Path to Xena expression table (genes x samples)
+    :param dict(str, list[str]) tissues: Output dataframe name mapped to the samples for that tissue
+    :param str output_dir: Path to output directory for tables
+    :param int chunksize: Number of genes to read at a time
+    """
+    outputs = {name: os.path.join(output_dir, name + '.tsv') for name in tissues}
+    pending = [name for name in sorted(tissues) if not os.path.exists(outputs[name])]
+    if not pending:
+        return
+
+    header = pd.read_csv(expression_path, delimiter='\t', index_col=0, nrows=0).columns
+    columns = {}
+    for name in pending:
+        samples = set(tissues[name])
+        columns[name] = [x for x in header if x in samples]
+
+    handles = {name: open(outputs[name] + '.tmp', 'w') for name in pending}
+    try:
+        reader = pd.read_csv(expression_path, delimiter='\t', index_col=0, chunksize=chunksize)
+        for i, chunk in enumerate(tqdm(reader)):
+            chunk.index.name = None
+            for name in pending:
+                sub = np.exp2(chunk[columns[name]]) - 1  # Reverse of Xena normalization
+                sub.to_csv(handles[name], sep='\t', header=(i == 0))
+    finally:
+        for f in handles.values():
+            f.close()
+    for name in pending:
+        os.rename(outputs[name] + '.tmp', outputs[name])
+
+
+def parallel_subframes(expression_path, tissues, output_dir, cores, chunksize=1000, scratch_dir=None):
+    """
+    Creates tissue subframes from a raw Xena table using a pool of processes.
+
+    The table is read a block of genes at a time, converted back to counts, into a memory-mapped, column-major
+    float32 array, so the parent never holds more than a chunk of it. The array and the gene index are kept in
+    a temporary directory that is removed once the subframes are written or if writing them fails. Every
+    worker memory-maps the array read-only and only pages in the sample columns of the tissue it is writing.
+    Counts are float32, which keeps 7 significant digits.
+
+    :param str expression_path: Path to Xena expression table (genes x samples)
+    :param dict(str, list[str]) tissues: Output dataframe name mapped to the samples for that tissue
+    :param str output_dir: Path to output directory for tables
+    :param int cores: Number of processes to use
+    :param int chunksize: Number of genes to read at a time
+    :param str scratch_dir: Directory to create the temporary directory in. Defaults to the system's
+    """
+    outputs = {name: os.path.join(output_dir, name + '.tsv') for name in tissues}
+    pending = [name for name in sorted(tissues) if not os.path.exists(outputs[name])]
+    if not pending:
+        return
+
+    log.info('Reading in expression table: ' + expression_path)
+    header = list(pd.read_csv(expression_path, delimiter='\t', index_col=0, nrows=0).columns)
+    with open(expression_path) as f:
+        n_genes = sum(1 for _ in f) - 1
+    tmp_dir = tempfile.mkdtemp(prefix='subframes-', dir=scratch_dir)
+    try:
+        matrix_path = os.path.join(tmp_dir, 'counts.npy')
+        matrix = np.lib.format.open_memmap(matrix_path, mode='w+', dtype=np.float32, shape=(n_genes, len(header)),
+                                           fortran_order=True)
+        genes = []
+        for chunk in tqdm(pd.read_csv(expression_path, delimiter='\t', index_col=0, chunksize=chunksize)):
+            matrix[len(genes):len(genes) + len(chunk)] = np.exp2(chunk.values) - 1  # Reverse of Xena normalization
+            genes.extend(chunk.index)
+        matrix.flush()
+        del matrix
+        genes_path = os.path.join(tmp_dir, 'genes.txt')
+        with open(genes_path, 'w') as f:
+            f.write(''.join(x + '\n' for x in genes))
+
+        jobs = []
+        for name in pending:
+            samples = set(tissues[name])
+            columns = [i for i, x in enumerate(header) if x in samples]
+            jobs.append((matrix_path, genes_path, [header[i] for i in columns], columns, outputs[name]))
+        with ProcessPoolExecutor(max_workers=cores) as executor:
+            for name, elapsed in tqdm(executor.map(_write_subframe, jobs), total=len(jobs)):
+                log.info('Created {} in {:.1f}s'.format(name, elapsed))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def _write_subframe(blob):
+    """Map function for writing one tissue subframe from the memory-mapped count matrix"""
+    matrix_path, genes_path, samples, columns, output_path = blob
+    start = time.time()
+    with open(genes_path) as f:
+        genes = [x.rstrip('\n') for x in f]
+    matrix = np.load(matrix_path, mmap_mode='r')
+    sub = pd.DataFrame(matrix[:len(genes), columns], index=genes, columns=samples)
+    sub.to_csv(output_path + '.tmp', sep='\t')
+    os.rename(output_path + '.tmp', output_path)
+    return os.path.basename(output_path), time.time() - start
 
 
 def concat_frames(gtex_df_paths, tcga_df_path, output_path):
@@ -114,7 +254,6 @@ def concat_frames(gtex_df_paths, tcga_df_path, output_path):
         df.to_csv(output_path, sep='\t')
 
 
-# TODO: Replace with GTFParser
 def remove_nonprotein_coding_genes(df_path, gencode_path):
     """
     Removes non-protein coding genes which can skew normalization
@@ -122,17 +261,10 @@ def remove_nonprotein_coding_genes(df_path, gencode_path):
     :param str df_path: Path to combined-gtex-tcga-counts.tsv dataframe
     :param str gencode_path: Path to gencode GTF
     """
-    df = pd.read_csv(df_path, sep='\t', index_col=0)
-    pc_genes = set()
     output_path = os.path.join(os.path.dirname(df_path), 'combined-gtex-tcga-counts-protein-coding.tsv')
     if not os.path.exists(output_path):
-        with open(gencode_path, 'r') as f:
-            for line in f.readlines():
-                if not line.startswith('#'):
-                    line = line.split()
-                    if line[line.index('gene_type') + 1] == '"protein_coding";':
-                        pc_genes.add(line[line.index('gene_id') + 1].split('"')[1])
+        df = pd.read_csv(df_path, sep='\t', index_col=0)
         # Subset list of protein-coding genes
-        pc_genes = list(pc_genes)
+        pc_genes = load_gtf_index(gencode_path).protein_coding_genes()
         df = df.ix[pc_genes]
         df.to_csv(output_path, sep='\t')
@@ -1,22 +1,43 @@
 # coding: utf-8
 import argparse
+import importlib
 import logging
+import os
+import subprocess
 import sys
+import time
 
-from experiments.deseq2_time_test import DESeq2TimeTest
-from experiments.pairwise_gtex import PairwiseGTEx
-from experiments.pairwise_gtex_vs_tcga import PairwiseTcgaVsGtex
-from experiments.pairwise_tcga import PairwiseTCGA
-from experiments.tcga_matched import TcgaMatched
-from experiments.tcga_matched_negative_control import TcgaMatchedNegativeControl
-from experiments.tcga_tumor_vs_normal import TcgaTumorVsNormal
-from experiments.tcga_tvn_negative_control import TcgaNegativeControl
-from experiments.tissue_clustering import TissueClustering
 from utils import cls, title_tcga_matched, title_pairwise_gtex_tcga
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger(__name__)
 
+# Experiment class of each subcommand, imported only when the subcommand runs so that --help and the
+# DESeq2-only subcommands don't load pandas, sklearn, matplotlib or scipy
+EXPERIMENTS = {
+    'pairwise-gtex': 'experiments.pairwise_gtex:PairwiseGTEx',
+    'pairwise-gtex-tcga': 'experiments.pairwise_gtex_vs_tcga:PairwiseTcgaVsGtex',
+    'pairwise-tcga': 'experiments.pairwise_tcga:PairwiseTCGA',
+    'tcga-tumor-vs-normal': 'experiments.tcga_tumor_vs_normal:TcgaTumorVsNormal',
+    'tcga-matched': 'experiments.tcga_matched:TcgaMatched',
+    'tcga-neg-control': 'experiments.tcga_tvn_negative_control:TcgaNegativeControl',
+    'tcga-matched-neg-control': 'experiments.tcga_matched_negative_control:TcgaMatchedNegativeControl',
+    'tissue-clustering': 'experiments.tissue_clustering:TissueClustering',
+    'deseq2-time-test': 'experiments.deseq2_time_test:DESeq2TimeTest'}
+
+# Modules that should never be loaded by --help or by dispatching a DESeq2 experiment
+HEAVY_MODULES = ['pandas', 'sklearn', 'matplotlib', 'scipy']
+
+
+def load_experiment(name):
+    """
+    :param str name: Subcommand of the experiment, a key of EXPERIMENTS
+    :return: Experiment class
+    :rtype: type
+    """
+    module, cls_name = EXPERIMENTS[name].split(':')
+    return getattr(importlib.import_module(module), cls_name)
+
 
 def runner(instance):
     instance.setup()
@@ -33,31 +54,54 @@ def main():
     First run create_project.py (or create-project entrypoint) to create the necessary
     prerequisite project directory
     """
-    parser = argparse.ArgumentParser(description=main.__doc__, formatter_class=argparse.RawDescriptionHelpFormatter,
-                                     add_help=False)
+    parser = argparse.ArgumentParser(description=main.__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
     subparsers = parser.add_subparsers(dest='command')
 
     # Pairwise GTEx
     parser_gtex_pairwise = subparsers.add_parser('pairwise-gtex', help='Run GTEx Pairwise Comparison')
     parser_gtex_pairwise.add_argument('--project-dir', required=True, help='Full path to project dir (rna-seq-analysis')
     parser_gtex_pairwise.add_argument('--cores', required=True, type=int, help='Number of cores to utilize during run.')
+    parser_gtex_pairwise.add_argument('--memory', type=float, help='Memory (GB) available to concurrent DESeq2 runs. '
+                                                                    'Defaults to 80%% of physical memory.')
+    parser_gtex_pairwise.add_argument('--engine', choices=['deseq2', 'nbinom'], default='deseq2',
+                                      help='Differential expression backend: DESeq2 in R, or the NumPy '
+                                           'negative-binomial engine.')
 
     # Pairwise TCGA v GTEx
     parser_pairwise = subparsers.add_parser('pairwise-gtex-tcga',
                                             help='Performs pairwise comparison between GTEx and TCGA')
     parser_pairwise.add_argument('--project-dir', help='Full path to project dir (rna-seq-analysis')
     parser_pairwise.add_argument('--cores', required=True, type=int, help='Number of cores to utilize during run.')
+    parser_pairwise.add_argument('--memory', type=float, help='Memory (GB) available to concurrent DESeq2 runs. '
+                                                               'Defaults to 80%% of physical memory.')
+    parser_pairwise.add_argument('--shared-reference', action='store_true',
+                                 help='Fit the reference cohort once per tissue and test each sample against it, '
+                                      'instead of running DESeq2 once per vector.')
+    parser_pairwise.add_argument('--engine', choices=['deseq2', 'nbinom'], default='deseq2',
+                                 help='Differential expression backend: DESeq2 in R, or the NumPy '
+                                      'negative-binomial engine.')
 
     # Pairwise TCGA Tumor vs Normal
     parser_pairwise = subparsers.add_parser('pairwise-tcga',
                                             help='Performs pairwise comparison between TCGA tumor and normal.')
     parser_pairwise.add_argument('--project-dir', help='Full path to project dir (rna-seq-analysis')
     parser_pairwise.add_argument('--cores', required=True, type=int, help='Number of cores to utilize during run.')
+    parser_pairwise.add_argument('--memory', type=float, help='Memory (GB) available to concurrent DESeq2 runs. '
+                                                               'Defaults to 80%% of physical memory.')
+    parser_pairwise.add_argument('--shared-reference', action='store_true',
+                                 help='Fit the reference cohort once per tissue and test each sample against it, '
+                                      'instead of running DESeq2 once per vector.')
+    parser_pairwise.add_argument('--engine', choices=['deseq2', 'nbinom'], default='deseq2',
+                                 help='Differential expression backend: DESeq2 in R, or the NumPy '
+                                      'negative-binomial engine.')
 
     # TCGA Tumor Vs Normal
     parser_tcga = subparsers.add_parser('tcga-tumor-vs-normal', help='Run TCGA T/N Analysis')
     parser_tcga.add_argument('--project-dir', help='Full path to project dir (rna-seq-analysis')
     parser_tcga.add_argument('--cores', required=True, type=int, help='Number of cores to utilize during run.')
+    parser_tcga.add_argument('--engine', choices=['deseq2', 'nbinom'], default='deseq2',
+                             help='Differential expression backend: DESeq2 in R, or the NumPy '
+                                  'negative-binomial engine.')
 
     # TCGA Matched
     parser_tcga_matched = subparsers.add_parser('tcga-matched', help='Run TCGA T/N analysis, matching T/N patients.')
@@ -69,12 +113,20 @@ def main():
                                                               'order of the disease vector relative to the input.')
     tcga_neg.add_argument('--project-dir', help='Full path to project dir (rna-seq-analysis')
     tcga_neg.add_argument('--cores', required=True, type=int, help='Number of cores to utilize during run.')
+    tcga_neg.add_argument('--permutations', type=int,
+                          help='Run this many label shuffles per tissue in one process and write aggregated '
+                               'null statistics, instead of a single DESeq2 run.')
+    tcga_neg.add_argument('--seed', type=int, default=0, help='Seed of the first permutation.')
 
     tcga_match_neg = subparsers.add_parser('tcga-matched-neg-control',
                                            help='Performs negative control experiment by randomizing disease'
                                                 'and patient vector relative to the input.')
     tcga_match_neg.add_argument('--project-dir', help='Full path to project dir (rna-seq-analysis')
     tcga_match_neg.add_argument('--cores', required=True, type=int, help='Number of cores to utilize during run.')
+    tcga_match_neg.add_argument('--permutations', type=int,
+                                help='Run this many label shuffles per tissue in one process and write aggregated '
+                                     'null statistics, instead of a single DESeq2 run.')
+    tcga_match_neg.add_argument('--seed', type=int, default=0, help='Seed of the first permutation.')
 
     # Tissue Pair Clustering
     parser_tissue_clustering = subparsers.add_parser('tissue-clustering',
@@ -82,6 +134,50 @@ def main():
                                                           ' TCGA tumor, normal, and GTEx samples.')
     parser_tissue_clustering.add_argument('--project-dir', required=True,
                                           help='Full path to project dir (rna-seq-analysis')
+    parser_tissue_clustering.add_argument('--cores', type=int, default=1,
+                                          help='Number of tissues to embed concurrently.')
+    parser_tissue_clustering.add_argument('--memory', type=float,
+                                          help='Memory (GB) available to concurrent tissues. '
+                                               'Defaults to 80%% of physical memory.')
+    parser_tissue_clustering.add_argument('--silhouette', action='store_true',
+                                          help='Also compute the silhouette of each group of samples, saved with '
+                                               'the centroid distances next to each embedding.')
+    parser_tissue_clustering.add_argument('--perplexity', type=float, default=30.0, help='t-SNE perplexity.')
+    parser_tissue_clustering.add_argument('--iterations', type=int, default=1000, help='t-SNE iterations.')
+    parser_tissue_clustering.add_argument('--seed', type=int, default=1, help='Seed of the t-SNE embedding.')
+    parser_tissue_clustering.add_argument('--pca-components', type=int, default=50,
+                                          help='Number of principal components t-SNE is run on.')
+
+    # nbinom engine concordance
+    parser_concordance = subparsers.add_parser('nbinom-concordance',
+                                               help='Reruns vectors that have DESeq2 results with the nbinom engine '
+                                                    'and compares the results.')
+    parser_concordance.add_argument('--project-dir', required=True, help='Full path to project dir (rna-seq-analysis)')
+    parser_concordance.add_argument('--experiment', required=True,
+                                    choices=['pairwise-gtex', 'pairwise-gtex-tcga', 'pairwise-tcga',
+                                             'tcga-tumor-vs-normal'],
+                                    help='Experiment whose DESeq2 results are compared.')
+    parser_concordance.add_argument('--vectors', type=int, default=10, help='Number of vectors to compare.')
+
+    # Shared-reference concordance
+    parser_shared = subparsers.add_parser('shared-reference-concordance',
+                                          help='Reruns queries that have shared-reference results with per-vector '
+                                               'DESeq2 and compares the results.')
+    parser_shared.add_argument('--project-dir', required=True, help='Full path to project dir (rna-seq-analysis)')
+    parser_shared.add_argument('--experiment', required=True, choices=['pairwise-gtex-tcga', 'pairwise-tcga'],
+                               help='Experiment whose shared-reference results are compared.')
+    parser_shared.add_argument('--queries', type=int, default=5, help='Number of queries to compare.')
+    parser_shared.add_argument('--cores', type=int, default=1, help='Number of R workers.')
+
+    # Export stored results
+    parser_export = subparsers.add_parser('export-results',
+                                          help='Writes the results held in an experiment\'s result stores back out '
+                                               'as one DESeq2 table per sample.')
+    parser_export.add_argument('--project-dir', required=True, help='Full path to project dir (rna-seq-analysis)')
+    parser_export.add_argument('--experiment', required=True,
+                               choices=['pairwise-gtex', 'pairwise-gtex-tcga', 'pairwise-tcga'],
+                               help='Experiment whose results are exported.')
+    parser_export.add_argument('--output-dir', required=True, help='Directory to write a directory per tissue to.')
 
     # DeSeq2 Time Test
     parser_deseq2 = subparsers.add_parser('deseq2-time-test', help='Runs DeSeq2 with increasing number of samples and '
@@ -89,6 +185,13 @@ def main():
     parser_deseq2.add_argument('--project-dir', required=True, help='Full path to project dir (rna-seq-analysis)')
     parser_deseq2.add_argument('--cores', required=True, help='Number of cores to utilize during run.')
 
+    # Startup benchmark
+    parser_startup = subparsers.add_parser('startup-benchmark',
+                                           help='Times --help and the dispatch of every experiment in fresh '
+                                                'interpreters and fails if any exceed the budget.')
+    parser_startup.add_argument('--budget', type=float, default=1.0, help='Budget in seconds for each.')
+    parser_startup.add_argument('--repeats', type=int, default=3, help='Runs of each; the fastest is kept.')
+
     # If no arguments provided, print full help menu
     if len(sys.argv) == 1:
         cls()
@@ -97,43 +200,102 @@ def main():
 
     # Execution
     params = parser.parse_args()
+    if params.command == 'startup-benchmark':
+        sys.exit(0 if startup_benchmark(params.budget, params.repeats) else 1)
     cls()
 
     if params.command == 'tissue-clustering':
         log.info('Tissue Clustering')
-        runner(TissueClustering(params.project_dir))
+        runner(load_experiment(params.command)(params.project_dir, params.perplexity, params.iterations,
+                                               params.seed, params.pca_components, params.cores, params.memory,
+                                               params.silhouette))
 
     elif params.command == 'tcga-matched':
         log.info(title_tcga_matched())
-        runner(TcgaMatched(params.project_dir, params.cores))
+        runner(load_experiment(params.command)(params.project_dir, params.cores))
 
     elif params.command == 'pairwise-gtex-tcga':
         log.info(title_pairwise_gtex_tcga())
-        runner(PairwiseTcgaVsGtex(params.project_dir, params.cores))
+        runner(load_experiment(params.command)(params.project_dir, params.cores, params.memory,
+                                               params.shared_reference, params.engine))
 
     elif params.command == 'tcga-tumor-vs-normal':
         log.info('TCGA Tumor Vs Normal')
-        runner(TcgaTumorVsNormal(params.project_dir, params.cores))
+        runner(load_experiment(params.command)(params.project_dir, params.cores, params.engine))
 
     elif params.command == 'tcga-neg-control':
         log.info('TCGA Tumor vs Normal Negative Control')
-        runner(TcgaNegativeControl(params.project_dir, params.cores))
+        runner(load_experiment(params.command)(params.project_dir, params.cores, params.permutations, params.seed))
 
     elif params.command == 'tcga-matched-neg-control':
         log.info('TCGA Matched Negative Control')
-        runner(TcgaMatchedNegativeControl(params.project_dir, params.cores))
+        runner(load_experiment(params.command)(params.project_dir, params.cores, params.permutations, params.seed))
 
-    elif params.command == 'gtex-pairwise':
+    elif params.command == 'pairwise-gtex':
         log.info('GTEx Pairwise Tissue Experiment')
-        runner(PairwiseGTEx(params.project_dir, params.cores))
+        runner(load_experiment(params.command)(params.project_dir, params.cores, params.memory, params.engine))
 
     elif params.command == 'pairwise-tcga':
         log.info('Pairwise TCGA Tumor vs Normal')
-        runner(PairwiseTCGA(params.project_dir, params.cores))
+        runner(load_experiment(params.command)(params.project_dir, params.cores, params.memory,
+                                               params.shared_reference, params.engine))
+
+    elif params.command == 'nbinom-concordance':
+        log.info('nbinom Engine Concordance')
+        experiment = load_experiment(params.experiment)(params.project_dir, 1)
+        experiment.check_concordance(experiment.vector_jobs(), n=params.vectors)
+
+    elif params.command == 'shared-reference-concordance':
+        log.info('Shared-Reference Concordance')
+        experiment = load_experiment(params.experiment)(params.project_dir, params.cores)
+        experiment.check_shared_reference(experiment.vector_jobs(), n=params.queries, cores=params.cores)
+
+    elif params.command == 'export-results':
+        log.info('Exporting Stored Results')
+        experiment = load_experiment(params.experiment)(params.project_dir, 1)
+        experiment.export_results(params.output_dir, [os.path.join(x, 'results') for x in experiment.tissue_dirs])
 
     elif params.command == 'deseq2-time-test':
         log.info('DESeq2 Time Test')
-        runner(DESeq2TimeTest(params.project_dir, params.cores))
+        runner(load_experiment(params.command)(params.project_dir, params.cores))
+
+
+def startup_benchmark(budget=1.0, repeats=3):
+    """
+    Times `--help`, and importing each experiment as its subcommand does, in fresh interpreters. Neither may
+    load HEAVY_MODULES, except for experiments that need them (tissue-clustering).
+
+    :param float budget: Budget in seconds for each
+    :param int repeats: Runs of each; the fastest is kept
+    :return: True if everything is within budget
+    :rtype: bool
+    """
+    root = os.path.dirname(os.path.abspath(__file__))
+    checks = [('--help', "sys.argv = ['recompute-analysis', '--help']\n"
+                         "try:\n    recompute_analysis.main()\nexcept SystemExit:\n    pass")]
+    checks += [(name, 'recompute_analysis.load_experiment({!r})'.format(name)) for name in sorted(EXPERIMENTS)]
+    report = '\nprint("heavy:" + ",".join(x for x in {!r} if x in sys.modules))'.format(HEAVY_MODULES)
+    ok = True
+    for name, code in checks:
+        elapsed = []
+        try:
+            for _ in xrange(repeats):
+                start = time.time()
+                script = 'import sys\nimport recompute_analysis\n' + code + report
+                out = subprocess.check_output([sys.executable, '-c', script], cwd=root)
+                elapsed.append(time.time() - start)
+        except subprocess.CalledProcessError:
+            log.error('{:<26} failed'.format(name))
+            ok = False
+            continue
+        heavy = [x for x in out.decode('utf-8').splitlines() if x.startswith('heavy:')][-1][len('heavy:'):]
+        within = min(elapsed) <= budget and (not heavy or name == 'tissue-clustering')
+        ok &= within
+        log.info('{:<26} {:6.2f}s {:<10} {}'.format(name, min(elapsed), 'ok' if within else 'OVER BUDGET',
+                                                    'loads ' + heavy if heavy else ''))
+    log.info('Startup is {}'.format('within budget' if ok else 'over budget'))
+    return ok
+
 
 if __name__ == '__main__':
     main()
@@ -3,16 +3,18 @@
 John Vivian
 November, 2016
 """
-from sklearn.decomposition import PCA
-from sklearn.manifold import TSNE
 
-from itertools import combinations
 import sys
 import pandas as pd
 import matplotlib.pyplot as plt
 import numpy as np
 import os
 
+from utils.cluster_diagnostics import ClusterDiagnostics
+from utils.gtf_index import load_gtf_index
+from utils.pca import RandomizedPCA
+from utils import tsne
+
 
 def create_classification_vector(df_paths):
     vector, label = [], []
@@ -32,14 +34,7 @@ def create_combined_df(df_paths, pc_genes):
 
 
 def find_protein_coding_genes(gencode_path):
-    pc_genes = set()
-    with open(gencode_path, 'r') as f:
-        for line in f.readlines():
-            if not line.startswith('#'):
-                line = line.split()
-                if line[line.index('gene_type') + 1] == '"protein_coding";':
-                    pc_genes.add(line[line.index('gene_id') + 1].split('"')[1])
-    return list(pc_genes)
+    return load_gtf_index(gencode_path).protein_coding_genes()
 
 
 def remove_nonprotein_coding_genes(df, pc_genes):
@@ -47,13 +42,12 @@ def remove_nonprotein_coding_genes(df, pc_genes):
 
 
 def run_pca(df):
-    pca = PCA(n_components=2)
-    return pca.fit(df).transform(df)
+    pca = RandomizedPCA(n_components=2)
+    return pca.fit_transform(np.asarray(df))
 
 
 def run_tsne(df):
-    model = TSNE(n_components=2)
-    return model.fit_transform(np.array(df))
+    return tsne.run_tsne(df)
 
 
 def plot_dimensionality_reduction(ax, x, files, label, title, alpha=0.5):
@@ -70,11 +64,8 @@ def plot_dimensionality_reduction(ax, x, files, label, title, alpha=0.5):
 def determine_distance(x, label, files):
     smallest_distance = sys.maxint
     smallest_set = None
-    for a, b in combinations(set(label), 2):
-        dist = np.sqrt((x[label == a, 0].mean() - x[label == b, 0].mean()) ** 2 +
-                       (x[label == a, 1].mean() - x[label == b, 1].mean()) ** 2)
-        s1 = os.path.basename(files[a]).split('.tsv')[0]
-        s2 = os.path.basename(files[b]).split('.tsv')[0]
+    names = [os.path.basename(z).split('.tsv')[0] for z in files]
+    for s1, s2, dist in ClusterDiagnostics.from_embedding(x, label, names=names).pairs():
         if 'tumor' in s1 or 'tumor' in s2:
             print 'Distance for: {} {}: {} '.format(s1, s2, dist)
             if dist < smallest_distance:
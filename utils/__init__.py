@@ -1,10 +1,8 @@
 # coding: utf-8
 import errno
 import os
-import pickle
 import textwrap
 
-import pandas as pd
 import logging
 
 import subprocess
@@ -36,16 +34,18 @@ def add_gene_names(df_path, gene_map_path):
     Adds gene names to results.tsv from DESeq2
 
     :param str df_path: Path to dataframe from DESeq2
-    :param str gene_map_path: Path to a pickled dictionary that maps geneId to geneName
+    :param str gene_map_path: Path to the gene map, as accepted by `load_gene_annotation`
     :return: Dataframe containing the geneNames as the index and the geneId as an appended column
     :rtype: pd.DataFrame
     """
-    gene_map = pickle.load(open(gene_map_path, 'rb'))
+    # Deferred so that importing utils (e.g. for the CLI's titles) doesn't load pandas
+    import pandas as pd
+    from utils.gene_annotation import load_gene_annotation
+
     df = pd.read_csv(df_path, sep='\t', index_col=0)
 
-    gene_names = [gene_map[x] if x in gene_map.keys() else x for x in df.index]
     df['geneId'] = df.index
-    df.index = gene_names
+    df.index = load_gene_annotation(gene_map_path).map_ids(df.index.values)
 
     return df
 
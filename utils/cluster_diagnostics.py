@@ -0,0 +1,179 @@
+"""
+Cluster diagnostics of 2-D (or any dimensional) embeddings
+
+The centroid of every group of samples (e.g. GTEx, TCGA tumor, TCGA normal) is computed in one grouped
+reduction, a product with the samples x groups indicator matrix, and the distances between all pairs of
+centroids in one broadcast. Silhouette scores are optional: each sample's mean distance to the samples of
+every group comes from a block of the pairwise distance matrix times the indicator matrix, so only
+block_size x samples distances are held at once.
+
+Diagnostics are saved as an .npz next to the embedding they describe, so similarity statistics across many
+embeddings can be gathered without recomputing or re-parsing logs.
+
+diagnostics = ClusterDiagnostics.from_embedding(x, label, names=['GTEX', 'TCGA-T', 'TCGA-N'], silhouette=True)
+diagnostics.distance(0, 2)
+diagnostics.save(pickle_path[:-len('.pickle')] + '.diagnostics.npz')
+"""
+import os
+
+import numpy as np
+
+
+def _indicator(label):
+    """
+    :param np.array label: Group label of each sample
+    :return: Sorted groups, group position of each sample, and the samples x groups indicator matrix
+    :rtype: tuple(np.array, np.array, np.array)
+    """
+    groups, inverse = np.unique(np.asarray(label), return_inverse=True)
+    indicator = np.zeros((len(inverse), len(groups)))
+    indicator[np.arange(len(inverse)), inverse] = 1
+    return groups, inverse, indicator
+
+
+def pairwise_distances(a, b):
+    """
+    :param np.array a: m x d matrix
+    :param np.array b: n x d matrix
+    :return: m x n Euclidean distances between the rows of a and b
+    :rtype: np.array
+    """
+    sq = (a ** 2).sum(axis=1)[:, np.newaxis] + (b ** 2).sum(axis=1)[np.newaxis, :] - 2 * np.dot(a, b.T)
+    return np.sqrt(np.maximum(sq, 0))
+
+
+def silhouette_samples(x, label, block_size=1024):
+    """
+    Silhouette of each sample: (b - a) / max(a, b), where a is its mean distance to the other samples of its
+    group and b its smallest mean distance to the samples of another group. Samples alone in their group score 0.
+
+    :param np.array x: samples x dimensions embedding
+    :param np.array label: Group label of each sample
+    :param int block_size: Samples whose distances are computed at once
+    :return: Silhouette of each sample
+    :rtype: np.array
+    """
+    x = np.asarray(x, dtype=np.float64)
+    groups, inverse, indicator = _indicator(label)
+    counts = indicator.sum(axis=0)
+    scores = np.zeros(len(x))
+    if len(groups) < 2:
+        return scores
+    for start in xrange(0, len(x), block_size):
+        rows = slice(start, min(start + block_size, len(x)))
+        own, index = inverse[rows], np.arange(len(inverse[rows]))
+        sums = np.dot(pairwise_distances(x[rows], x), indicator)
+        a = sums[index, own] / np.maximum(counts[own] - 1, 1)
+        means = sums / counts
+        means[index, own] = np.inf
+        b = means.min(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            s = (b - a) / np.maximum(a, b)
+        s[counts[own] == 1] = 0
+        scores[rows] = np.nan_to_num(s)
+    return scores
+
+
+class ClusterDiagnostics(object):
+
+    def __init__(self, groups, names, counts, centroids, distances, silhouette=None):
+        """
+        :param np.array groups: Sorted group labels
+        :param list[str] names: Name of each group
+        :param np.array counts: Number of samples in each group
+        :param np.array centroids: groups x dimensions centroids
+        :param np.array distances: groups x groups distances between centroids
+        :param np.array silhouette: Mean silhouette of each group's samples, if computed
+        """
+        self.groups = np.asarray(groups)
+        self.names = list(names)
+        self.counts = np.asarray(counts)
+        self.centroids = np.asarray(centroids)
+        self.distances = np.asarray(distances)
+        self.silhouette = silhouette
+        self.group_index = {x: i for i, x in enumerate(self.groups.tolist())}
+
+    @classmethod
+    def from_embedding(cls, x, label, names=None, silhouette=False):
+        """
+        :param np.array x: samples x dimensions embedding
+        :param np.array label: Group label of each sample
+        :param list[str] names: Name of each label, indexed by label. Defaults to the labels themselves
+        :param bool silhouette: Also compute the mean silhouette of each group
+        :rtype: ClusterDiagnostics
+        """
+        x = np.asarray(x, dtype=np.float64)
+        groups, inverse, indicator = _indicator(label)
+        counts = indicator.sum(axis=0)
+        centroids = np.dot(indicator.T, x) / counts[:, np.newaxis]
+        scores = None
+        if silhouette:
+            scores = np.dot(silhouette_samples(x, label), indicator) / counts
+        names = [str(x) for x in groups] if names is None else [names[x] for x in groups]
+        return cls(groups, names, counts, centroids, pairwise_distances(centroids, centroids), scores)
+
+    def distance(self, a, b):
+        """
+        :param a: Group label
+        :param b: Group label
+        :return: Distance between the groups' centroids, or None if either group is empty
+        :rtype: float
+        """
+        if a not in self.group_index or b not in self.group_index:
+            return None
+        return self.distances[self.group_index[a], self.group_index[b]]
+
+    def pairs(self):
+        """
+        :return: (name, name, distance) of every pair of groups, in label order
+        :rtype: list(tuple(str, str, float))
+        """
+        k = len(self.groups)
+        return [(self.names[i], self.names[j], self.distances[i, j]) for i in xrange(k) for j in xrange(i + 1, k)]
+
+    @classmethod
+    def load(cls, path):
+        """
+        :param str path: Path to diagnostics written by `save`
+        :rtype: ClusterDiagnostics
+        """
+        with np.load(path) as npz:
+            silhouette = npz['silhouette'] if 'silhouette' in npz.files else None
+            return cls(npz['groups'], npz['names'].tolist(), npz['counts'], npz['centroids'], npz['distances'],
+                       silhouette)
+
+    def save(self, path):
+        """
+        Atomically writes the diagnostics to an .npz
+
+        :param str path: Output path, ending in .npz
+        """
+        arrays = dict(groups=self.groups, names=np.array(self.names), counts=self.counts, centroids=self.centroids,
+                      distances=self.distances)
+        if self.silhouette is not None:
+            arrays['silhouette'] = self.silhouette
+        tmp_path = path[:-len('.npz')] + '.tmp.npz'
+        np.savez(tmp_path, **arrays)
+        os.rename(tmp_path, path)
+
+
+def load_diagnostics(path, x, label, names=None, silhouette=False, source=None):
+    """
+    Returns the diagnostics saved at a path, computing and saving them if they're missing, lack silhouettes, or
+    are older than the embedding's file
+
+    :param str path: Path to diagnostics .npz, next to the embedding
+    :param np.array x: samples x dimensions embedding
+    :param np.array label: Group label of each sample
+    :param list[str] names: Name of each label, indexed by label
+    :param bool silhouette: Also compute the mean silhouette of each group
+    :param str source: Path to the file the embedding was loaded from
+    :rtype: ClusterDiagnostics
+    """
+    if os.path.exists(path) and not (source and os.path.getmtime(source) > os.path.getmtime(path)):
+        diagnostics = ClusterDiagnostics.load(path)
+        if diagnostics.silhouette is not None or not silhouette:
+            return diagnostics
+    diagnostics = ClusterDiagnostics.from_embedding(x, label, names=names, silhouette=silhouette)
+    diagnostics.save(path)
+    return diagnostics
@@ -0,0 +1,140 @@
+"""
+Binary count-matrix store
+
+A store is a directory holding a genes x samples matrix of integer counts (counts.npy, column-major
+so every sample is one contiguous block) and the gene / sample indexes (genes.txt, samples.txt).
+The matrix is memory-mapped, so selecting a handful of samples only touches those columns on disk.
+
+`write_matrix` slices a set of samples into a single binary file R can load with readBin: two int32
+dimensions, the int32 counts in column-major order (R's own layout), then the gene and sample names
+as NUL-terminated strings.
+"""
+import logging
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger(__name__)
+
+
+def write_count_store(df_path, store_dir):
+    """
+    Converts a genes x samples TSV into a count store. Counts are rounded, as DESeq2 does before fitting.
+    The store is written to a temporary directory that is renamed once complete, so callers can treat an
+    existing store directory as finished.
+
+    :param str df_path: Path to genes x samples dataframe
+    :param str store_dir: Directory to write the store to
+    :return: Path to store
+    :rtype: str
+    """
+    log.info('Writing count store: ' + store_dir)
+    df = pd.read_csv(df_path, sep='\t', index_col=0)
+    tmp_dir = os.path.normpath(store_dir) + '.tmp'
+    if os.path.isdir(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    counts = np.asfortranarray(np.round(df.values).astype(np.int32))
+    np.save(os.path.join(tmp_dir, 'counts.npy'), counts)
+    for name, index in [('genes.txt', df.index), ('samples.txt', df.columns)]:
+        with open(os.path.join(tmp_dir, name), 'w') as f:
+            f.write('\n'.join(index) + '\n')
+    os.rename(tmp_dir, store_dir)
+    return store_dir
+
+
+class CountStore(object):
+    """
+    Read-only view of a count store
+
+    store = CountStore(path)
+    df = store.subset(['GTEX-1117F-0226-SM-5GZZ7', 'TCGA-BH-A0B3-11'])
+    """
+
+    def __init__(self, store_dir):
+        """
+        :param str store_dir: Path to store directory created by `write_count_store`
+        """
+        self.store_dir = store_dir
+        self.genes = [x.strip() for x in open(os.path.join(store_dir, 'genes.txt'), 'r') if x.strip()]
+        self.samples = [x.strip() for x in open(os.path.join(store_dir, 'samples.txt'), 'r') if x.strip()]
+        self.sample_index = {x: i for i, x in enumerate(self.samples)}
+        self._counts = None
+
+    @property
+    def counts(self):
+        """Memory-mapped genes x samples count matrix"""
+        if self._counts is None:
+            self._counts = np.load(os.path.join(self.store_dir, 'counts.npy'), mmap_mode='r')
+        return self._counts
+
+    @property
+    def shape(self):
+        return len(self.genes), len(self.samples)
+
+    def columns(self, samples):
+        """
+        Returns column positions for samples. R-style names (TCGA.XX.XXXX.01) are accepted as well.
+
+        :param list[str] samples: Sample names
+        :return: Column positions in the order given
+        :rtype: np.array
+        """
+        try:
+            return np.array([self.sample_index[x] if x in self.sample_index else self.sample_index[x.replace('.', '-')]
+                             for x in samples], dtype=np.int64)
+        except KeyError as e:
+            raise KeyError('Sample not found in count store {}: {}'.format(self.store_dir, e.args[0]))
+
+    def subset_array(self, samples):
+        """
+        Reads counts for the given samples only
+
+        :param list[str] samples: Sample names
+        :return: genes x samples count matrix in the order given
+        :rtype: np.array
+        """
+        cols = self.columns(samples)
+        # Reading columns in storage order keeps the reads sequential; restore the requested order after
+        order = np.argsort(cols)
+        out = np.empty((len(self.genes), len(cols)), dtype=self.counts.dtype, order='F')
+        out[:, order] = self.counts[:, cols[order]]
+        return out
+
+    def subset(self, samples):
+        """
+        Reads counts for the given samples as a dataframe
+
+        :param list[str] samples: Sample names
+        :return: genes x samples dataframe in the order given
+        :rtype: pd.DataFrame
+        """
+        return pd.DataFrame(self.subset_array(samples), index=self.genes, columns=list(samples))
+
+    def write_matrix(self, samples, path):
+        """
+        Atomically writes counts for the given samples in the binary format read by the DESeq2 workers
+
+        :param list[str] samples: Sample names, written as given so they match the job's vector
+        :param str path: Output path
+        :return: Path to matrix
+        :rtype: str
+        """
+        counts = self.subset_array(samples)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.array(counts.shape, dtype='<i4').tofile(f)
+            counts.astype('<i4').ravel(order='F').tofile(f)
+            f.write(''.join(x + '\0' for x in list(self.genes) + list(samples)).encode('utf-8'))
+        os.rename(tmp_path, path)
+        return path
+
+    def to_frame(self):
+        """
+        :return: Full genes x samples dataframe
+        :rtype: pd.DataFrame
+        """
+        return pd.DataFrame(np.asarray(self.counts), index=self.genes, columns=self.samples)
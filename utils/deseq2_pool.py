@@ -0,0 +1,294 @@
+"""
+Pool of long-lived R processes for running DESeq2 scripts
+
+Each worker loads DESeq2 once, then evaluates the experiment's generated script for every job it
+receives over stdin. The script's call to commandArgs() is answered with the job arguments and its
+call to read.table() for the tissue matrix is served from a per-worker cache, so neither R startup
+nor re-parsing the combined dataframe is paid per vector.
+
+A job can also come with a pre-subset count matrix (see `CountStore.write_matrix`), in which case
+read.table() for the tissue matrix returns only the vector's columns, read with readBin. Vectors kept
+in a manifest have no file of their own: a read of a vector path that does not exist returns the
+columns of the job's matrix, which are the vector's samples in order.
+"""
+import logging
+import os
+import subprocess
+import textwrap
+import threading
+import time
+from collections import namedtuple, defaultdict
+
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import write_script
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger(__name__)
+
+# Prefix of the status lines the worker writes, so stray output from a script can't be mistaken for one
+STATUS_TAG = '@@deseq2-worker@@'
+
+# peak_mb is the worker's peak resident memory during the job (VmHWM), including its cached dataframe, the
+# DESeq2 / Rcpp native allocations and R itself. Without /proc it is R's peak heap as reported by gc().
+# key is the key the job was given to map, if any
+JobResult = namedtuple('JobResult', ['script_path', 'args', 'worker', 'status', 'elapsed', 'peak_mb', 'message', 'key'])
+JobResult.__new__.__defaults__ = (None,)
+
+
+class DESeq2WorkerPool(object):
+    """
+    Runs (script_path, args) jobs, the same blobs `run_deseq2` takes, on a pool of persistent R workers
+
+    Jobs are sorted by their arguments before dispatch so consecutive jobs on a worker share the same
+    tissue dataframe and it is parsed once per worker rather than once per vector.
+
+    with DESeq2WorkerPool(cores=4, directory=experiment_dir) as pool:
+        results = pool.map(blob)
+    """
+
+    def __init__(self, cores, directory):
+        """
+        :param int cores: Number of R workers to run
+        :param str directory: Directory where the worker script will be written
+        """
+        self.cores = int(cores)
+        self.directory = directory
+        self.worker_script = None
+        self.workers = []
+        self.timings = defaultdict(list)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def start(self):
+        """Launches R workers"""
+        self.worker_script = write_script(worker_script, self.directory, name='deseq2-worker.R')
+        log.info('Starting {} R workers'.format(self.cores))
+        self.workers = [self._launch() for _ in xrange(self.cores)]
+
+    def _launch(self):
+        """Starts one R worker process"""
+        return subprocess.Popen(['Rscript', self.worker_script], stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE, universal_newlines=True)
+
+    def close(self):
+        """Shuts down R workers and logs how long each worker's jobs took"""
+        for worker in self.workers:
+            worker.stdin.close()
+            worker.wait()
+        self.workers = []
+        self.report()
+
+    def report(self):
+        """Logs the number of jobs and mean / max runtime for each worker"""
+        for worker_id in sorted(self.timings):
+            times = self.timings[worker_id]
+            log.info('Worker {}: {} jobs, mean {:.1f}s, max {:.1f}s, total {:.1f}s'.format(
+                worker_id, len(times), np.mean(times), max(times), sum(times)))
+
+    def map(self, blob, on_start=None, on_finish=None, ordered=False, prepare=None):
+        """
+        Runs every job in blob and returns when all have finished
+
+        :param iterable(tuple) blob: Script path and arguments for each job, optionally followed by a key that
+                                     identifies the job in callbacks and is set on its JobResult
+        :param function on_start: Called with the job's tuple, e.g. (script_path, args), as it is sent to a worker
+        :param function on_finish: Called with the JobResult of each job as it finishes
+        :param bool ordered: Dispatch jobs in the order given instead of grouping them by arguments
+        :param function prepare: Called with the job's tuple before it is submitted. May return the path
+                                 to a pre-subset count matrix to serve the job's read of its tissue matrix
+        :return: One result per job
+        :rtype: list[JobResult]
+        """
+        jobs = iter(list(blob) if ordered else sorted(blob, key=lambda x: list(x[1])))
+        lock = threading.Lock()
+        with ThreadPoolExecutor(max_workers=len(self.workers)) as executor:
+            futures = [executor.submit(self._drain, i, jobs, lock, on_start, on_finish, prepare)
+                       for i in xrange(len(self.workers))]
+            results = [result for future in futures for result in future.result()]
+        failed = [x for x in results if x.status != 'OK']
+        if failed:
+            log.error('{} of {} DESeq2 jobs failed'.format(len(failed), len(results)))
+        return results
+
+    def _drain(self, worker_id, jobs, lock, on_start=None, on_finish=None, prepare=None):
+        """Feeds jobs to one worker until the shared job iterator is exhausted"""
+        results = []
+        while True:
+            with lock:
+                job = next(jobs, None)
+            if job is None:
+                return results
+            if on_start:
+                on_start(*job)
+            # Every started job reaches on_finish, so whatever on_start reserved is always released
+            result = None
+            try:
+                result = self._run(worker_id, job, prepare)
+            finally:
+                if result is None:
+                    result = JobResult(job[0], list(job[1]), worker_id, 'ERR', 0.0, None, 'Job was interrupted')
+                if len(job) > 2:
+                    result = result._replace(key=job[2])
+                results.append(result)
+                if on_finish:
+                    on_finish(result)
+
+    def _run(self, worker_id, job, prepare=None):
+        """Prepares and submits one job, returning an ERR result if either fails"""
+        try:
+            counts = prepare(*job) if prepare else None
+        except Exception as e:
+            log.error('Could not prepare job {}: {}'.format(' '.join(job[1]), e))
+            return JobResult(job[0], list(job[1]), worker_id, 'ERR', 0.0, None, 'Could not prepare job: {}'.format(e))
+        try:
+            return self.submit(worker_id, job[0], job[1], counts=counts)
+        except RuntimeError as e:
+            # The R process died (e.g. killed for memory), record the failure and replace it
+            log.error(str(e))
+            self._restart(worker_id)
+            return JobResult(job[0], list(job[1]), worker_id, 'ERR', 0.0, None, str(e))
+
+    def _restart(self, worker_id):
+        """Replaces a worker whose R process has exited"""
+        self.workers[worker_id].wait()
+        self.workers[worker_id] = self._launch()
+
+    def submit(self, worker_id, script_path, args, counts=None):
+        """
+        Runs a single job on a given worker and blocks until it has finished
+
+        :param int worker_id: Index of the worker
+        :param str script_path: Path to the R script
+        :param list[str] args: Arguments for the script, as they would be passed to Rscript
+        :param str counts: Path to a pre-subset count matrix, returned for the script's read of its tissue matrix
+        :return: Result of the job
+        :rtype: JobResult
+        """
+        worker = self.workers[worker_id]
+        args = list(args)
+        log.debug('Worker {}: {}'.format(worker_id, args))
+        start = time.time()
+        try:
+            worker.stdin.write('\t'.join([script_path, counts or ''] + args) + '\n')
+            worker.stdin.flush()
+        except IOError:
+            raise RuntimeError('R worker {} is no longer running, could not submit: {}'.format(worker_id, args))
+        while True:
+            line = worker.stdout.readline()
+            if not line:
+                raise RuntimeError('R worker {} exited unexpectedly while running: {}'.format(worker_id, args))
+            if line.startswith(STATUS_TAG):
+                break
+        fields = line.rstrip('\n').split('\t')
+        status, elapsed, peak_mb, message = fields[1], float(fields[2]), float(fields[3]), '\t'.join(fields[4:])
+        self.timings[worker_id].append(elapsed)
+        if status == 'OK':
+            log.info('Worker {} finished {} in {:.1f}s, peak {:.0f}MB'.format(worker_id, os.path.basename(args[-1]),
+                                                                               elapsed, peak_mb))
+        else:
+            log.error('Worker {} failed on {}: {}'.format(worker_id, args, message))
+        log.debug('Round trip: {:.1f}s'.format(time.time() - start))
+        return JobResult(script_path, args, worker_id, status, elapsed, peak_mb, message)
+
+
+def run_deseq2_pool(blob, cores, directory):
+    """
+    Runs DESeq2 jobs on a pool of persistent R workers. Replacement for mapping `run_deseq2`
+
+    :param iterable(tuple(str, list[str])) blob: Script path and arguments for each job
+    :param int cores: Number of R workers
+    :param str directory: Directory where the worker script will be written
+    :return: One result per job
+    :rtype: list[JobResult]
+    """
+    with DESeq2WorkerPool(cores=cores, directory=directory) as pool:
+        return pool.map(blob)
+
+
+def worker_script():
+    return textwrap.dedent("""
+        suppressMessages(library('DESeq2'))
+        suppressMessages(library('data.table'))
+
+        # Holds the most recently read dataframe. Jobs arrive sorted by dataframe,
+        # so this is re-read only when the worker moves on to a new tissue
+        matrix_cache <- new.env()
+        cached_read_table <- function(file, ...) {{
+            # Vectors are read without row.names; only dataframes are cached
+            if (is.null(list(...)$row.names)) return(utils::read.table(file, ...))
+            key <- normalizePath(file)
+            if (!exists(key, envir=matrix_cache, inherits=FALSE)) {{
+                rm(list=ls(matrix_cache), envir=matrix_cache)
+                gc()
+                assign(key, utils::read.table(file, ...), envir=matrix_cache)
+            }}
+            get(key, envir=matrix_cache)
+        }}
+
+        # Reads a matrix written by CountStore.write_matrix as a dataframe, like read.table would
+        read_counts <- function(path) {{
+            con <- file(path, 'rb')
+            on.exit(close(con))
+            dims <- readBin(con, 'integer', 2, size=4, endian='little')
+            counts <- readBin(con, 'integer', dims[1] * dims[2], size=4, endian='little')
+            labels <- readBin(con, 'character', dims[1] + dims[2])
+            as.data.frame(matrix(counts, nrow=dims[1], ncol=dims[2],
+                                 dimnames=list(labels[1:dims[1]], labels[-(1:dims[1])])))
+        }}
+
+        # Peak resident memory in MB from VmHWM, which writing 5 to clear_refs resets to the current resident
+        # memory. If the reset isn't permitted VmHWM is the worker's lifetime peak, which only overestimates
+        proc_status <- '/proc/self/status'
+        reset_peak <- function() {{
+            invisible(gc(reset=TRUE))
+            if (file.exists(proc_status)) try(cat('5', file='/proc/self/clear_refs'), silent=TRUE)
+        }}
+        peak_mb <- function() {{
+            if (file.exists(proc_status)) {{
+                hwm <- grep('^VmHWM:', readLines(proc_status), value=TRUE)
+                if (length(hwm) == 1) return(as.numeric(gsub('[^0-9]', '', hwm)) * 1024 / 1e6)
+            }}
+            # Peak R heap since the reset, in Mb: the column following 'max used'
+            usage <- gc()
+            sum(usage[, which(colnames(usage) == 'max used') + 1])
+        }}
+
+        con <- file('stdin', open='r')
+        while (length(line <- readLines(con, n=1)) > 0) {{
+            fields <- strsplit(line, '\\t', fixed=TRUE)[[1]]
+            counts_path <- fields[2]
+            job_args <- fields[-(1:2)]
+            job_env <- new.env()
+            job_env$commandArgs <- function(trailingOnly=FALSE) job_args
+            job_env$read.table <- cached_read_table
+            if (nzchar(counts_path)) {{
+                # The job's matrix was pre-subset to its vector
+                job_counts <- read_counts(counts_path)
+                job_env$read.table <- function(file, ...) {{
+                    if (!is.null(list(...)$row.names)) return(job_counts)
+                    if (!file.exists(file)) return(data.frame(V1=colnames(job_counts), stringsAsFactors=FALSE))
+                    utils::read.table(file, ...)
+                }}
+            }}
+
+            reset_peak()
+            start <- proc.time()[['elapsed']]
+            status <- tryCatch({{
+                sys.source(fields[1], envir=job_env)
+                c('OK', '')
+            }}, error=function(e) c('ERR', gsub('[\\t\\n]', ' ', conditionMessage(e))))
+            elapsed <- proc.time()[['elapsed']] - start
+
+            cat('{tag}', status[1], elapsed, peak_mb(), status[2], sep='\\t')
+            cat('\\n')
+            flush(stdout())
+            rm(job_env)
+        }}
+        """.format(tag=STATUS_TAG))
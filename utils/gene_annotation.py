@@ -0,0 +1,168 @@
+"""
+Gene ID / gene name annotation shared by all experiments
+
+The gene map is held as sorted arrays, so mapping a whole index of gene IDs to names (or back) is a
+vectorized binary search rather than one dictionary lookup per gene. IDs that don't match exactly are
+retried without their Ensembl version (ENSG00000141510.16 -> ENSG00000141510), so results from a different
+GENCODE release still get names. Genes that can't be mapped keep their ID (or name).
+
+The pickled metadata/gene_map.pickle is converted once to an .npz of two string arrays next to it, which
+loads faster and can't execute code. Annotations are kept in memory for the life of the process.
+
+annotation = load_gene_annotation(os.path.join(root_dir, 'metadata/gene_map.pickle'))
+names = annotation.map_ids(df.index)
+"""
+import logging
+import os
+import pickle
+
+import numpy as np
+
+from utils.gtf_index import load_gtf_index
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger(__name__)
+
+# Annotations already loaded by this process, keyed by .npz path
+_annotations = {}
+
+
+def strip_version(ids):
+    """
+    :param list[str] ids: Ensembl IDs
+    :return: IDs without their version suffix
+    :rtype: np.array
+    """
+    ids = np.asarray(ids, dtype=str)
+    return np.char.partition(ids, '.')[:, 0] if len(ids) else ids
+
+
+def _lookup(keys, values, query):
+    """
+    :param np.array keys: Sorted keys
+    :param np.array values: Value of each key
+    :param np.array query: Keys to look up
+    :return: Value of each query key (meaningless where not found), and a mask of which were found
+    :rtype: tuple(np.array, np.array)
+    """
+    if not len(keys):
+        return query, np.zeros(len(query), dtype=bool)
+    pos = np.minimum(np.searchsorted(keys, query), len(keys) - 1)
+    return values[pos], keys[pos] == query
+
+
+class GeneAnnotation(object):
+
+    def __init__(self, ids, names):
+        """
+        :param list[str] ids: Gene IDs
+        :param list[str] names: Gene name of each ID
+        """
+        ids, names = np.asarray(ids, dtype=str), np.asarray(names, dtype=str)
+        order = np.argsort(ids, kind='mergesort')
+        self.ids, self.names = ids[order], names[order]
+        # Stable sorts keep the first of duplicate keys first, which searchsorted finds
+        stripped = strip_version(self.ids)
+        order = np.argsort(stripped, kind='mergesort')
+        self._stripped_ids, self._stripped_names = stripped[order], self.names[order]
+        order = np.argsort(self.names, kind='mergesort')
+        self._sorted_names, self._name_ids = self.names[order], self.ids[order]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def map_ids(self, ids):
+        """
+        :param list[str] ids: Gene IDs, with or without versions
+        :return: Gene name of each ID, or the ID itself if it isn't annotated
+        :rtype: np.array
+        """
+        query = np.asarray(ids, dtype=str)
+        if not len(query):
+            return np.array([], dtype=self.names.dtype)
+        names, found = _lookup(self.ids, self.names, query)
+        out = np.where(found, names, query)
+        missing = np.flatnonzero(~found)
+        if len(missing):
+            names, found = _lookup(self._stripped_ids, self._stripped_names, strip_version(query[missing]))
+            out[missing[found]] = names[found]
+        return out
+
+    def map_names(self, names):
+        """
+        :param list[str] names: Gene names
+        :return: Gene ID of each name, or the name itself if it isn't annotated. Names shared by several
+                 genes map to the first ID in sorted order.
+        :rtype: np.array
+        """
+        query = np.asarray(names, dtype=str)
+        if not len(query):
+            return np.array([], dtype=self.ids.dtype)
+        ids, found = _lookup(self._sorted_names, self._name_ids, query)
+        return np.where(found, ids, query)
+
+    @classmethod
+    def from_pickle(cls, path):
+        """
+        :param str path: Path to a pickled dictionary that maps gene ID to gene name
+        :rtype: GeneAnnotation
+        """
+        with open(path, 'rb') as f:
+            gene_map = pickle.load(f)
+        return cls(list(gene_map.keys()), list(gene_map.values()))
+
+    @classmethod
+    def from_gtf(cls, gtf_path):
+        """
+        :param str gtf_path: Path to GTF
+        :rtype: GeneAnnotation
+        """
+        index = load_gtf_index(gtf_path)
+        return cls(index['gene_id'], index['gene_name'])
+
+    @classmethod
+    def load(cls, path):
+        """
+        :param str path: Path to an annotation written by `save`
+        :rtype: GeneAnnotation
+        """
+        with np.load(path) as npz:
+            return cls(npz['ids'], npz['names'])
+
+    def save(self, path):
+        """
+        Atomically writes the annotation to an .npz
+
+        :param str path: Output path, ending in .npz
+        """
+        tmp_path = path[:-len('.npz')] + '.tmp.npz'
+        np.savez(tmp_path, ids=self.ids, names=self.names)
+        os.rename(tmp_path, path)
+
+
+def load_gene_annotation(gene_map_path, gtf_path=None):
+    """
+    Returns the annotation for a gene map, converting a pickled map to an .npz the first time it's used
+
+    :param str gene_map_path: Path to gene map, either gene_map.pickle or its converted .npz
+    :param str gtf_path: GTF to build the annotation from if there is no gene map
+    :return: Gene annotation
+    :rtype: GeneAnnotation
+    """
+    npz_path = os.path.splitext(gene_map_path)[0] + '.npz'
+    if npz_path not in _annotations:
+        pickled = gene_map_path != npz_path and os.path.exists(gene_map_path)
+        if os.path.exists(npz_path) and not (pickled and os.path.getmtime(gene_map_path) > os.path.getmtime(npz_path)):
+            annotation = GeneAnnotation.load(npz_path)
+        elif pickled:
+            log.info('Converting gene map to ' + npz_path)
+            annotation = GeneAnnotation.from_pickle(gene_map_path)
+            annotation.save(npz_path)
+        elif gtf_path and os.path.exists(gtf_path):
+            log.info('No gene map found, building one from ' + gtf_path)
+            annotation = GeneAnnotation.from_gtf(gtf_path)
+            annotation.save(npz_path)
+        else:
+            raise IOError('Gene map not found: ' + gene_map_path)
+        _annotations[npz_path] = annotation
+    return _annotations[npz_path]
@@ -0,0 +1,139 @@
+"""
+Cached gene-level index of a GTF annotation
+
+The GTF is parsed once into array-backed columns (gene_id, gene_name, gene_type, seqname, start, end, strand)
+and saved as an .npz next to the GTF. The cache name is derived from the GTF's path, size and mtime, so an
+edited or replaced annotation is re-parsed automatically. Indexes are also kept in memory for the life of the process.
+
+index = load_gtf_index('gencode.v23.annotation.gtf')
+pc_genes = index.protein_coding_genes()
+"""
+import hashlib
+import logging
+import os
+
+import numpy as np
+
+from utils.gtf_parser import iter_gtf
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger(__name__)
+
+COLUMNS = ['gene_id', 'gene_name', 'gene_type', 'seqname', 'start', 'end', 'strand']
+
+# Indexes already loaded by this process, keyed by cache path
+_indexes = {}
+
+
+class GTFIndex(object):
+
+    def __init__(self, columns):
+        """
+        :param dict(str, np.array) columns: One array per entry in COLUMNS, all of the same length
+        """
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.columns['gene_id'])
+
+    def __getitem__(self, column):
+        return self.columns[column]
+
+    @classmethod
+    def parse(cls, gtf_path):
+        """
+        Parses the gene records of a GTF
+
+        :param str gtf_path: Path to GTF
+        :return: Index of every gene in the GTF
+        :rtype: GTFIndex
+        """
+        log.info('Parsing GTF: ' + gtf_path)
+        values = {x: [] for x in COLUMNS}
+        for record in iter_gtf(gtf_path, features=['gene']):
+            for attr in COLUMNS:
+                values[attr].append(getattr(record, attr, ''))
+        columns = {x: np.array(values[x]) for x in COLUMNS}
+        columns['start'] = columns['start'].astype(np.int64)
+        columns['end'] = columns['end'].astype(np.int64)
+        return cls(columns)
+
+    @classmethod
+    def load(cls, path):
+        """
+        :param str path: Path to a cache written by `save`
+        :rtype: GTFIndex
+        """
+        with np.load(path) as npz:
+            return cls({x: npz[x] for x in COLUMNS})
+
+    def save(self, path):
+        """
+        Atomically writes the index to an .npz
+
+        :param str path: Output path, ending in .npz
+        """
+        tmp_path = path[:-len('.npz')] + '.tmp.npz'
+        np.savez(tmp_path, **self.columns)
+        os.rename(tmp_path, path)
+
+    def protein_coding_genes(self):
+        """
+        :return: Gene IDs of protein-coding genes
+        :rtype: list[str]
+        """
+        return self.columns['gene_id'][self.columns['gene_type'] == 'protein_coding'].tolist()
+
+    def gene_positions(self, gene_type=None):
+        """
+        :param str gene_type: If provided, only return genes of this type, e.g. protein_coding
+        :return: Gene ID mapped to (seqname, start, end, strand)
+        :rtype: dict(str, tuple(str, int, int, str))
+        """
+        c = self.columns
+        mask = np.ones(len(self), dtype=bool) if gene_type is None else c['gene_type'] == gene_type
+        columns = [c[x][mask].tolist() for x in ['gene_id', 'seqname', 'start', 'end', 'strand']]
+        return {gene: (seqname, start, end, strand) for gene, seqname, start, end, strand in zip(*columns)}
+
+    def gene_map(self):
+        """
+        :return: Gene ID mapped to gene name
+        :rtype: dict(str, str)
+        """
+        return dict(zip(self.columns['gene_id'].tolist(), self.columns['gene_name'].tolist()))
+
+
+def cache_path(gtf_path, cache_dir=None):
+    """
+    Returns the cache location for a GTF, which changes whenever the GTF's path, size or mtime change
+
+    :param str gtf_path: Path to GTF
+    :param str cache_dir: Directory for the cache. Defaults to the GTF's directory
+    :return: Path to cache
+    :rtype: str
+    """
+    gtf_path = os.path.abspath(gtf_path)
+    stat = os.stat(gtf_path)
+    key = hashlib.md5('{}:{}:{}'.format(gtf_path, stat.st_size, stat.st_mtime).encode('utf-8')).hexdigest()[:12]
+    cache_dir = cache_dir or os.path.dirname(gtf_path)
+    return os.path.join(cache_dir, '.{}.{}.npz'.format(os.path.basename(gtf_path), key))
+
+
+def load_gtf_index(gtf_path, cache_dir=None):
+    """
+    Returns the gene index for a GTF, parsing the GTF only if no valid cache exists
+
+    :param str gtf_path: Path to GTF
+    :param str cache_dir: Directory for the cache. Defaults to the GTF's directory
+    :return: Gene index
+    :rtype: GTFIndex
+    """
+    path = cache_path(gtf_path, cache_dir)
+    if path not in _indexes:
+        if os.path.exists(path):
+            _indexes[path] = GTFIndex.load(path)
+        else:
+            index = GTFIndex.parse(gtf_path)
+            index.save(path)
+            _indexes[path] = index
+    return _indexes[path]
@@ -1,4 +1,17 @@
+def _column(index, func):
+    """Read-only property for one of the nine GTF columns"""
+    return property(lambda self: func(self._fields[index]))
+
+
 class GTFRecord(object):
+    """
+    A single GTF record
+
+    The nine columns are kept as a tuple of strings and converted on access. The attribute column is only
+    split into key / value pairs the first time one of its attributes (gene_id, gene_type, ...) is accessed.
+    """
+    __slots__ = ('_fields', '_attributes')
+
     def __init__(self, line):
         """
         Converts a GTF record into an python object
@@ -6,22 +19,43 @@ class GTFRecord(object):
         :param line str|list: GTF record
         """
         if isinstance(line, str):
-            line = line.strip().split('\t')
+            line = line.rstrip('\n').split('\t')
         if len(line) != 9:
-            msg = '\n'.join(self.attributes)
+            msg = '\n'.join(x for x, _ in self.attributes)
             raise ValueError('GTF file format has changed. Must have these attributes: {}'.format(msg))
-        for (attr, func), value in zip(self.attributes, line):
-            setattr(self, attr, func(value))
-        for feature in self.attribute.split(';'):
-            try:
-                attr, value = feature.split()
-                setattr(self, attr, value.replace('"', ''))
-            except ValueError:
-                pass
+        self._fields = tuple(line)
+        self._attributes = None
 
     attributes = [('seqname', str), ('source', str), ('feature', str), ('start', int), ('end', int),
                   ('score', str), ('strand', str), ('frame', str), ('attribute', str)]
 
+    seqname = _column(0, str)
+    source = _column(1, str)
+    feature = _column(2, str)
+    start = _column(3, int)
+    end = _column(4, int)
+    score = _column(5, str)
+    strand = _column(6, str)
+    frame = _column(7, str)
+    attribute = _column(8, str)
+
+    def __getattr__(self, name):
+        # Only called for names that aren't columns, i.e. entries of the attribute column
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if self._attributes is None:
+            self._attributes = {}
+            for feature in self._fields[8].split(';'):
+                try:
+                    attr, value = feature.split()
+                    self._attributes[attr] = value.replace('"', '')
+                except ValueError:
+                    pass
+        try:
+            return self._attributes[name]
+        except KeyError:
+            raise AttributeError(name)
+
     def __repr__(self):
         if self.feature == 'gene':
             return 'GTF({}, gene:{}, start:{}, length:{})'.format(self.seqname, self.gene_name,
@@ -75,4 +109,25 @@ class GTFRecord(object):
             else:
                 return False
         except AttributeError:
-            return False
\ No newline at end of file
+            return False
+
+
+def iter_gtf(gtf_path, features=None):
+    """
+    Streams records from a GTF
+
+    Comments and records whose feature isn't requested are skipped before a record is created.
+
+    :param str gtf_path: Path to GTF
+    :param list[str] features: Features to return, e.g. ['gene']. Defaults to all features
+    :return: GTF records
+    :rtype: generator(GTFRecord)
+    """
+    features = set(features) if features else None
+    with open(gtf_path, 'r') as f:
+        for line in f:
+            if line.startswith('#'):
+                continue
+            fields = line.rstrip('\n').split('\t')
+            if features is None or fields[2] in features:
+                yield GTFRecord(fields)
@@ -0,0 +1,131 @@
+"""
+Cached log-normalized expression matrices
+
+A tissue's genes x samples dataframe is parsed once and saved as a samples x genes float32 matrix of
+log(x + 1), named after the tissue and the MD5 of the dataframe: the matrix in an .npy, which is memory-mapped
+when loaded, and the sample and gene indexes in an .npz. A changed dataframe hashes to a new cache, and caches
+for older versions of it are removed. Rows are samples, so selecting a subset of samples reads contiguous rows,
+and a tissue's matrix can be read a block of samples at a time (see utils.pca) without loading all of it.
+Files derived from a matrix, like its PCA scores (see utils.tsne), are named after its cache and removed with it.
+
+matrix = load_log_matrix(df_path, cache_dir)
+x = matrix.subset([s for s in matrix.samples if 'TCGA-' in s])
+"""
+import glob
+import hashlib
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger(__name__)
+
+
+def file_md5(path, block_size=1 << 20):
+    """
+    :param str path: Path to file
+    :param int block_size: Bytes read at a time
+    :return: MD5 hex digest of the file's contents
+    :rtype: str
+    """
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+class LogMatrix(object):
+
+    def __init__(self, values, samples, genes):
+        """
+        :param np.array values: samples x genes float32 matrix of log(x + 1)
+        :param list[str] samples: Sample of each row
+        :param list[str] genes: Gene of each column
+        """
+        self.path = None
+        self.values = values
+        self.samples = list(samples)
+        self.genes = list(genes)
+        self.sample_index = {x: i for i, x in enumerate(self.samples)}
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    @classmethod
+    def from_dataframe(cls, df_path):
+        """
+        :param str df_path: Path to genes x samples dataframe of counts
+        :rtype: LogMatrix
+        """
+        df = pd.read_csv(df_path, sep='\t', index_col=0)
+        return cls(np.log1p(df.values.T).astype(np.float32), df.columns, df.index)
+
+    @classmethod
+    def load(cls, path):
+        """
+        :param str path: Path to a matrix written by `save`
+        :rtype: LogMatrix
+        """
+        with np.load(path) as npz:
+            samples, genes = npz['samples'].tolist(), npz['genes'].tolist()
+        matrix = cls(np.load(path[:-len('.npz')] + '.npy', mmap_mode='r'), samples, genes)
+        matrix.path = path
+        return matrix
+
+    def save(self, path):
+        """
+        Atomically writes the matrix to an .npy and its indexes to an .npz. The .npz is written last, so a cache
+        is only complete once it exists.
+
+        :param str path: Output path of the indexes, ending in .npz
+        """
+        base = path[:-len('.npz')]
+        np.save(base + '.tmp.npy', self.values)
+        os.rename(base + '.tmp.npy', base + '.npy')
+        np.savez(base + '.tmp.npz', samples=np.array(self.samples), genes=np.array(self.genes))
+        os.rename(base + '.tmp.npz', path)
+        self.path = path
+
+    def rows(self, samples):
+        """
+        :param list[str] samples: Samples, in the order wanted
+        :return: Row positions of the samples
+        :rtype: np.array
+        """
+        return np.array([self.sample_index[x] for x in samples], dtype=np.int64)
+
+    def subset(self, samples):
+        """
+        :param list[str] samples: Samples, in the order wanted
+        :return: In-memory samples x genes matrix of the given samples
+        :rtype: np.array
+        """
+        return self.values[self.rows(samples)]
+
+
+def load_log_matrix(df_path, cache_dir, name=None):
+    """
+    Returns the log-normalized matrix of a dataframe, parsing the dataframe only if it has no cache
+
+    :param str df_path: Path to genes x samples dataframe of counts
+    :param str cache_dir: Directory for caches
+    :param str name: Name of the cache, e.g. the tissue. Defaults to the dataframe's directory name
+    :return: Log-normalized matrix
+    :rtype: LogMatrix
+    """
+    name = name or os.path.basename(os.path.dirname(os.path.abspath(df_path)))
+    path = os.path.join(cache_dir, '{}.{}.npz'.format(name, file_md5(df_path)[:12]))
+    if os.path.exists(path) and os.path.exists(path[:-len('.npz')] + '.npy'):
+        return LogMatrix.load(path)
+    log.info('Caching log-normalized matrix: ' + path)
+    matrix = LogMatrix.from_dataframe(df_path)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    for stale in glob.glob(os.path.join(cache_dir, name + '.*.np[yz]')):
+        os.remove(stale)
+    matrix.save(path)
+    return matrix
@@ -0,0 +1,119 @@
+"""
+Single-file manifest of an experiment's vectors
+
+Pairwise vectors are a tissue's reference group plus one query sample, so rather than a file per vector the
+manifest stores each reference group once and one (job_id, tissue, reference, query) row per vector, as a
+single JSON file. Jobs are built from the manifest, and their vectors are handed to the DESeq2 workers and
+the nbinom engine from it, so no per-vector files are written or listed.
+
+manifest = VectorManifest(os.path.join(experiment_dir, 'manifest.json'))
+manifest.add_reference('Breast', gtex_samples)
+manifest.add_vector('Breast/TCGA.A1.A0SB.01', 'Breast', 'Breast', 'TCGA.A1.A0SB.01')
+manifest.save()
+"""
+import json
+import os
+from collections import namedtuple
+
+# reference is the ID of a reference group; the vector is the group's samples followed by the query sample
+Vector = namedtuple('Vector', ['job_id', 'tissue', 'reference', 'query'])
+
+
+class ManifestVector(object):
+    """
+    Samples of one vector, looked up in the manifest when iterated. Jobs hold these rather than lists
+    so that a manifest of many vectors over large reference groups isn't expanded in memory.
+    """
+    __slots__ = ('manifest', 'job_id')
+
+    def __init__(self, manifest, job_id):
+        self.manifest = manifest
+        self.job_id = job_id
+
+    def __iter__(self):
+        return iter(self.manifest.samples(self.job_id))
+
+    def __len__(self):
+        vector = self.manifest.vectors[self.manifest.index[self.job_id]]
+        return len(self.manifest.references[vector.reference]) + 1
+
+
+class VectorManifest(object):
+
+    def __init__(self, path):
+        """
+        :param str path: Path to manifest. Loaded if it exists
+        """
+        self.path = path
+        self.references = {}
+        self.vectors = []
+        self.index = {}
+        if os.path.exists(path):
+            manifest = json.load(open(path, 'r'))
+            self.references = manifest['references']
+            for row in manifest['vectors']:
+                self.add_vector(*row)
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def __iter__(self):
+        return iter(self.vectors)
+
+    def __contains__(self, job_id):
+        return job_id in self.index
+
+    def add_reference(self, reference, samples):
+        """
+        :param str reference: Reference group ID
+        :param list[str] samples: Samples of the group
+        """
+        self.references[reference] = list(samples)
+
+    def add_vector(self, job_id, tissue, reference, query):
+        """
+        Adds a vector, replacing any vector with the same job ID
+
+        :param str job_id: Job ID
+        :param str tissue: Tissue
+        :param str reference: Reference group ID, added with `add_reference`
+        :param str query: Query sample
+        """
+        vector = Vector(job_id, tissue, reference, query)
+        if job_id in self.index:
+            self.vectors[self.index[job_id]] = vector
+        else:
+            self.index[job_id] = len(self.vectors)
+            self.vectors.append(vector)
+
+    def tissue(self, tissue):
+        """
+        :param str tissue: Tissue
+        :return: Vectors of the tissue
+        :rtype: list[Vector]
+        """
+        return [x for x in self.vectors if x.tissue == tissue]
+
+    def vector(self, job_id):
+        """
+        :param str job_id: Job ID
+        :return: The job's vector, read from the manifest when it is used
+        :rtype: ManifestVector
+        """
+        return ManifestVector(self, job_id)
+
+    def samples(self, job_id):
+        """
+        :param str job_id: Job ID
+        :return: Samples of the job's vector, reference group first and the query sample last
+        :rtype: list[str]
+        """
+        vector = self.vectors[self.index[job_id]]
+        return self.references[vector.reference] + [vector.query]
+
+    def save(self):
+        """Atomically writes the manifest"""
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'references': self.references, 'vectors': [list(x) for x in self.vectors]}, f)
+        os.rename(tmp_path, self.path)
@@ -0,0 +1,82 @@
+"""
+Vectorized masking of matched tumor results
+
+For every patient with both a tumor (.01) and a normal (.11) result in a tissue's result store, genes
+significant in the normal result are masked out of the tumor result. The mask is a genes x patients boolean
+matrix built from the normal padj columns in one pass, and applying it sets the masked genes of every tumor
+column to NaN, i.e. missing from the result, as if they had been dropped from the table.
+
+Patients are processed in blocks on a thread pool, since the work is mostly reading memory-mapped columns,
+and the masked blocks are appended to the masked store in order by the calling thread.
+"""
+import logging
+from collections import Counter
+
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.result_store import COLUMNS
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger(__name__)
+
+
+def matched_patients(samples):
+    """
+    :param list[str] samples: Sample names in R-style (TCGA.XX.XXXX.01)
+    :return: Barcodes of patients with exactly one tumor (.01) and one normal (.11) result
+    :rtype: list[str]
+    """
+    # Trim last 3 characters to get TCGA barcode without the tumor / normal tag
+    counts = Counter(x[:-3] for x in samples)
+    names = set(samples)
+    return sorted(x for x, count in counts.items() if count == 2 and x + '.01' in names and x + '.11' in names)
+
+
+def mask_block(store, patients, cutoff=0.001):
+    """
+    Masks the tumor results of a block of patients
+
+    :param ResultStore store: Result store holding the tumor and normal results
+    :param list[str] patients: Patient barcodes
+    :param float cutoff: padj cutoff for a gene to be masked
+    :return: genes x patients mask, and the masked genes x patients array of each DESeq2 column
+    :rtype: tuple(np.array, dict(str, np.array))
+    """
+    normal = store.columns([x + '.11' for x in patients])
+    tumor = store.columns([x + '.01' for x in patients])
+    with np.errstate(invalid='ignore'):
+        mask = store.array('padj')[:, normal] < cutoff
+    values = {}
+    for column in COLUMNS:
+        values[column] = np.asfortranarray(store.array(column)[:, tumor])
+        values[column][mask] = np.nan
+    return mask, values
+
+
+def mask_matched(store, masked_store, cutoff=0.001, cores=1, block_size=64):
+    """
+    Writes the masked tumor result of every matched patient to a result store
+
+    :param ResultStore store: Result store holding the tumor and normal results
+    :param ResultStore masked_store: Result store the masked tumor results are written to
+    :param float cutoff: padj cutoff for a gene to be masked
+    :param int cores: Number of threads
+    :param int block_size: Number of patients per block
+    :return: Patient barcodes, and the genes x patients mask over the store's genes
+    :rtype: tuple(list[str], np.array)
+    """
+    patients = matched_patients(store.samples)
+    mask = np.zeros((len(store.genes), len(patients)), dtype=bool)
+    if not patients:
+        return patients, mask
+    blocks = [patients[i:i + block_size] for i in xrange(0, len(patients), block_size)]
+    log.info('Masking {} matched patients in {} blocks'.format(len(patients), len(blocks)))
+    start = 0
+    with ThreadPoolExecutor(max_workers=int(cores)) as executor:
+        for block, (block_mask, values) in zip(blocks, executor.map(lambda x: mask_block(store, x, cutoff), blocks)):
+            masked_store.extend([x + '.01' for x in block], values, genes=store.genes,
+                                modes=[store.mode(x + '.01') for x in block])
+            mask[:, start:start + len(block)] = block_mask
+            start += len(block)
+    return patients, mask
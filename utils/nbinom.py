@@ -0,0 +1,509 @@
+"""
+Negative-binomial GLM differential expression in NumPy / SciPy
+
+A Python version of the DESeq2 steps the experiments run in R, vectorized across genes:
+median-of-ratios size factors, gene-wise dispersions from the Cox-Reid adjusted likelihood, a parametric
+dispersion trend, shrinkage of the gene-wise dispersions towards the trend, and a Wald test of the
+condition coefficient with Benjamini-Hochberg adjustment. Results are written as DESeq2 writes them:
+baseMean, log2FoldChange, lfcSE, stat, pvalue and padj, ordered by padj.
+
+Coefficients are bounded at +/-30 on the log2 scale, as DESeq2 bounds them, so a gene with counts in only one
+condition gets a large but finite fold change. As in DESeq2's results(), genes with a Cook's distance above the
+99% quantile of F(p, m - p) in a sample of a design cell with 3 or more replicates get NA pvalue and padj,
+unless 3 or more samples have higher counts than the outlying one.
+
+It differs from DESeq2 in that dispersions are maximized over a grid of log-dispersions instead of by line
+search, outliers are only filtered and never replaced by trimmed means and refit (DESeq2 replaces them in cells
+of 7 or more), and there is no independent filtering, so padj is adjusted over every gene with counts that
+isn't an outlier. `concordance` compares a table from this engine with the DESeq2 table for the same vector.
+
+counts = store.subset_array(samples)
+X, levels = design_matrix(['N', 'N', 'N', 'T'])
+res = nbinom_wald(counts, X)
+"""
+import logging
+import os
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from scipy.special import gammaln, polygamma
+from scipy.stats import f as f_dist
+from scipy.stats import norm
+
+from utils.count_store import CountStore
+from utils.scheduler import job_vector
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger(__name__)
+
+MIN_DISP = 1e-8
+MIN_MU = 0.5
+# Bound on coefficients (natural log scale), DESeq2's +/-30 on the log2 scale
+MAX_BETA = 30 * np.log(2)
+# Minimum robust dispersion used for Cook's distances, as in DESeq2
+MIN_COOKS_DISP = 0.04
+COLUMNS = ['baseMean', 'log2FoldChange', 'lfcSE', 'stat', 'pvalue', 'padj']
+
+
+def size_factors(counts):
+    """
+    Median-of-ratios size factors, as DESeq2's estimateSizeFactors
+
+    :param np.array counts: genes x samples counts
+    :return: One size factor per sample
+    :rtype: np.array
+    """
+    with np.errstate(divide='ignore'):
+        log_counts = np.log(counts)
+    log_geo_means = log_counts.mean(axis=1)
+    usable = np.isfinite(log_geo_means)
+    if not usable.any():
+        raise ValueError('Every gene has a zero count in at least one sample, size factors are undefined')
+    return np.exp(np.median(log_counts[usable] - log_geo_means[usable, None], axis=0))
+
+
+def design_matrix(condition, covariates=None):
+    """
+    Builds the model matrix of `~ covariates + condition`, with levels ordered as R orders factor levels
+
+    :param list[str] condition: Condition of each sample, with exactly two levels
+    :param list[list[str]] covariates: Other factors of the design, e.g. patient, one label per sample each
+    :return: samples x coefficients matrix, whose last column is the condition coefficient, and the condition levels
+    :rtype: tuple(np.array, list[str])
+    """
+    columns = [np.ones(len(condition))]
+    for factor in (covariates or []) + [condition]:
+        levels = sorted(set(factor))
+        columns += [np.array([x == level for x in factor], dtype=float) for level in levels[1:]]
+    levels = sorted(set(condition))
+    if len(levels) != 2:
+        raise ValueError('Condition must have two levels, found: {}'.format(levels))
+    return np.column_stack(columns), levels
+
+
+def _gene_chunks(n_genes, n_coefs):
+    """Slices of genes small enough that per-gene coefficient matrices stay around 32MB"""
+    size = max(1, int(4e6 / n_coefs ** 2))
+    return [slice(i, i + size) for i in xrange(0, n_genes, size)]
+
+
+def _nb_loglik(y, mu, alpha):
+    """Negative-binomial log-likelihood of each gene, alpha is one dispersion per gene"""
+    r = 1 / alpha[:, None]
+    return (gammaln(y + r) - gammaln(r) - gammaln(y + 1) + r * np.log(r / (r + mu)) +
+            y * np.log(mu / (r + mu))).sum(axis=1)
+
+
+def _xtwx(w, X):
+    """genes x coefficients x coefficients matrices X' W X, for genes x samples weights"""
+    # A batched matmul, which unlike a three-operand einsum is handed to BLAS
+    return np.matmul(X.T[None] * w[:, None, :], X)
+
+
+def fit_glm(counts, sf, X, alpha, max_iter=100, tol=1e-8):
+    """
+    Fits a negative-binomial GLM with log link to every gene by iteratively reweighted least squares
+
+    :param np.array counts: genes x samples counts
+    :param np.array sf: Size factors
+    :param np.array X: samples x coefficients model matrix
+    :param np.array alpha: Dispersion of each gene
+    :param int max_iter: Maximum number of iterations
+    :param float tol: Convergence tolerance on the relative change in deviance
+    :return: Coefficients (natural log scale), their standard errors, and fitted means
+    :rtype: tuple(np.array, np.array, np.array)
+    """
+    n_genes, n_coefs = counts.shape[0], X.shape[1]
+    beta, se = np.zeros((n_genes, n_coefs)), np.zeros((n_genes, n_coefs))
+    mu = np.zeros(counts.shape)
+    ridge = 1e-6 * np.eye(n_coefs)
+    offset = np.log(sf)
+    # Start from least squares on log normalized counts
+    start = np.clip(np.linalg.lstsq(X, np.log(counts / sf + 0.1).T, rcond=None)[0].T, -MAX_BETA, MAX_BETA)
+    for chunk in _gene_chunks(n_genes, n_coefs):
+        y, a, b = counts[chunk], alpha[chunk], start[chunk]
+        dev = np.full(len(y), np.inf)
+        active = np.ones(len(y), dtype=bool)
+        for _ in xrange(max_iter):
+            m = np.maximum(np.exp(b[active].dot(X.T) + offset), MIN_MU)
+            w = m / (1 + a[active, None] * m)
+            z = np.log(m) - offset + (y[active] - m) / m
+            b[active] = np.clip(np.linalg.solve(_xtwx(w, X) + ridge, (w * z).dot(X)[..., None])[..., 0],
+                                -MAX_BETA, MAX_BETA)
+            m = np.maximum(np.exp(b[active].dot(X.T) + offset), MIN_MU)
+            new_dev = -2 * _nb_loglik(y[active], m, a[active])
+            converged = np.abs(new_dev - dev[active]) / (np.abs(new_dev) + 0.1) < tol
+            dev[active] = new_dev
+            active[np.flatnonzero(active)[converged]] = False
+            if not active.any():
+                break
+        m = np.maximum(np.exp(b.dot(X.T) + offset), MIN_MU)
+        w = m / (1 + a[:, None] * m)
+        cov = np.linalg.inv(_xtwx(w, X) + ridge)
+        beta[chunk], mu[chunk] = b, m
+        se[chunk] = np.sqrt(np.maximum(np.diagonal(cov, axis1=1, axis2=2), 0))
+    return beta, se, mu
+
+
+def _cr_loglik(counts, mu, X, alpha):
+    """Cox-Reid adjusted log-likelihood of each gene at the given dispersions, with the means held fixed"""
+    out = np.empty(len(counts))
+    for chunk in _gene_chunks(len(counts), X.shape[1]):
+        w = mu[chunk] / (1 + alpha[chunk, None] * mu[chunk])
+        logdet = np.linalg.slogdet(_xtwx(w, X))[1]
+        out[chunk] = _nb_loglik(counts[chunk], mu[chunk], alpha[chunk]) - 0.5 * logdet
+    return out
+
+
+def _grid_max(objective, low, high, n_genes, points=30, rounds=3):
+    """
+    Maximizes objective(log_alpha) per gene over a grid of log-dispersions, then refines twice around the best
+
+    :param function objective: Maps a log-dispersion per gene to an objective value per gene
+    :return: Log-dispersion of each gene
+    :rtype: np.array
+    """
+    low, high = np.full(n_genes, low), np.full(n_genes, high)
+    for _ in xrange(rounds):
+        grid = np.linspace(0, 1, points)[None, :] * (high - low)[:, None] + low[:, None]
+        values = np.column_stack([objective(grid[:, k]) for k in xrange(points)])
+        best = np.argmax(np.where(np.isfinite(values), values, -np.inf), axis=1)
+        step = (high - low) / (points - 1)
+        center = grid[np.arange(n_genes), best]
+        low, high = center - step, center + step
+    return center
+
+
+def fit_dispersion_trend(base_mean, disp):
+    """
+    Fits DESeq2's parametric trend, dispersion = asymptDisp + extraPois / mean, as a gamma-family GLM with
+    identity link, refitting without genes far from the trend until the coefficients converge
+
+    :param np.array base_mean: Mean of normalized counts of each gene
+    :param np.array disp: Gene-wise dispersion of each gene
+    :return: Function from mean to trended dispersion
+    :rtype: function
+    """
+    use = disp >= MIN_DISP * 100
+    x, d = 1 / base_mean[use], disp[use]
+    coefs = np.array([0.1, 1.0])
+    for _ in xrange(10):
+        ratio = d / (coefs[0] + coefs[1] * x)
+        good = (ratio > 1e-4) & (ratio < 15)
+        A = np.column_stack([np.ones(good.sum()), x[good]])
+        new = coefs.copy()
+        # Gamma GLM with identity link: least squares weighted by 1 / fitted^2
+        try:
+            for _ in xrange(25):
+                fit = np.maximum(A.dot(new), 1e-12)
+                w = 1 / fit ** 2
+                new = np.linalg.solve(A.T.dot(A * w[:, None]), A.T.dot(w * d[good]))
+        except np.linalg.LinAlgError:
+            # Too few genes near the trend to fit both coefficients
+            new = None
+        if new is None or np.any(new <= 0):
+            log.warning('Parametric dispersion trend failed to fit, using the mean dispersion')
+            mean_disp = d[(d > 1e-4) & (d < 15)].mean() if use.any() else MIN_DISP * 100
+            return lambda mean: np.full(np.shape(mean), mean_disp)
+        converged = np.sum(np.log(new / coefs) ** 2) < 1e-6
+        coefs = new
+        if converged:
+            break
+    return lambda mean: coefs[0] + coefs[1] / mean
+
+
+def estimate_dispersions(counts, sf, X):
+    """
+    Gene-wise, trended and final (maximum a posteriori) dispersions, following DESeq2's estimateDispersions
+
+    :param np.array counts: genes x samples counts, without genes that are zero in every sample
+    :param np.array sf: Size factors
+    :param np.array X: samples x coefficients model matrix
+    :return: Final dispersion of each gene
+    :rtype: np.array
+    """
+    n_samples, n_coefs = X.shape
+    max_disp = max(10.0, n_samples)
+    normed = counts / sf
+    base_mean = normed.mean(axis=1)
+
+    # Rough estimate from a linear model of normalized counts, used to fit the means
+    hat = X.dot(np.linalg.pinv(X))
+    mu_lin = np.maximum(normed.dot(hat.T), 1)
+    rough = (((normed - mu_lin) ** 2 - mu_lin) / mu_lin ** 2).sum(axis=1) / max(n_samples - n_coefs, 1)
+    moments = (normed.var(axis=1, ddof=1) - np.mean(1 / sf) * base_mean) / base_mean ** 2
+    start = np.clip(np.minimum(rough, moments), MIN_DISP, max_disp)
+    mu = fit_glm(counts, sf, X, start)[2]
+
+    lo, hi = np.log(MIN_DISP), np.log(max_disp)
+    gene_disp = np.exp(_grid_max(lambda la: _cr_loglik(counts, mu, X, np.exp(la)), lo, hi, len(counts)))
+    trend = fit_dispersion_trend(base_mean, gene_disp)
+    fitted = trend(base_mean)
+
+    use = gene_disp >= MIN_DISP * 100
+    residuals = np.log(gene_disp[use]) - np.log(fitted[use])
+    var_log_disp = (1.4826 * np.median(np.abs(residuals - np.median(residuals)))) ** 2
+    prior_var = max(var_log_disp - polygamma(1, max(n_samples - n_coefs, 1) / 2.0), 0.25)
+
+    log_fit = np.log(fitted)
+    posterior = lambda la: _cr_loglik(counts, mu, X, np.exp(la)) - (la - log_fit) ** 2 / (2 * prior_var)
+    map_disp = np.exp(_grid_max(posterior, lo, hi, len(counts)))
+    # Genes far above the trend keep their own estimate, as in DESeq2
+    outliers = np.log(gene_disp) > log_fit + 2 * np.sqrt(var_log_disp)
+    map_disp[outliers] = gene_disp[outliers]
+    return np.clip(map_disp, MIN_DISP, max_disp)
+
+
+def bh_adjust(pvals):
+    """
+    Benjamini-Hochberg adjusted p-values, leaving NaN where the p-value is NaN
+
+    :param np.array pvals: p-values
+    :rtype: np.array
+    """
+    out = np.full(len(pvals), np.nan)
+    tested = np.flatnonzero(~np.isnan(pvals))
+    order = tested[np.argsort(pvals[tested])[::-1]]
+    ranks = np.arange(len(order), 0, -1)
+    out[order] = np.minimum(1, np.minimum.accumulate(pvals[order] * len(order) / ranks))
+    return out
+
+
+def _trimmed_mean(values, trim):
+    """Row means with floor(n * trim) values dropped from each end, as R's mean(x, trim=trim)"""
+    n = values.shape[1]
+    drop = int(np.floor(n * trim))
+    return np.sort(values, axis=1)[:, drop:n - drop].mean(axis=1)
+
+
+def _trim(n):
+    """Trim ratio and variance scale DESeq2 uses for a cell of n samples"""
+    if n < 3.5:
+        return 1 / 3.0, 2.04
+    if n < 23.5:
+        return 1 / 4.0, 1.86
+    return 1 / 8.0, 1.51
+
+
+def _replicated(X, n=3):
+    """Mask of samples whose row of the model matrix, i.e. design cell, occurs at least n times"""
+    rows = [tuple(x) for x in X]
+    sizes = Counter(rows)
+    return np.array([sizes[x] >= n for x in rows])
+
+
+def robust_dispersions(counts, sf, X):
+    """
+    Dispersions from trimmed within-cell variances, DESeq2's robustMethodOfMomentsDisp, used for Cook's distances
+
+    :param np.array counts: genes x samples counts
+    :param np.array sf: Size factors
+    :param np.array X: samples x coefficients model matrix
+    :return: Dispersion of each gene
+    :rtype: np.array
+    """
+    normed = counts / sf
+    cells = [tuple(x) for x in X]
+    replicated = [x for x in sorted(set(cells)) if cells.count(x) >= 3]
+    if replicated:
+        variances = []
+        for cell in replicated:
+            values = normed[:, [i for i, x in enumerate(cells) if x == cell]]
+            trim, scale = _trim(values.shape[1])
+            sq_error = (values - _trimmed_mean(values, trim)[:, None]) ** 2
+            variances.append(scale * _trimmed_mean(sq_error, trim))
+        v = np.max(variances, axis=0)
+    else:
+        sq_error = (normed - _trimmed_mean(normed, 1 / 8.0)[:, None]) ** 2
+        v = 1.51 * _trimmed_mean(sq_error, 1 / 8.0)
+    m = normed.mean(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.maximum(np.nan_to_num((v - m) / m ** 2), MIN_COOKS_DISP)
+
+
+def cooks_distances(counts, mu, sf, X, alpha):
+    """
+    Cook's distance of every count, DESeq2's calculateCooksDistance
+
+    :param np.array counts: genes x samples counts
+    :param np.array mu: Fitted means
+    :param np.array sf: Size factors
+    :param np.array X: samples x coefficients model matrix
+    :param np.array alpha: Dispersion of each gene used in the fit
+    :return: genes x samples Cook's distances
+    :rtype: np.array
+    """
+    p = X.shape[1]
+    robust = robust_dispersions(counts, sf, X)
+    pearson_sq = (counts - mu) ** 2 / (mu + robust[:, None] * mu ** 2)
+    hat = np.empty(mu.shape)
+    ridge = 1e-6 * np.eye(p)
+    for chunk in _gene_chunks(len(counts), p):
+        w = mu[chunk] / (1 + alpha[chunk, None] * mu[chunk])
+        cov = np.linalg.inv(_xtwx(w, X) + ridge)
+        hat[chunk] = np.minimum(w * (np.matmul(X, cov) * X).sum(axis=-1), 1 - 1e-8)
+    return pearson_sq / p * hat / (1 - hat) ** 2
+
+
+def cooks_outliers(counts, cooks, X, quantile=0.99):
+    """
+    Genes whose p-values DESeq2's results() would set to NA for an outlying count
+
+    :param np.array counts: genes x samples counts
+    :param np.array cooks: genes x samples Cook's distances
+    :param np.array X: samples x coefficients model matrix
+    :param float quantile: Quantile of F(p, m - p) used as the cutoff
+    :return: Mask of outlier genes
+    :rtype: np.array
+    """
+    m, p = X.shape
+    replicated = _replicated(X)
+    if not replicated.any() or m <= p:
+        return np.zeros(len(counts), dtype=bool)
+    outliers = cooks[:, replicated].max(axis=1) > f_dist.ppf(quantile, p, m - p)
+    # Genes where 3 or more samples have higher counts than the outlying one are kept
+    rows = np.flatnonzero(outliers)
+    outlier_counts = counts[rows, cooks[rows].argmax(axis=1)]
+    outliers[rows[(counts[rows] > outlier_counts[:, None]).sum(axis=1) >= 3]] = False
+    return outliers
+
+
+def nbinom_wald(counts, X, genes=None, sf=None, disp=None):
+    """
+    Tests the last coefficient of the design for every gene
+
+    :param np.array counts: genes x samples counts
+    :param np.array X: samples x coefficients model matrix from `design_matrix`
+    :param list[str] genes: Gene IDs, used as the index of the table
+    :param np.array sf: Size factors, if already computed for these counts
+    :param np.array disp: Dispersion of each gene, if already estimated for these counts
+    :return: DESeq2-style results table ordered by padj
+    :rtype: pd.DataFrame
+    """
+    counts = np.round(np.asarray(counts, dtype=float))
+    sf = size_factors(counts) if sf is None else sf
+    base_mean = (counts / sf).mean(axis=1)
+    nonzero = base_mean > 0
+
+    res = pd.DataFrame(np.nan, index=genes if genes is not None else np.arange(len(counts)), columns=COLUMNS)
+    res['baseMean'] = base_mean
+    disp = estimate_dispersions(counts[nonzero], sf, X) if disp is None else disp[nonzero]
+    beta, se, mu = fit_glm(counts[nonzero], sf, X, disp)
+    stat = beta[:, -1] / se[:, -1]
+    pvalue = 2 * norm.sf(np.abs(stat))
+    pvalue[cooks_outliers(counts[nonzero], cooks_distances(counts[nonzero], mu, sf, X, disp), X)] = np.nan
+    res.loc[nonzero, 'log2FoldChange'] = beta[:, -1] / np.log(2)
+    res.loc[nonzero, 'lfcSE'] = se[:, -1] / np.log(2)
+    res.loc[nonzero, 'stat'] = stat
+    res.loc[nonzero, 'pvalue'] = pvalue
+    res['padj'] = bh_adjust(res['pvalue'].values)
+    return res.sort_values('padj', kind='mergesort')
+
+
+def read_counts(samples, store=None, df_path=None):
+    """
+    Reads the counts of a vector from a count store, or from the tissue dataframe if there is no store
+
+    :param list[str] samples: Samples in R-style names, as listed in vectors
+    :param str store: Path to count store
+    :param str df_path: Path to genes x samples dataframe
+    :return: genes x samples counts, columns in the order given
+    :rtype: pd.DataFrame
+    """
+    if store and os.path.isdir(store):
+        return CountStore(store).subset(samples)
+    df = pd.read_csv(df_path, sep='\t', index_col=0)
+    df.columns = [x.replace('-', '.') for x in df.columns]
+    return df[samples]
+
+
+def run_vector(samples, condition, output, store=None, df_path=None, covariates=None):
+    """
+    Runs the engine on one vector and atomically writes the results table
+
+    :param list[str] samples: Samples of the vector
+    :param list[str] condition: Condition of each sample
+    :param str output: Path to results table
+    :param str store: Path to count store
+    :param str df_path: Path to genes x samples dataframe, used if there is no store
+    :param list[list[str]] covariates: Other factors of the design
+    :return: Path to results table
+    :rtype: str
+    """
+    counts = read_counts(samples, store=store, df_path=df_path)
+    X, _ = design_matrix(condition, covariates=covariates)
+    res = nbinom_wald(counts.values, X, genes=counts.index)
+    tmp_path = output + '.tmp'
+    res.to_csv(tmp_path, sep='\t', na_rep='NA')
+    os.rename(tmp_path, output)
+    return output
+
+
+def run_job(job, condition, output=None):
+    """
+    Runs one DESeq2 scheduler job with the engine
+
+    :param Job job: Job
+    :param list[str] condition: Condition of each sample of the job's vector
+    :param str output: Path to results table. Defaults to the job's output
+    :return: Path to results table
+    :rtype: str
+    """
+    return run_vector(job_vector(job), condition, output or job.output, store=job.store,
+                      df_path=job.matrix or job.args[0])
+
+
+def run_nbinom_jobs(jobs, conditions, cores):
+    """
+    Runs DESeq2 jobs with the NumPy engine instead of R. Jobs whose output exists are skipped.
+
+    :param list[Job] jobs: Jobs, as passed to the DESeq2 scheduler
+    :param dict(str, list[str]) conditions: Condition of each sample of each job's vector, keyed by job ID
+    :param int cores: Number of processes
+    :return: Jobs that did not finish
+    :rtype: list[Job]
+    """
+    todo = [x for x in jobs if not os.path.exists(x.output)]
+    log.info('{} of {} jobs left to run with the nbinom engine'.format(len(todo), len(jobs)))
+    failed = []
+    with ProcessPoolExecutor(max_workers=int(cores)) as executor:
+        # Vectors are resolved here so that manifest-backed jobs don't each pickle the whole manifest
+        futures = {executor.submit(run_job, job._replace(vector=job_vector(job)), conditions[job.job_id]): job
+                   for job in todo}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                log.error('nbinom engine failed on {}: {}'.format(futures[future].job_id, e))
+                failed.append(futures[future])
+    if failed:
+        log.error('{} of {} jobs failed'.format(len(failed), len(todo)))
+    return failed
+
+
+def concordance(deseq2_path, nbinom_path, alpha=0.05, labels=('deseq2', 'nbinom')):
+    """
+    Compares the results of the NumPy engine with DESeq2's results for the same vector
+
+    :param str deseq2_path: Path to DESeq2 results table
+    :param str nbinom_path: Path to results table from this engine
+    :param float alpha: padj cutoff for calling a gene significant
+    :param tuple(str, str) labels: Names of the two tables in the keys of their significant gene counts
+    :return: Number of genes compared, correlations of log2FoldChange (Pearson) and pvalue (Spearman),
+             significant genes called by each, and the Jaccard index of the significant sets
+    :rtype: dict
+    """
+    a = pd.read_csv(deseq2_path, sep='\t', index_col=0)
+    b = pd.read_csv(nbinom_path, sep='\t', index_col=0).reindex(a.index)
+    both = a['pvalue'].notnull() & b['pvalue'].notnull()
+    sig_a = set(a.index[a['padj'] < alpha])
+    sig_b = set(b.index[b['padj'] < alpha])
+    union = sig_a | sig_b
+    return {'genes': int(both.sum()),
+            'log2fc_pearson': a.loc[both, 'log2FoldChange'].corr(b.loc[both, 'log2FoldChange']),
+            'pvalue_spearman': a.loc[both, 'pvalue'].corr(b.loc[both, 'pvalue'], method='spearman'),
+            'significant_' + labels[0]: len(sig_a),
+            'significant_' + labels[1]: len(sig_b),
+            'jaccard': len(sig_a & sig_b) / float(len(union)) if union else 1.0}
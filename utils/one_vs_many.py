@@ -0,0 +1,166 @@
+"""
+Shared-reference ("one-vs-many") DESeq2
+
+Pairwise experiments compare a large reference cohort (all GTEx samples, or all TCGA normals of a tissue)
+against one query sample at a time, so every per-vector DESeq2 run re-estimates nearly the same size factors
+and dispersions. With a single query sample in its own group the query contributes no residual degrees of
+freedom, so the dispersions are effectively those of the reference cohort alone.
+
+This mode fits the reference cohort once per tissue (size factors, gene-wise dispersions and trend) and then
+runs only the Wald test for each query sample, with the query's size factor taken against the reference
+geometric means. Each query gets a results table at the same path as its per-vector run, with a .mode file
+naming this mode, which the result store keeps with the result.
+
+That is an approximation of the per-vector run: Cook's outlier replacement and refitting are skipped, the
+dispersions are those of the reference alone, and the query's size factor is computed on its own rather than
+jointly with the reference. `AbstractExperiment.check_shared_reference` reruns a few queries per-vector and
+compares the two.
+
+A tissue only gets a job while some of its queries have no result, and the job's ID names those queries, so
+queries added to the manifest later, or left over from a failed run, get a new job rather than one the
+journal already has as done.
+"""
+import hashlib
+import os
+import textwrap
+
+from utils.result_store import MODE_SUFFIX, result_store_dir
+from utils.scheduler import Job
+
+# Mode recorded for results of a shared-reference fit
+SHARED_REFERENCE = 'shared-reference'
+
+
+def write_reference(tissue_dir, reference, queries):
+    """
+    Writes the sample lists a shared-reference job reads in a tissue's directory
+
+    :param str tissue_dir: Experiment directory of the tissue
+    :param list[str] reference: Reference samples, in R-style names
+    :param list[str] queries: Query samples, in R-style names
+    :return: Paths to the reference list and to the list of every sample the job reads
+    :rtype: tuple(str, str)
+    """
+    reference_path = os.path.join(tissue_dir, 'reference')
+    samples_path = os.path.join(tissue_dir, 'reference-samples')
+    for path, samples in [(reference_path, reference), (samples_path, reference + queries)]:
+        with open(path, 'w') as f:
+            f.write('\n'.join(samples))
+    return reference_path, samples_path
+
+
+def pending_queries(results_dir, queries):
+    """
+    :param str results_dir: Directory the tissue's result tables are written to
+    :param list[str] queries: Query samples, in R-style names
+    :return: Queries with neither a result table nor a result in the tissue's result store
+    :rtype: list[str]
+    """
+    stored = set()
+    stored_path = os.path.join(result_store_dir(results_dir), 'samples.txt')
+    if os.path.exists(stored_path):
+        with open(stored_path, 'r') as f:
+            stored = set(x.strip() for x in f)
+    return [x for x in queries if x not in stored and not os.path.exists(os.path.join(results_dir, x))]
+
+
+def shared_reference_jobs(script_path, protein_coding_paths, experiment_dir, manifest):
+    """
+    Creates one job per tissue with queries left to run, writing its sample lists with `write_reference`
+
+    :param str script_path: Path to the script from `one_vs_many_script`
+    :param list[str] protein_coding_paths: Protein-coding dataframe of each tissue
+    :param str experiment_dir: Experiment directory holding a directory per tissue
+    :param VectorManifest manifest: Vectors of the experiment, with the tissue as their reference group
+    :return: Jobs
+    :rtype: list[Job]
+    """
+    jobs = []
+    for df in protein_coding_paths:
+        tissue = os.path.basename(os.path.dirname(df))
+        tissue_dir = os.path.join(experiment_dir, tissue)
+        queries = pending_queries(os.path.join(tissue_dir, 'results'), [x.query for x in manifest.tissue(tissue)])
+        if queries:
+            reference_path, samples_path = write_reference(tissue_dir, manifest.references[tissue], queries)
+            digest = hashlib.md5('\n'.join(queries).encode('utf-8')).hexdigest()[:12]
+            jobs.append(Job(job_id='{}/{}'.format(tissue, digest), script_path=script_path,
+                            args=[df, reference_path, samples_path],
+                            output=None, vector=samples_path,
+                            store=os.path.join(os.path.dirname(df), 'counts-protein-coding')))
+    return jobs
+
+
+def one_vs_many_script(reference_level, query_level='T'):
+    """
+    :param str reference_level: Condition label of the reference cohort, as used by the per-vector script
+    :param str query_level: Condition label of the query sample
+    :return: R script that tests every query sample of a tissue against its reference cohort
+    :rtype: str
+    """
+    return textwrap.dedent("""
+        suppressMessages(library('DESeq2'))
+
+        # Argument parsing
+        args <- commandArgs(trailingOnly = TRUE)
+        df_path <- args[1]
+        reference_path <- args[2]
+        samples_path <- args[3]
+        results_dir <- paste(dirname(reference_path), 'results', sep='/')
+
+        # Every sample that isn't in the reference is a query; those with results, as tables or already moved
+        # into the tissue's result store, are done already
+        reference <- as.character(read.table(reference_path)$V1)
+        queries <- setdiff(as.character(read.table(samples_path)$V1), reference)
+        queries <- queries[!file.exists(file.path(results_dir, queries))]
+        stored_path <- paste0(results_dir, '-store/samples.txt')
+        if (file.exists(stored_path)) queries <- setdiff(queries, readLines(stored_path))
+
+        run_queries <- function(queries) {{
+            n <- read.table(df_path, sep='\\t', header=1, row.names=1)
+            ref_counts <- as.matrix(round(n[, reference]))
+
+            # Fit the reference cohort once: size factors, dispersions and the dispersion trend
+            ref <- DESeqDataSetFromMatrix(countData=ref_counts,
+                                          colData=data.frame(disease=rep('{ref}', length(reference)),
+                                                             row.names=reference),
+                                          design=~ 1)
+            ref <- estimateSizeFactors(ref)
+            ref <- estimateDispersions(ref)
+            ref_sf <- sizeFactors(ref)
+            ref_disp <- dispersions(ref)
+            trend <- dispersionFunction(ref)
+            log_geo_means <- rowMeans(log(ref_counts))
+            disease_vector <- factor(c(rep('{ref}', length(reference)), '{query}'), levels=c('{ref}', '{query}'))
+
+            for (sample_name in queries) {{
+                query <- round(n[, sample_name])
+                countData <- cbind(ref_counts, query)
+                colnames(countData) <- c(reference, sample_name)
+                colData <- data.frame(disease=disease_vector, row.names=colnames(countData))
+                y <- DESeqDataSetFromMatrix(countData = countData, colData = colData, design = ~ disease)
+
+                # Median-of-ratios against the reference geometric means, as estimateSizeFactors does
+                usable <- is.finite(log_geo_means) & query > 0
+                sizeFactors(y) <- c(ref_sf, exp(median((log(query) - log_geo_means)[usable])))
+
+                # Genes without reference counts have no reference dispersion; use the trend at their mean
+                disp <- ref_disp
+                missing <- is.na(disp)
+                disp[missing] <- trend(pmax(rowMeans(counts(y, normalized=TRUE))[missing], 1e-8))
+                dispersions(y) <- disp
+
+                y <- nbinomWaldTest(y, quiet=TRUE)
+                res <- results(y)
+
+                # Write out table
+                resOrdered <- res[order(res$padj),]
+                res_path <- paste(results_dir, sample_name, sep='/')
+                write.table(as.data.frame(resOrdered), file=paste0(res_path, '.tmp'), col.names=NA, sep='\\t',
+                            quote=FALSE)
+                writeLines('{mode}', paste0(res_path, '{suffix}'))
+                file.rename(paste0(res_path, '.tmp'), res_path)
+            }}
+        }}
+
+        if (length(queries) > 0) run_queries(queries)
+        """.format(ref=reference_level, query=query_level, mode=SHARED_REFERENCE, suffix=MODE_SUFFIX))
@@ -0,0 +1,123 @@
+"""
+Randomized, out-of-core PCA
+
+Clustering only keeps the top few components, so rather than a full SVD of the samples x genes matrix the
+top-k subspace is found by randomized SVD (Halko, Martinsson & Tropp): the centered matrix is multiplied by a
+random (genes x k + oversamples) matrix, refined with a few power iterations, and the small projected matrix
+is decomposed exactly. Every step is a product with the matrix computed one block of rows at a time, so the
+matrix can be memory-mapped and only one block (block_mb) is held as float64 at once; each fit makes
+2 * iterations + 3 passes over it.
+
+pca = RandomizedPCA(n_components=2, random_state=1)
+x = pca.fit_transform(matrix.values, rows=matrix.rows(samples))
+"""
+import numpy as np
+
+
+class RandomizedPCA(object):
+    """
+    PCA via randomized SVD, with the fit / transform interface of sklearn.decomposition.PCA. Components are
+    sign-normalized so that the largest loading of each is positive, making results reproducible for a seed.
+    """
+
+    def __init__(self, n_components=2, oversamples=10, iterations=4, random_state=None, block_mb=64):
+        """
+        :param int n_components: Number of components to keep
+        :param int oversamples: Extra random vectors, which improve the accuracy of the top components
+        :param int iterations: Power iterations, which help when the spectrum decays slowly
+        :param int random_state: Seed of the random projection
+        :param float block_mb: Size of the blocks of rows the matrix is read in, as float64
+        """
+        self.n_components = n_components
+        self.oversamples = oversamples
+        self.iterations = iterations
+        self.random_state = random_state
+        self.block_mb = block_mb
+        self.mean_ = None
+        self.components_ = None
+        self.singular_values_ = None
+        self.explained_variance_ = None
+        self.explained_variance_ratio_ = None
+
+    def _blocks(self, X, rows=None, center=True):
+        """Yields (positions, block) over the selected rows of X, each block as float64"""
+        n = X.shape[0] if rows is None else len(rows)
+        size = max(1, int(self.block_mb * 1e6 / (X.shape[1] * 8)))
+        for start in xrange(0, n, size):
+            positions = slice(start, min(start + size, n))
+            block = np.asarray(X[positions] if rows is None else X[rows[positions]], dtype=np.float64)
+            yield positions, block - self.mean_ if center else block
+
+    def _times(self, X, rows, m):
+        """Centered X times m"""
+        out = np.empty((X.shape[0] if rows is None else len(rows), m.shape[1]))
+        for positions, block in self._blocks(X, rows):
+            out[positions] = np.dot(block, m)
+        return out
+
+    def _t_times(self, X, rows, m):
+        """Centered X transposed times m"""
+        out = np.zeros((X.shape[1], m.shape[1]))
+        for positions, block in self._blocks(X, rows):
+            out += np.dot(block.T, m[positions])
+        return out
+
+    def _fit(self, X, rows=None):
+        """Fits the model and returns the scores of the rows it was fit to"""
+        n, p = X.shape[0] if rows is None else len(rows), X.shape[1]
+        total, sum_sq = np.zeros(p), 0.0
+        for _, block in self._blocks(X, rows, center=False):
+            total += block.sum(axis=0)
+            sum_sq += (block ** 2).sum()
+        self.mean_ = total / n
+        total_var = (sum_sq - n * (self.mean_ ** 2).sum()) / max(n - 1, 1)
+
+        k = min(self.n_components, n, p)
+        rank = min(k + self.oversamples, n, p)
+        q = self._times(X, rows, np.random.RandomState(self.random_state).normal(size=(p, rank)))
+        for _ in xrange(self.iterations):
+            q, _ = np.linalg.qr(q)
+            z, _ = np.linalg.qr(self._t_times(X, rows, q))
+            q = self._times(X, rows, z)
+        q, _ = np.linalg.qr(q)
+        u, s, vt = np.linalg.svd(self._t_times(X, rows, q).T, full_matrices=False)
+
+        signs = np.sign(vt[np.arange(len(vt)), np.abs(vt).argmax(axis=1)])
+        signs[signs == 0] = 1
+        u, vt = u * signs, vt * signs[:, np.newaxis]
+
+        self.components_ = vt[:k]
+        self.singular_values_ = s[:k]
+        self.explained_variance_ = s[:k] ** 2 / max(n - 1, 1)
+        self.explained_variance_ratio_ = self.explained_variance_ / total_var if total_var > 0 else \
+            np.zeros(k)
+        return np.dot(q, u[:, :k]) * s[:k]
+
+    def fit(self, X, rows=None):
+        """
+        :param np.array X: samples x features matrix, e.g. a memory-mapped array
+        :param np.array rows: Rows of X to fit to. Defaults to all
+        :rtype: RandomizedPCA
+        """
+        self._fit(X, rows)
+        return self
+
+    def transform(self, X, rows=None):
+        """
+        :param np.array X: samples x features matrix
+        :param np.array rows: Rows of X to project. Defaults to all
+        :return: samples x n_components scores
+        :rtype: np.array
+        """
+        return self._times(X, rows, self.components_.T)
+
+    def fit_transform(self, X, rows=None):
+        """
+        Fits the model and returns the scores of the rows it was fit to, without another pass over X
+
+        :param np.array X: samples x features matrix
+        :param np.array rows: Rows of X to fit to. Defaults to all
+        :return: samples x n_components scores
+        :rtype: np.array
+        """
+        return self._fit(X, rows)
@@ -0,0 +1,102 @@
+"""
+Batched label-permutation nulls for the negative-control experiments
+
+Instead of one DESeq2 run per shuffled vector, a tissue's counts are read once, size factors (which don't
+depend on the labels) are computed once, and N shuffles of the condition labels are tested with the nbinom
+engine across processes. Dispersions are also estimated once, with the condition left out of the design:
+shuffled labels are independent of the counts, so every permutation's fit would estimate nearly the same
+dispersions, and each permutation only fits the GLM and runs the Wald test. Only aggregated null statistics
+are kept: how often each gene is called significant, how many genes each permutation calls, and the
+distribution of per-gene call counts.
+
+Workers are forked after the counts are set in a module global, so the matrix is shared with every
+process rather than pickled for each batch. Each permutation is seeded with seed + its index, so results
+don't depend on the number of cores.
+"""
+import logging
+
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+from utils.nbinom import design_matrix, estimate_dispersions, nbinom_wald, size_factors
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger(__name__)
+
+# (counts, size factors, dispersions, condition, covariates, seed, alpha) of the tissue being permuted
+_shared = None
+
+
+def _permute_batch(indexes):
+    """
+    Runs a batch of permutations on the shared counts
+
+    :param list[int] indexes: Permutation indexes
+    :return: genes x permutations mask of significant calls
+    :rtype: np.array
+    """
+    counts, sf, disp, condition, covariates, seed, alpha = _shared
+    calls = np.zeros((len(counts), len(indexes)), dtype=bool)
+    for j, i in enumerate(indexes):
+        shuffled = list(np.random.RandomState(seed + i).permutation(condition))
+        X, _ = design_matrix(shuffled, covariates=covariates)
+        padj = nbinom_wald(counts, X, sf=sf, disp=disp).sort_index()['padj'].values
+        calls[:, j] = padj < alpha
+    return calls
+
+
+def permutation_null(counts, condition, n, cores=1, covariates=None, seed=0, alpha=0.05):
+    """
+    Tests n shuffles of the condition labels against the same counts
+
+    :param pd.DataFrame counts: genes x samples counts
+    :param list[str] condition: Condition of each sample; shuffled relative to the samples and covariates
+    :param int n: Number of permutations
+    :param int cores: Number of processes
+    :param list[list[str]] covariates: Other factors of the design, kept with their samples
+    :param int seed: Seed of the first permutation
+    :param float alpha: padj cutoff for a significant call
+    :return: Per-gene calls (baseMean, significant_calls, significant_fraction), and per-permutation
+             significant gene counts
+    :rtype: tuple(pd.DataFrame, pd.DataFrame)
+    """
+    global _shared
+    values = np.round(counts.values.astype(float))
+    sf = size_factors(values)
+    nonzero = (values / sf).mean(axis=1) > 0
+    X, _ = design_matrix(list(condition), covariates=covariates)
+    log.info('Estimating dispersions without the condition')
+    disp = np.full(len(values), np.nan)
+    disp[nonzero] = estimate_dispersions(values[nonzero], sf, X[:, :-1])
+    _shared = (values, sf, disp, list(condition), covariates, seed, alpha)
+
+    batches = [list(x) for x in np.array_split(np.arange(n), min(n, int(cores) * 4)) if len(x)]
+    log.info('Running {} permutations in {} batches on {} cores'.format(n, len(batches), cores))
+    try:
+        if int(cores) > 1:
+            with ProcessPoolExecutor(max_workers=int(cores)) as executor:
+                calls = np.hstack(list(executor.map(_permute_batch, batches)))
+        else:
+            calls = np.hstack([_permute_batch(x) for x in batches])
+    finally:
+        _shared = None
+
+    genes = pd.DataFrame({'baseMean': (values / sf).mean(axis=1),
+                          'significant_calls': calls.sum(axis=1)}, index=counts.index)
+    genes['significant_fraction'] = genes['significant_calls'] / float(n)
+    genes.sort_values('significant_calls', ascending=False, kind='mergesort', inplace=True)
+    permutations = pd.DataFrame({'seed': seed + np.arange(n), 'significant_genes': calls.sum(axis=0)},
+                                index=pd.Index(np.arange(n), name='permutation'))
+    return genes, permutations
+
+
+def call_distribution(genes, n):
+    """
+    :param pd.DataFrame genes: Per-gene calls from `permutation_null`
+    :param int n: Number of permutations
+    :return: Number of genes called significant in exactly k permutations, for k = 0..n
+    :rtype: pd.DataFrame
+    """
+    counts = np.bincount(genes['significant_calls'].values.astype(int), minlength=n + 1)
+    return pd.DataFrame({'genes': counts}, index=pd.Index(np.arange(n + 1), name='significant_calls'))
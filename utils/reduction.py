@@ -0,0 +1,258 @@
+"""
+Vectorized reduction of pairwise DESeq2 results
+
+Every result file contributes one column to aligned genes x samples arrays of padj and log2FoldChange,
+and the per-gene statistics of the ranked table are computed over those arrays in single calls.
+The pairwise experiments keep their results in a ResultStore, whose memory-mapped arrays already hold every
+result column, and reduce them straight from it with `reduce_store`; tables are reduced with `reduce_results`.
+Store values are upcast to float64 before reducing, so the two agree to the store's float32 precision.
+
+`reduce_store` keeps a StoreReduction next to the store: per-gene counts, significant counts, and running means
+and sums of squared deviations of padj and log2FoldChange, with the list of samples already folded in. Only
+the results stored since are read to update them. Medians can't be updated from running statistics, so they are
+the one part of the table still computed over every reduced column.
+"""
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from utils import dedupe
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger(__name__)
+
+
+def stack_results(results):
+    """
+    Reads DESeq2 result tables into aligned genes x samples arrays
+
+    :param list[str] results: Paths to DESeq2 result tables
+    :return: Genes (in order of first appearance), padj and log2FoldChange arrays, and a mask of which
+             genes appeared in which result
+    :rtype: tuple(list[str], np.array, np.array, np.array)
+    """
+    columns = []
+    for result in tqdm(results):
+        df = pd.read_csv(result, index_col=0, sep='\t')
+        columns.append((df.index, df['padj'].values, df['log2FoldChange'].values))
+
+    genes = list(dedupe(gene for index, _, _ in columns for gene in index))
+    gene_index = pd.Index(genes)
+    shape = (len(genes), len(columns))
+    pvals, fc, present = np.full(shape, np.nan), np.full(shape, np.nan), np.zeros(shape, dtype=bool)
+    for i, (index, padj, log2fc) in enumerate(columns):
+        rows = gene_index.get_indexer(index)
+        pvals[rows, i] = padj
+        fc[rows, i] = log2fc
+        present[rows, i] = True
+    return genes, pvals, fc, present
+
+
+def _rowwise(func, values, present):
+    """Applies func along each row, ignoring entries for genes absent from a result"""
+    full = present.all(axis=1)
+    out = np.empty(len(values))
+    out[full] = func(values[full], axis=1)
+    for i in np.flatnonzero(~full):
+        out[i] = func(values[i, present[i]])
+    return out
+
+
+def rank_genes(genes, pvals, fc, present, annotation, cutoff=0.001):
+    """
+    Creates the ranked table of a pairwise experiment
+
+    :param list[str] genes: Gene IDs, one per row of the arrays
+    :param np.array pvals: genes x samples array of padj
+    :param np.array fc: genes x samples array of log2FoldChange
+    :param np.array present: genes x samples mask of which genes appeared in which result
+    :param GeneAnnotation annotation: Maps gene ID to gene name
+    :param float cutoff: padj cutoff for a gene to count as significant in a sample
+    :return: Genes ranked by the number of samples they are significant in
+    :rtype: pd.DataFrame
+    """
+    with np.errstate(invalid='ignore'):
+        return _ranked_table(genes, present.sum(axis=1), ((pvals < cutoff) & present).sum(axis=1),
+                             _rowwise(np.median, pvals, present), _rowwise(np.std, pvals, present),
+                             _rowwise(np.median, fc, present), _rowwise(np.std, fc, present), annotation)
+
+
+def _ranked_table(genes, num_samples, pval_counts, pval, pval_std, fc, fc_std, annotation):
+    """Assembles the ranked table from per-gene statistics"""
+    ranked = pd.DataFrame()
+    ranked['num_samples'] = num_samples
+    ranked['pval_counts'] = pval_counts
+    ranked['pval'] = pval
+    ranked['pval_std'] = np.round(pval_std, 4)
+    ranked['fc'] = np.round(fc, 4)
+    ranked['fc_std'] = np.round(fc_std, 4)
+
+    ranked['gene_id'] = genes
+    ranked.index = annotation.map_ids(genes)
+    ranked.sort_values('pval_counts', inplace=True, ascending=False, kind='mergesort')
+    return ranked
+
+
+def reduce_results(results, annotation, cutoff=0.001):
+    """
+    Reduces DESeq2 result tables into a single table of genes ranked by p-value counts
+
+    :param list[str] results: Paths to DESeq2 result tables
+    :param GeneAnnotation annotation: Maps gene ID to gene name
+    :param float cutoff: padj cutoff for a gene to count as significant in a sample
+    :return: Ranked genes
+    :rtype: pd.DataFrame
+    """
+    genes, pvals, fc, present = stack_results(results)
+    return rank_genes(genes, pvals, fc, present, annotation, cutoff=cutoff)
+
+
+class StoreReduction(object):
+    """
+    Per-gene running statistics of the results in a ResultStore, saved next to the store
+
+    Holds, for each of the store's genes, the number of results it appeared in, how many called it significant,
+    the mean and sum of squared deviations of its padj and log2FoldChange (merged batch by batch, so NaN padj
+    propagates as it does through np.std), and the result it first appeared in with its padj there. The samples
+    already folded in are saved with them; `update` reads only the columns of samples added since.
+    """
+
+    def __init__(self, store, name='reduction'):
+        """
+        :param ResultStore store: Result store
+        :param str name: Name of the reduction, saved as <store_dir>/<name>.npz. Loaded if it exists
+        """
+        self.store = store
+        self.path = os.path.join(store.store_dir, name + '.npz')
+        self.cutoff = None
+        self._reset()
+        if os.path.exists(self.path):
+            with np.load(self.path) as npz:
+                self.samples = npz['samples'].tolist()
+                self.cutoff = float(npz['cutoff'])
+                self.replaced = int(npz['replaced'])
+                self.stats = {x: npz[x] for x in self.stats}
+
+    def _reset(self):
+        """Empties the statistics; `update` sizes them to the store's genes"""
+        self.samples = []
+        self.replaced = len(self.store.replaced)
+        self.stats = {'n': np.zeros(0, dtype=np.int64), 'significant': np.zeros(0, dtype=np.int64),
+                      'pval_mean': np.zeros(0), 'pval_m2': np.zeros(0), 'fc_mean': np.zeros(0), 'fc_m2': np.zeros(0),
+                      'first': np.zeros(0, dtype=np.int64), 'first_padj': np.zeros(0)}
+
+    def _reusable(self, samples, cutoff):
+        """Whether the saved statistics are of a prefix of samples, none of whose results have been replaced"""
+        n = len(self.samples)
+        return (self.cutoff == cutoff and self.samples == samples[:n] and len(self.stats['n']) <= len(self.store.genes)
+                and not set(self.store.replaced[self.replaced:]) & set(self.samples))
+
+    def update(self, samples, cutoff=0.001):
+        """
+        Brings the statistics in line with a list of the store's samples
+
+        :param list[str] samples: Samples to reduce, in order
+        :param float cutoff: padj cutoff for a gene to count as significant in a sample
+        :return: True if any results were read
+        :rtype: bool
+        """
+        if not self._reusable(samples, cutoff):
+            if self.samples:
+                log.info('Saved reduction {} is of other samples or results, reducing from scratch'.format(self.path))
+            self._reset()
+        self.cutoff = cutoff
+        # Genes added to the store since are absent from every result already folded in
+        n_genes = len(self.store.genes)
+        for key, fill in [('n', 0), ('significant', 0), ('pval_mean', 0), ('pval_m2', 0), ('fc_mean', 0), ('fc_m2', 0),
+                          ('first', -1), ('first_padj', np.nan)]:
+            stat = self.stats[key]
+            self.stats[key] = np.concatenate([stat, np.full(n_genes - len(stat), fill, dtype=stat.dtype)])
+
+        new = samples[len(self.samples):]
+        log.info('{} results already reduced, reading {} new'.format(len(self.samples), len(new)))
+        if not new:
+            return False
+        cols = self.store.columns(new)
+        present = self.store.present()[:, cols]
+        pvals = np.asarray(self.store.array('padj')[:, cols], dtype=np.float64)
+        fc = np.asarray(self.store.array('log2FoldChange')[:, cols], dtype=np.float64)
+
+        n = present.sum(axis=1)
+        with np.errstate(invalid='ignore'):
+            self.stats['significant'] += ((pvals < cutoff) & present).sum(axis=1)
+        appeared = (self.stats['first'] < 0) & (n > 0)
+        first = np.argmax(present[appeared], axis=1)
+        self.stats['first'][appeared] = len(self.samples) + first
+        self.stats['first_padj'][appeared] = pvals[appeared, first]
+        self._merge('pval', pvals, present, n)
+        self._merge('fc', fc, present, n)
+        self.stats['n'] += n
+        self.samples += new
+        return True
+
+    def _merge(self, name, values, present, n):
+        """Merges a batch's means and sums of squared deviations into the running ones (Chan et al.)"""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(n > 0, np.where(present, values, 0).sum(axis=1) / n, 0)
+            m2 = np.where(present, (values - mean[:, np.newaxis]) ** 2, 0).sum(axis=1)
+            total = self.stats['n'] + n
+            delta = np.where(n > 0, mean - self.stats[name + '_mean'], 0)
+            self.stats[name + '_mean'] += np.where(n > 0, delta * n / np.maximum(total, 1), 0)
+            self.stats[name + '_m2'] += np.where(n > 0, m2 + delta ** 2 * self.stats['n'] * n / np.maximum(total, 1), 0)
+
+    def save(self):
+        """Atomically writes the statistics"""
+        tmp_path = self.path[:-len('.npz')] + '.tmp.npz'
+        np.savez(tmp_path, samples=np.array(self.samples), cutoff=self.cutoff, replaced=self.replaced, **self.stats)
+        os.rename(tmp_path, self.path)
+
+    def rank(self, annotation):
+        """
+        :param GeneAnnotation annotation: Maps gene ID to gene name
+        :return: Ranked genes
+        :rtype: pd.DataFrame
+        """
+        stats = self.stats
+        # Genes only found in other samples' results are left out, and the rest are put in the order reducing the
+        # tables finds them: the genes of each result by padj, NA last, then those new in the next result. The store
+        # doesn't keep the order of a table's NA rows, so genes first found with NA padj are in the store's order
+        rows = np.flatnonzero(stats['n'] > 0)
+        first_padj = stats['first_padj'][rows]
+        rows = rows[np.lexsort((rows, np.where(np.isnan(first_padj), np.inf, first_padj), stats['first'][rows]))]
+        n = stats['n'][rows]
+
+        # Absent genes are NaN in the store, and a NaN padj or log2FoldChange in a result makes a gene's mean NaN,
+        # so for the other genes the median of the values that aren't NaN is the median over their results
+        cols = self.store.columns(self.samples)
+        medians = {}
+        for name, column in [('pval', 'padj'), ('fc', 'log2FoldChange')]:
+            values = np.sort(np.asarray(self.store.array(column)[:, cols][rows], dtype=np.float64), axis=1)
+            i = np.arange(len(rows))
+            medians[name] = np.where(np.isnan(stats[name + '_mean'][rows]), np.nan,
+                                     (values[i, (n - 1) // 2] + values[i, n // 2]) / 2)
+        return _ranked_table([self.store.genes[i] for i in rows], n, stats['significant'][rows], medians['pval'],
+                             np.sqrt(stats['pval_m2'][rows] / n), medians['fc'], np.sqrt(stats['fc_m2'][rows] / n),
+                             annotation)
+
+
+def reduce_store(store, annotation, cutoff=0.001, samples=None, name='reduction'):
+    """
+    Reduces the results in a result store into a single table of genes ranked by p-value counts
+
+    Statistics are kept in a StoreReduction, so only results stored since the last reduction are read for them
+
+    :param ResultStore store: Result store
+    :param GeneAnnotation annotation: Maps gene ID to gene name
+    :param float cutoff: padj cutoff for a gene to count as significant in a sample
+    :param list[str] samples: Samples to reduce. Defaults to all
+    :param str name: Name of the saved reduction. Reductions of different samples of a store need their own
+    :return: Ranked genes
+    :rtype: pd.DataFrame
+    """
+    reduction = StoreReduction(store, name=name)
+    if reduction.update(list(store.samples if samples is None else samples), cutoff=cutoff):
+        reduction.save()
+    return reduction.rank(annotation)
@@ -0,0 +1,322 @@
+"""
+Columnar store of a tissue's DESeq2 results
+
+A store is a directory holding one raw float32 file per DESeq2 column (baseMean.f32, log2FoldChange.f32, ...),
+each a genes x samples array in column-major order, with the gene and sample indexes in genes.txt and
+samples.txt. Column-major means every result is one contiguous block per column, so adding a result is an
+append to each file followed by a line in samples.txt, and "all genes for sample Y" is a sequential read.
+"All samples for gene X" is a strided read of the memory-mapped arrays, which touches one value per result.
+
+Genes missing from a result are NaN in every column; baseMean is never NaN for a gene DESeq2 reported, so
+it doubles as the mask of which genes appeared in which result. float32 keeps 7 significant digits, and
+p-values below ~1e-45 are stored as 0. Samples whose results are replaced in place are logged to replaced.txt,
+so anything derived from their earlier results can tell it is stale.
+
+The mode that produced a result is kept in modes.tsv for results not from the experiment's own per-vector run,
+such as those of a shared-reference fit. A table's mode is read from a <table>.mode file next to it on ingest.
+
+store = ResultStore(result_store_dir(os.path.join(tissue_dir, 'results')))
+store.ingest([os.path.join(tissue_dir, 'results', x) for x in os.listdir(os.path.join(tissue_dir, 'results'))])
+store.gene('ENSG00000141510.16')
+store.export('TCGA.A1.A0SB.01', 'TCGA.A1.A0SB.01.tsv')
+"""
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger(__name__)
+
+# Columns of a DESeq2 results table, in the order write.table writes them
+COLUMNS = ['baseMean', 'log2FoldChange', 'lfcSE', 'stat', 'pvalue', 'padj']
+
+# Mode of results without a recorded one, and the suffix of the file next to a table that names its mode
+DEFAULT_MODE = 'per-vector'
+MODE_SUFFIX = '.mode'
+
+
+def result_store_dir(results_dir):
+    """
+    :param str results_dir: Directory a tissue's result tables are written to, e.g. <tissue>/results
+    :return: Path of its result store, next to it with a -store suffix
+    :rtype: str
+    """
+    return os.path.normpath(results_dir) + '-store'
+
+
+class ResultStore(object):
+    """
+    Appendable genes x samples store of DESeq2 results. Writes are expected from a single process.
+    """
+
+    def __init__(self, store_dir):
+        """
+        :param str store_dir: Path to store directory. Created if it doesn't exist
+        """
+        self.store_dir = store_dir
+        if not os.path.isdir(store_dir):
+            os.makedirs(store_dir)
+        self.samples = self._read_index('samples.txt')
+        self._recover()
+        self.genes = self._read_index('genes.txt')
+        self.replaced = self._read_index('replaced.txt')
+        self.modes = dict(x.split('\t', 1) for x in self._read_index('modes.tsv'))
+        self.gene_index = {x: i for i, x in enumerate(self.genes)}
+        self.sample_index = {x: i for i, x in enumerate(self.samples)}
+        self._truncate()
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __contains__(self, sample):
+        return sample in self.sample_index
+
+    @property
+    def shape(self):
+        return len(self.genes), len(self.samples)
+
+    def _path(self, name):
+        return os.path.join(self.store_dir, name)
+
+    def _read_index(self, name):
+        if not os.path.exists(self._path(name)):
+            return []
+        with open(self._path(name), 'r') as f:
+            return [x.rstrip('\n') for x in f if x.strip()]
+
+    def _recover(self):
+        """Finishes or discards extending the gene axis, if `_add_genes` was interrupted"""
+        tmp_genes = self._path('genes.txt.tmp')
+        tmp_paths = {x: self._path(x + '.f32.tmp') for x in COLUMNS}
+        if os.path.exists(tmp_genes):
+            size = len(self._read_index('genes.txt.tmp')) * len(self.samples) * 4
+            # genes.txt.tmp is written once every column is, so if it's complete any column without a tmp file
+            # was already renamed into place
+            if all(os.path.getsize(tmp_paths[x] if os.path.exists(tmp_paths[x]) else self._path(x + '.f32')) == size
+                   for x in COLUMNS):
+                log.info('Finishing an interrupted extension of result store {}'.format(self.store_dir))
+                for column, tmp_path in tmp_paths.items():
+                    if os.path.exists(tmp_path):
+                        os.rename(tmp_path, self._path(column + '.f32'))
+                os.rename(tmp_genes, self._path('genes.txt'))
+                return
+            os.remove(tmp_genes)
+        for tmp_path in tmp_paths.values():
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _truncate(self):
+        """Drops data appended after the last sample was recorded, left by an interrupted append"""
+        size = len(self.genes) * len(self.samples) * 4
+        for column in COLUMNS:
+            path = self._path(column + '.f32')
+            if not os.path.exists(path):
+                open(path, 'wb').close()
+            elif os.path.getsize(path) > size:
+                with open(path, 'r+b') as f:
+                    f.truncate(size)
+
+    def array(self, column, mode='r'):
+        """
+        :param str column: DESeq2 column, one of COLUMNS
+        :param str mode: Memory-map mode; 'r+' to modify results in place
+        :return: Memory-mapped genes x samples array
+        :rtype: np.array
+        """
+        if not self.samples:
+            return np.empty((len(self.genes), 0), dtype=np.float32)
+        return np.memmap(self._path(column + '.f32'), dtype='<f4', mode=mode, shape=self.shape, order='F')
+
+    def present(self, samples=None):
+        """
+        :param list[str] samples: Samples to include. Defaults to all
+        :return: genes x samples mask of which genes appeared in which result
+        :rtype: np.array
+        """
+        base_mean = self.array('baseMean')
+        return ~np.isnan(base_mean if samples is None else base_mean[:, self.columns(samples)])
+
+    def mode(self, sample):
+        """
+        :param str sample: Sample name
+        :return: Mode that produced the sample's result, e.g. DEFAULT_MODE or 'shared-reference'
+        :rtype: str
+        """
+        return self.modes.get(sample, DEFAULT_MODE)
+
+    def columns(self, samples):
+        """
+        :param list[str] samples: Sample names
+        :return: Column positions in the order given
+        :rtype: np.array
+        """
+        try:
+            return np.array([self.sample_index[x] for x in samples], dtype=np.int64)
+        except KeyError as e:
+            raise KeyError('Sample not found in result store {}: {}'.format(self.store_dir, e.args[0]))
+
+    def sample(self, sample):
+        """
+        All genes for one sample
+
+        :param str sample: Sample name
+        :return: The sample's results table, genes x COLUMNS, without genes missing from its result
+        :rtype: pd.DataFrame
+        """
+        j = self.columns([sample])[0]
+        df = pd.DataFrame({x: self.array(x)[:, j] for x in COLUMNS}, index=self.genes, columns=COLUMNS)
+        return df[df['baseMean'].notnull()]
+
+    def gene(self, gene, columns=None, samples=None):
+        """
+        All samples for one gene
+
+        :param str gene: Gene ID
+        :param list[str] columns: DESeq2 columns to read. Defaults to all
+        :param list[str] samples: Samples to include. Defaults to all
+        :return: samples x columns dataframe, NaN where the gene is missing from a result
+        :rtype: pd.DataFrame
+        """
+        if gene not in self.gene_index:
+            raise KeyError('Gene not found in result store {}: {}'.format(self.store_dir, gene))
+        i = self.gene_index[gene]
+        samples = self.samples if samples is None else list(samples)
+        cols = self.columns(samples)
+        columns = columns or COLUMNS
+        return pd.DataFrame({x: self.array(x)[i, cols] for x in columns}, index=samples, columns=columns)
+
+    def append(self, sample, df, mode=DEFAULT_MODE):
+        """
+        Adds a result, replacing the sample's result if it is already stored
+
+        :param str sample: Sample name
+        :param pd.DataFrame df: DESeq2 results table indexed by gene
+        :param str mode: Mode that produced the result
+        """
+        self.extend([sample], {x: df[x].values[:, np.newaxis] for x in COLUMNS}, genes=df.index, modes=[mode])
+
+    def extend(self, samples, values, genes=None, modes=None):
+        """
+        Adds a block of results, replacing those of samples already stored
+
+        :param list[str] samples: Sample names
+        :param dict(str, np.array) values: genes x samples array of each of COLUMNS
+        :param list[str] genes: Genes of the arrays' rows. Defaults to the store's genes, in order
+        :param list[str] modes: Mode that produced each result. Defaults to DEFAULT_MODE
+        """
+        self._set_modes(samples, modes or [DEFAULT_MODE] * len(samples))
+        if genes is not None:
+            new = [x for x in genes if x not in self.gene_index]
+            if new:
+                self._add_genes(new)
+            rows = np.array([self.gene_index[x] for x in genes], dtype=np.int64)
+            aligned = {}
+            for column in COLUMNS:
+                aligned[column] = np.full((len(self.genes), len(samples)), np.nan, dtype='<f4', order='F')
+                aligned[column][rows] = values[column]
+            values = aligned
+
+        stored = [j for j, x in enumerate(samples) if x in self.sample_index]
+        if stored:
+            with open(self._path('replaced.txt'), 'a') as f:
+                f.write(''.join(samples[j] + '\n' for j in stored))
+            self.replaced += [samples[j] for j in stored]
+            cols = self.columns([samples[j] for j in stored])
+            for column in COLUMNS:
+                array = self.array(column, mode='r+')
+                array[:, cols] = values[column][:, stored]
+                array.flush()
+        new = [j for j, x in enumerate(samples) if x not in self.sample_index]
+        if not new:
+            return
+
+        for column in COLUMNS:
+            with open(self._path(column + '.f32'), 'ab') as f:
+                np.asarray(values[column][:, new], dtype='<f4').ravel(order='F').tofile(f)
+        # Samples are only part of the store once they're recorded, so an interrupted append is truncated away
+        with open(self._path('samples.txt'), 'a') as f:
+            f.write(''.join(samples[j] + '\n' for j in new))
+        for j in new:
+            self.sample_index[samples[j]] = len(self.samples)
+            self.samples.append(samples[j])
+
+    def _set_modes(self, samples, modes):
+        """Records the modes that differ from those recorded; later lines of modes.tsv override earlier ones"""
+        changed = [(x, mode) for x, mode in zip(samples, modes) if self.mode(x) != mode]
+        if changed:
+            with open(self._path('modes.tsv'), 'a') as f:
+                f.write(''.join('{}\t{}\n'.format(x, mode) for x, mode in changed))
+            self.modes.update(changed)
+
+    def _add_genes(self, genes):
+        """
+        Extends the gene axis, rewriting every column with NaN for the new genes in existing results
+
+        Every column and the new genes.txt are written to tmp files before any is renamed into place, so an
+        interrupted extension is either discarded or finished by `_recover` when the store is next opened
+        """
+        log.info('Adding {} genes to result store {}'.format(len(genes), self.store_dir))
+        shape = (len(self.genes) + len(genes), len(self.samples))
+        for column in COLUMNS:
+            extended = np.full(shape, np.nan, dtype='<f4', order='F')
+            extended[:len(self.genes)] = self.array(column)
+            extended.ravel(order='F').tofile(self._path(column + '.f32.tmp'))
+        with open(self._path('genes.txt.tmp'), 'w') as f:
+            f.write(''.join(x + '\n' for x in self.genes + list(genes)))
+        for column in COLUMNS:
+            os.rename(self._path(column + '.f32.tmp'), self._path(column + '.f32'))
+        os.rename(self._path('genes.txt.tmp'), self._path('genes.txt'))
+        for gene in genes:
+            self.gene_index[gene] = len(self.genes)
+            self.genes.append(gene)
+
+    def ingest(self, results, remove=False):
+        """
+        Appends DESeq2 result tables, named by sample, to the store, with the mode in each one's .mode file
+
+        :param list[str] results: Paths to DESeq2 result tables
+        :param bool remove: Remove each table, and its .mode file, once it's stored
+        :return: Number of tables stored
+        :rtype: int
+        """
+        for path in results:
+            mode_path = path + MODE_SUFFIX
+            mode = DEFAULT_MODE
+            if os.path.exists(mode_path):
+                with open(mode_path, 'r') as f:
+                    mode = f.read().strip() or DEFAULT_MODE
+            self.append(os.path.basename(path), pd.read_csv(path, sep='\t', index_col=0), mode=mode)
+            if remove:
+                os.remove(path)
+                if os.path.exists(mode_path):
+                    os.remove(mode_path)
+        if results:
+            log.info('Stored {} results in {}, {} in total'.format(len(results), self.store_dir, len(self.samples)))
+        return len(results)
+
+    def export(self, sample, path):
+        """
+        Writes a sample's results in the layout of the DESeq2 scripts' tables: ordered by padj, NA last
+
+        :param str sample: Sample name
+        :param str path: Output path
+        :return: Path to table
+        :rtype: str
+        """
+        df = self.sample(sample)
+        df = df.iloc[np.argsort(df['padj'].values, kind='mergesort')]
+        df.to_csv(path, sep='\t', na_rep='NA')
+        return path
+
+    def export_tables(self, directory, samples=None):
+        """
+        :param str directory: Directory to write tables to, one per sample named by the sample
+        :param list[str] samples: Samples to export. Defaults to all
+        :return: Paths to tables
+        :rtype: list[str]
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        return [self.export(x, os.path.join(directory, x)) for x in (self.samples if samples is None else samples)]
@@ -0,0 +1,559 @@
+"""
+Resumable scheduling of DESeq2 jobs
+
+Every (tissue, vector) job has an entry in a journal recording its state (pending, running, done or failed)
+and the number of attempts made. Each state change appends a line to the journal, which is replayed when it is
+loaded, so an interrupted run picks up where it stopped: finished jobs are skipped and failed jobs are retried
+until they run out of attempts.
+
+Jobs are dispatched longest-first, using a cost model fit to the deseq2-time-test results, and the
+predicted makespan is logged before the run starts. Jobs within a factor of two in cost are dispatched together
+by tissue dataframe, so a worker reading dataframes keeps reusing the one it has cached. A job is only started
+while the predicted memory of all running jobs fits in the memory budget; predictions are scaled by the peak
+memory observed for past jobs.
+
+Jobs with a count store have their vector's columns sliced into a binary matrix just before they start,
+so the R worker reads only those columns instead of parsing the whole tissue dataframe.
+"""
+import heapq
+import json
+import logging
+import os
+import re
+import threading
+from collections import namedtuple, Counter
+
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+from utils import mkdir_p
+from utils.deseq2_pool import DESeq2WorkerPool
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger(__name__)
+
+PENDING, RUNNING, DONE, FAILED = 'pending', 'running', 'done', 'failed'
+
+# output is the file the job writes. A job whose output already exists when it is first journaled is
+# considered done, so results from runs made before the journal existed are not recomputed.
+# samples is the number of samples in the job's vector; if None it is the number of lines in the vector.
+# matrix is the dataframe the job's script reads, used to predict its memory; if None it is the first argument.
+# vector is the file listing the job's samples, or the samples themselves (e.g. a ManifestVector);
+# if None it is the last argument. A job whose vector is a list reads it from the job's count matrix; if its
+# counts can't be taken from its store, the vector is written to its last argument for the job to read.
+# store is the count store holding the matrix's counts. If it exists the job is given only its vector's columns
+Job = namedtuple('Job', ['job_id', 'script_path', 'args', 'output', 'samples', 'matrix', 'vector', 'store'])
+Job.__new__.__defaults__ = (None, None, None, None)
+
+# Memory of one sample column of ~20,000 protein-coding genes held as doubles
+SAMPLE_MB = 20000 * 8 / 1e6
+
+
+def job_vector(job):
+    """
+    :param Job job: Job
+    :return: Samples in the job's vector
+    :rtype: list[str]
+    """
+    if job.vector is not None and not isinstance(job.vector, str):
+        return list(job.vector)
+    with open(job.vector or job.args[-1], 'r') as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+class CostModel(object):
+    """
+    Predicts DESeq2 runtime in seconds from the number of samples as: coef * samples ** exponent
+
+    Without timing data the model is linear with a coefficient of 1, which still orders jobs correctly
+    but gives the makespan in relative units.
+    """
+
+    def __init__(self, coef=1.0, exponent=1.0, calibrated=False):
+        self.coef = coef
+        self.exponent = exponent
+        self.calibrated = calibrated
+
+    def predict(self, samples):
+        return self.coef * samples ** self.exponent
+
+    @classmethod
+    def from_time_test(cls, results_path):
+        """
+        Fits the model to the results of the deseq2-time-test experiment
+
+        :param str results_path: Path to deseq2-time-test results.tsv
+        :return: Fit model, or the uncalibrated default if there aren't at least two timings
+        :rtype: CostModel
+        """
+        if not os.path.exists(results_path):
+            return cls()
+        # Each record is the vector path followed by the stderr of `time Rscript ...`, which ends
+        # with e.g. "1:02.33elapsed" or "1:02:03elapsed"
+        text = open(results_path, 'r').read()
+        samples, seconds = [], []
+        for match in re.finditer(r'(\d+)-vector\t(.*?)(?=\S*\d+-vector\t|\Z)', text, re.S):
+            elapsed = re.search(r'(?:(\d+):)?(\d+):(\d+(?:\.\d+)?)elapsed', match.group(2))
+            if elapsed:
+                hours, minutes, secs = elapsed.groups()
+                samples.append(int(match.group(1)))
+                seconds.append(int(hours or 0) * 3600 + int(minutes) * 60 + float(secs))
+        if len(set(samples)) < 2:
+            return cls()
+        exponent, intercept = np.polyfit(np.log(samples), np.log(seconds), 1)
+        log.info('DESeq2 cost model: {:.3g} * samples ^ {:.2f} seconds'.format(np.exp(intercept), exponent))
+        return cls(coef=float(np.exp(intercept)), exponent=float(exponent), calibrated=True)
+
+
+class MemoryModel(object):
+    """
+    Predicts a job's peak memory in MB as: ratio * (size of its dataframe on disk + size of its vector's columns)
+
+    The ratio is learned from the peak memory reported for finished jobs, and the observations are saved
+    to `path` so later runs start from them. Until there are observations a conservative default is used.
+    """
+
+    def __init__(self, path=None, default_ratio=4.0, history=200):
+        """
+        :param str path: JSON file where observed ratios are kept
+        :param float default_ratio: Ratio used before any job has been observed
+        :param int history: Number of most recent observations to keep
+        """
+        self.path = path
+        self.default_ratio = default_ratio
+        self.history = history
+        self.ratios = json.load(open(path, 'r')) if path and os.path.exists(path) else []
+        self.lock = threading.Lock()
+
+    @property
+    def ratio(self):
+        # The 90th percentile of recent observations, so estimates stay on the safe side
+        return float(np.percentile(self.ratios, 90)) if self.ratios else self.default_ratio
+
+    @staticmethod
+    def base_mb(matrix, samples):
+        matrix_mb = os.path.getsize(matrix) / 1e6 if matrix and os.path.exists(matrix) else 0.0
+        return matrix_mb + samples * SAMPLE_MB
+
+    def predict(self, matrix, samples):
+        """
+        :param str matrix: Path to the dataframe the job reads
+        :param int samples: Number of samples in the job's vector
+        :return: Predicted peak memory in MB
+        :rtype: float
+        """
+        return self.ratio * self.base_mb(matrix, samples)
+
+    def observe(self, matrix, samples, peak_mb):
+        """Records the peak memory of a finished job and saves the observations"""
+        base = self.base_mb(matrix, samples)
+        if not peak_mb or not base:
+            return
+        with self.lock:
+            self.ratios = (self.ratios + [peak_mb / base])[-self.history:]
+            if self.path:
+                tmp_path = self.path + '.tmp'
+                with open(tmp_path, 'w') as f:
+                    json.dump(self.ratios, f)
+                os.rename(tmp_path, self.path)
+
+
+class MemoryBudget(object):
+    """
+    Admits jobs while the predicted memory of running jobs stays within a budget
+
+    A job larger than the whole budget is still admitted once nothing else is running, so it can't block forever.
+    """
+
+    def __init__(self, budget_mb):
+        """
+        :param float budget_mb: Memory available to jobs in MB
+        """
+        self.budget_mb = budget_mb
+        self.in_use = 0.0
+        self.condition = threading.Condition()
+
+    def acquire(self, mb):
+        with self.condition:
+            while self.in_use > 0 and self.in_use + mb > self.budget_mb:
+                self.condition.wait()
+            self.in_use += mb
+
+    def release(self, mb):
+        with self.condition:
+            self.in_use -= mb
+            self.condition.notify_all()
+
+
+def available_memory_mb(fraction=0.8):
+    """
+    :param float fraction: Fraction of physical memory to make available
+    :return: Memory budget in MB
+    :rtype: float
+    """
+    return fraction * os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1e6
+
+
+def budget_map(fn, blobs, memory, cores=1, memory_mb=None):
+    """
+    Maps a function over blobs in a process pool, largest first, starting a blob only while the predicted memory
+    of those already started fits in the budget. fn must be a module-level function so it can be pickled.
+
+    :param function fn: Function of one blob
+    :param list blobs: Arguments of each call
+    :param list[float] memory: Predicted peak memory of each call in MB
+    :param int cores: Number of processes. With one, or a single blob, blobs are mapped in this process
+    :param float memory_mb: Memory budget in MB. Defaults to 80% of physical memory
+    :return: Results in the order of blobs
+    :rtype: list
+    """
+    if int(cores) <= 1 or len(blobs) <= 1:
+        return [fn(x) for x in blobs]
+    budget = MemoryBudget(memory_mb or available_memory_mb())
+    log.info('Running {} tasks on {} cores with a {:.0f} MB memory budget'.format(len(blobs), cores,
+                                                                                 budget.budget_mb))
+    futures = [None] * len(blobs)
+    with ProcessPoolExecutor(max_workers=int(cores)) as executor:
+        for i in longest_first(dict(enumerate(memory))):
+            budget.acquire(memory[i])
+            futures[i] = executor.submit(fn, blobs[i])
+            futures[i].add_done_callback(lambda _, mb=memory[i]: budget.release(mb))
+    return [x.result() for x in futures]
+
+
+def longest_first(costs):
+    """
+    :param dict(object, float) costs: Predicted cost of each job
+    :return: Jobs ordered by decreasing cost, ties broken by job
+    :rtype: list
+    """
+    return sorted(costs, key=lambda x: (-costs[x], x))
+
+
+def banded_order(costs, groups, band=2.0):
+    """
+    Orders jobs longest-first by cost band, and by group within a band, so jobs sharing e.g. a dataframe run
+    consecutively unless their costs differ by more than a band
+
+    :param dict(object, float) costs: Predicted cost of each job
+    :param dict(object, object) groups: Group of each job
+    :param float band: Ratio between the largest and smallest cost of a band
+    :return: Jobs ordered by decreasing band, then by group, largest group first, then by decreasing cost
+    :rtype: list
+    """
+    bands = {x: int(np.floor(np.log(max(cost, 1e-12)) / np.log(band))) for x, cost in costs.items()}
+    largest = {}
+    for x in costs:
+        key = (bands[x], groups[x])
+        largest[key] = max(largest.get(key, 0.0), costs[x])
+    return sorted(costs, key=lambda x: (-bands[x], -largest[(bands[x], groups[x])], groups[x], -costs[x], x))
+
+
+def predict_makespan(costs, workers):
+    """
+    Simulates longest-processing-time-first scheduling of jobs across workers
+
+    :param list[float] costs: Predicted cost of each job
+    :param int workers: Number of workers
+    :return: Predicted time until the last job finishes
+    :rtype: float
+    """
+    loads = [0.0] * max(1, workers)
+    for cost in sorted(costs, reverse=True):
+        heapq.heappush(loads, heapq.heappop(loads) + cost)
+    return max(loads)
+
+
+class JobJournal(object):
+    """
+    State of every job, kept as an append-only log of JSON lines
+
+    Each line is [job_id, entry], and later lines replace earlier ones, so a state change appends one short line
+    instead of rewriting the journal. Once as many lines have been appended as there are jobs, the log is compacted:
+    it is atomically rewritten with one line per job, so its size stays proportional to the number of jobs.
+    """
+
+    def __init__(self, path):
+        """
+        :param str path: Path to journal. Replayed if it exists
+        """
+        self.path = path
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self._log = None
+        self._appended = 0
+        legacy_path = os.path.splitext(path)[0] + '.json'
+        if os.path.exists(path):
+            self._replay()
+        elif legacy_path != path and os.path.exists(legacy_path):
+            # Journals written before the log were a single JSON object
+            self.jobs = json.load(open(legacy_path, 'r'))
+
+    def _replay(self):
+        """Loads the journal, applying its lines in order"""
+        partial = False
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    job_id, entry = json.loads(line)
+                except ValueError:
+                    # The last line is partial if a run was killed while appending it
+                    partial = True
+                    continue
+                self.jobs[job_id] = entry
+        if partial:
+            # Rewritten so lines appended later don't continue the partial one
+            self._compact()
+
+    def __contains__(self, job_id):
+        return job_id in self.jobs
+
+    def state(self, job_id):
+        return self.jobs[job_id]['state']
+
+    def attempts(self, job_id):
+        return self.jobs[job_id]['attempts']
+
+    def register(self, job_id, state=PENDING):
+        """Adds a job if it isn't in the journal already"""
+        if job_id not in self.jobs:
+            self.jobs[job_id] = {'state': state, 'attempts': 0}
+
+    def update(self, job_id, state, **info):
+        """
+        Sets the state of a job and appends it to the journal
+
+        :param str job_id: Job ID
+        :param str state: New state
+        :param info: Additional fields to record for the job, e.g. elapsed time
+        """
+        with self.lock:
+            entry = self.jobs[job_id]
+            entry['state'] = state
+            if state == RUNNING:
+                entry['attempts'] += 1
+            entry.update(info)
+            if self._log is None:
+                self._log = open(self.path, 'a')
+            self._log.write(json.dumps([job_id, entry]) + '\n')
+            self._log.flush()
+            self._appended += 1
+            if self._appended >= max(len(self.jobs), 1000):
+                self._compact()
+
+    def save(self):
+        """Atomically rewrites the journal with one line per job"""
+        with self.lock:
+            self._compact()
+
+    def close(self):
+        """Closes the log lines are appended to"""
+        with self.lock:
+            if self._log is not None:
+                self._log.close()
+                self._log = None
+
+    def _compact(self):
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for job_id in sorted(self.jobs):
+                f.write(json.dumps([job_id, self.jobs[job_id]]) + '\n')
+        os.rename(tmp_path, self.path)
+        self._appended = 0
+
+
+class DESeq2Scheduler(object):
+    """
+    Runs DESeq2 jobs on a worker pool, tracking each job in a journal
+
+    scheduler = DESeq2Scheduler(journal_path, cores=8, directory=experiment_dir)
+    outstanding = scheduler.run(jobs)
+    """
+
+    def __init__(self, journal_path, cores, directory, max_attempts=3, cost_model=None, memory_mb=None,
+                 memory_model=None):
+        """
+        :param str journal_path: Path to journal
+        :param int cores: Number of R workers
+        :param str directory: Directory where the worker script will be written
+        :param int max_attempts: Number of times a job is run before it is left as failed
+        :param CostModel cost_model: Model used to order jobs longest-first. Defaults to a linear model
+        :param float memory_mb: Memory budget for concurrent jobs in MB. Defaults to 80% of physical memory
+        :param MemoryModel memory_model: Model used to predict each job's memory
+        """
+        self.journal = JobJournal(journal_path)
+        self.cores = int(cores)
+        self.directory = directory
+        self.max_attempts = max_attempts
+        self.cost_model = cost_model or CostModel()
+        self.budget = MemoryBudget(memory_mb or available_memory_mb())
+        self.memory_model = memory_model or MemoryModel()
+        self.matrix_dir = os.path.join(directory, 'matrices')
+        self._samples = {}
+        self._stores = {}
+        # Vector files written for jobs that read their dataframe, keyed by job ID
+        self._vector_files = {}
+
+    def samples(self, job):
+        """
+        :param Job job: Job
+        :return: Number of samples in the job's vector
+        :rtype: int
+        """
+        if job.samples is not None:
+            return job.samples
+        if job.job_id not in self._samples:
+            self._samples[job.job_id] = len(self.vector(job))
+        return self._samples[job.job_id]
+
+    @staticmethod
+    def vector(job):
+        return job_vector(job)
+
+    @staticmethod
+    def presubset(job):
+        return bool(job.store) and os.path.isdir(job.store)
+
+    def matrix(self, job):
+        # A pre-subset job never reads the whole dataframe, so only its vector counts towards its memory
+        return None if self.presubset(job) else job.matrix or job.args[0]
+
+    def costs(self, jobs):
+        """
+        :param list[Job] jobs: Jobs
+        :return: Predicted cost of each job, keyed by job ID
+        :rtype: dict(str, float)
+        """
+        return {job.job_id: self.cost_model.predict(self.samples(job)) for job in jobs}
+
+    def unfinished(self, jobs):
+        """
+        :param list[Job] jobs: Jobs
+        :return: Jobs that are not done and have attempts remaining
+        :rtype: list[Job]
+        """
+        return [x for x in jobs if self.journal.state(x.job_id) != DONE and
+                self.journal.attempts(x.job_id) < self.max_attempts]
+
+    def run(self, jobs):
+        """
+        Runs all unfinished jobs, retrying failures, and reports what is outstanding
+
+        :param list[Job] jobs: Jobs
+        :return: Jobs that are still not done
+        :rtype: list[Job]
+        """
+        for job in jobs:
+            done = job.output and job.job_id not in self.journal and os.path.exists(job.output)
+            self.journal.register(job.job_id, state=DONE if done else PENDING)
+        self.journal.save()
+
+        todo = self.unfinished(jobs)
+        log.info('{} of {} jobs left to run'.format(len(todo), len(jobs)))
+        if todo:
+            cores = min(self.cores, len(todo))
+            costs = self.costs(todo)
+            makespan = predict_makespan(costs.values(), cores)
+            if self.cost_model.calibrated:
+                log.info('Predicted makespan: {:.1f} hours on {} workers'.format(makespan / 3600, cores))
+            else:
+                log.info('Predicted makespan: {:.0f} sample-units on {} workers (no deseq2-time-test results '
+                         'to calibrate against)'.format(makespan, cores))
+
+            log.info('Memory budget: {:.0f}MB, predicting {:.1f}x each job\'s input size'.format(
+                self.budget.budget_mb, self.memory_model.ratio))
+
+            by_id = {x.job_id: x for x in jobs}
+            reserved = {}
+            with DESeq2WorkerPool(cores=cores, directory=self.directory) as pool:
+                while todo:
+                    order = banded_order({x.job_id: costs[x.job_id] for x in todo},
+                                         {x.job_id: x.matrix or x.args[0] for x in todo})
+                    pool.map([(by_id[x].script_path, by_id[x].args, x) for x in order],
+                             on_start=lambda script_path, args, job_id: self._start(by_id[job_id], reserved),
+                             on_finish=lambda result: self._finish(by_id[result.key], result, reserved),
+                             ordered=True,
+                             prepare=lambda script_path, args, job_id: self._prepare(by_id[job_id]))
+                    todo = self.unfinished(jobs)
+                    if todo:
+                        log.info('Retrying {} failed jobs'.format(len(todo)))
+            self.journal.close()
+        return self.report(jobs)
+
+    def _start(self, job, reserved):
+        """Waits until the job's predicted memory fits in the budget, then marks it as running"""
+        mb = self.memory_model.predict(self.matrix(job), self.samples(job))
+        self.budget.acquire(mb)
+        reserved[job.job_id] = mb
+        self.journal.update(job.job_id, RUNNING, predicted_mb=round(mb, 1))
+
+    def matrix_path(self, job):
+        return os.path.join(self.matrix_dir, job.job_id.replace(os.sep, '--') + '.bin')
+
+    def _prepare(self, job):
+        """
+        Writes the counts of a job's vector from its count store
+
+        :param Job job: Job
+        :return: Path to the job's count matrix, or None if the job should read its dataframe
+        :rtype: str
+        """
+        if self.presubset(job):
+            if job.store not in self._stores:
+                # Deferred with pandas, which count_store imports, so that dispatching an experiment doesn't load it
+                from utils.count_store import CountStore
+                self._stores[job.store] = CountStore(job.store)
+            mkdir_p(self.matrix_dir)
+            try:
+                return self._stores[job.store].write_matrix(self.vector(job), self.matrix_path(job))
+            except (KeyError, IOError) as e:
+                log.warning('Could not subset counts for {}, reading its dataframe instead: {}'.format(job.job_id, e))
+        self._write_vector(job)
+        return None
+
+    def _write_vector(self, job):
+        """
+        A job whose vector is kept in a manifest has no vector file, which a job reading its dataframe needs, so
+        its samples are written to the vector path in its arguments until the job finishes
+        """
+        path = job.args[-1]
+        if job.vector is None or isinstance(job.vector, str) or os.path.exists(path):
+            return
+        mkdir_p(os.path.dirname(path))
+        with open(path + '.tmp', 'w') as f:
+            f.write(''.join(x + '\n' for x in self.vector(job)))
+        os.rename(path + '.tmp', path)
+        self._vector_files[job.job_id] = path
+
+    def _finish(self, job, result, reserved):
+        """Records the outcome of a job, removes its count matrix and returns its memory to the budget"""
+        if os.path.exists(self.matrix_path(job)):
+            os.remove(self.matrix_path(job))
+        vector_path = self._vector_files.pop(job.job_id, None)
+        if vector_path and os.path.exists(vector_path):
+            os.remove(vector_path)
+        self.budget.release(reserved.pop(job.job_id))
+        if result.status == 'OK':
+            self.memory_model.observe(self.matrix(job), self.samples(job), result.peak_mb)
+        state = DONE if result.status == 'OK' else FAILED
+        self.journal.update(job.job_id, state, elapsed=result.elapsed, peak_mb=result.peak_mb, message=result.message)
+
+    def report(self, jobs):
+        """
+        Logs job counts by state and any jobs that are not done
+
+        :param list[Job] jobs: Jobs
+        :return: Jobs that are not done
+        :rtype: list[Job]
+        """
+        counts = Counter(self.journal.state(x.job_id) for x in jobs)
+        log.info('Jobs: ' + ', '.join('{} {}'.format(counts[x], x) for x in [DONE, FAILED, PENDING, RUNNING]))
+        outstanding = [x for x in jobs if self.journal.state(x.job_id) != DONE]
+        for job in outstanding:
+            entry = self.journal.jobs[job.job_id]
+            log.warning('Outstanding: {} ({} after {} attempts) {}'.format(
+                job.job_id, entry['state'], entry['attempts'], entry.get('message', '')))
+        return outstanding
@@ -0,0 +1,88 @@
+"""
+Seeded simulations checking the NumPy negative-binomial engine against the quantities it estimates
+
+Counts are drawn from negative binomials with a known parametric dispersion trend, so the tests check that the
+Wald test holds its size under the null, that dispersions are recovered, that planted changes are found, and
+that the fallbacks for unfit trends and outlying counts behave as DESeq2's do.
+"""
+import numpy as np
+
+from utils.nbinom import design_matrix, estimate_dispersions, fit_dispersion_trend, nbinom_wald, size_factors
+
+
+def _simulate(n_genes, n_per_group, seed, fold_changes=None):
+    """
+    :return: genes x samples counts, model matrix, and the true means and dispersions of the first group
+    :rtype: tuple(np.array, np.array, np.array, np.array)
+    """
+    rng = np.random.RandomState(seed)
+    mean = np.exp(rng.uniform(np.log(20), np.log(5000), n_genes))
+    alpha = 0.05 + 2.0 / mean
+    sf = np.exp(rng.uniform(-0.2, 0.2, 2 * n_per_group))
+    mu = mean[:, None] * sf[None, :]
+    if fold_changes is not None:
+        mu[:, n_per_group:] *= fold_changes[:, None]
+    r = 1 / alpha[:, None]
+    counts = rng.negative_binomial(r, r / (r + mu)).astype(float)
+    X, _ = design_matrix(['A'] * n_per_group + ['B'] * n_per_group)
+    return counts, X, mean, alpha
+
+
+def test_null_pvalues_are_uniform():
+    counts, X, _, _ = _simulate(3000, 5, seed=1)
+    res = nbinom_wald(counts, X)
+    tested = res['pvalue'].dropna()
+    assert len(tested) > 2900
+    assert 0.03 < (tested < 0.05).mean() < 0.07
+    assert (res['padj'].dropna() < 0.1).sum() <= 5
+
+
+def test_dispersions_are_recovered():
+    counts, X, _, alpha = _simulate(3000, 10, seed=2)
+    disp = estimate_dispersions(counts, size_factors(counts), X)
+    ratio = np.log(disp / alpha)
+    assert abs(np.median(ratio)) < 0.15
+    assert np.mean(np.abs(ratio) < np.log(2)) > 0.8
+
+
+def test_planted_change_is_detected():
+    fold_changes = np.ones(1000)
+    fold_changes[:5] = 4.0
+    counts, X, _, _ = _simulate(1000, 5, seed=3, fold_changes=fold_changes)
+    res = nbinom_wald(counts, X).sort_index()
+    assert (res['padj'][:5] < 0.01).all()
+    assert np.allclose(res['log2FoldChange'][:5], 2, atol=0.5)
+
+
+def test_singular_trend_falls_back_to_mean_dispersion():
+    # Only one gene is near the trend, too few to fit both of its coefficients
+    trend = fit_dispersion_trend(np.array([10.0, 100.0]), np.array([1e-5, 0.2]))
+    assert np.allclose(trend(np.array([10.0, 1000.0])), 0.2)
+
+
+def test_outlier_count_gets_no_pvalue():
+    counts, X, _, _ = _simulate(1000, 10, seed=4)
+    counts[0] = 0
+    counts[0, 3] = 1000
+    res = nbinom_wald(counts, X).sort_index()
+    assert np.isnan(res['pvalue'][0]) and np.isnan(res['padj'][0])
+    assert abs(res['log2FoldChange'][0]) <= 30
+    assert res['pvalue'][1:].notnull().mean() > 0.99
+
+
+def test_outlier_in_unreplicated_cell_is_kept():
+    # As in DESeq2, only samples in design cells with 3 or more replicates are checked for outliers
+    counts, _, _, _ = _simulate(1000, 10, seed=5)
+    counts[0] = 0
+    counts[0, -1] = 1000
+    X, _ = design_matrix(['A'] * 19 + ['B'])
+    res = nbinom_wald(counts, X).sort_index()
+    assert res['pvalue'].notnull().all()
+
+
+def test_fold_changes_are_bounded():
+    counts, X, _, _ = _simulate(500, 3, seed=6)
+    counts[0, :3] = 0
+    counts[0, 3:] = [1e6, 2e6, 1.5e6]
+    res = nbinom_wald(counts, X).sort_index()
+    assert 0 < res['log2FoldChange'][0] <= 30
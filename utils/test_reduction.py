@@ -0,0 +1,98 @@
+"""
+Checks that reducing a result store gives the ranked table reducing the same DESeq2 tables gives
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+from utils.gene_annotation import GeneAnnotation
+from utils.reduction import StoreReduction, reduce_results, reduce_store
+from utils.result_store import COLUMNS, ResultStore
+
+
+def _write_tables(directory, n_samples=8, n_genes=200, seed=0):
+    """
+    Writes DESeq2-style tables: each reports its own subset of genes, ordered by padj with NA last
+
+    :return: Paths to tables and the annotation of their genes
+    :rtype: tuple(list[str], GeneAnnotation)
+    """
+    rng = np.random.RandomState(seed)
+    genes = ['ENSG{:011d}.1'.format(i) for i in range(n_genes)]
+    paths = []
+    for j in range(n_samples):
+        index = [x for x in genes if rng.rand() > 0.1]
+        n = len(index)
+        padj = np.where(rng.rand(n) < 0.3, 10 ** rng.uniform(-30, -3, n), rng.uniform(size=n))
+        padj[rng.rand(n) < 0.05] = np.nan
+        df = pd.DataFrame({'baseMean': rng.gamma(2, 100, n), 'log2FoldChange': rng.normal(0, 2, n),
+                           'lfcSE': rng.gamma(2, 0.2, n), 'stat': rng.normal(0, 3, n),
+                           'pvalue': padj / 2, 'padj': padj}, index=index, columns=COLUMNS)
+        path = os.path.join(directory, 'TCGA.{:02d}.01'.format(j))
+        df.iloc[np.argsort(df['padj'].values, kind='mergesort')].to_csv(path, sep='\t', na_rep='NA')
+        paths.append(path)
+    return paths, GeneAnnotation(genes, ['GENE{}'.format(i) for i in range(n_genes)])
+
+
+def _assert_same_ranking(expected, ranked):
+    assert list(ranked.index) == list(expected.index)
+    assert list(ranked['gene_id']) == list(expected['gene_id'])
+    for column in ['num_samples', 'pval_counts']:
+        assert (ranked[column].values == expected[column].values).all()
+    # Stored values keep float32's 7 significant digits
+    assert np.allclose(ranked['pval'], expected['pval'], rtol=1e-6, atol=0, equal_nan=True)
+    for column in ['pval_std', 'fc', 'fc_std']:
+        assert np.allclose(ranked[column], expected[column], rtol=0, atol=1e-4, equal_nan=True)
+
+
+def test_reduce_store_matches_reduce_results(tmpdir):
+    paths, annotation = _write_tables(str(tmpdir))
+    expected = reduce_results(paths, annotation)
+    store = ResultStore(os.path.join(str(tmpdir), 'results-store'))
+    store.ingest(paths)
+    _assert_same_ranking(expected, reduce_store(store, annotation))
+
+
+def test_reduce_store_matches_reduce_results_for_samples(tmpdir):
+    paths, annotation = _write_tables(str(tmpdir), seed=1)
+    store = ResultStore(os.path.join(str(tmpdir), 'results-store'))
+    store.ingest(paths)
+    samples = [os.path.basename(x) for x in paths[::2]]
+    _assert_same_ranking(reduce_results(paths[::2], annotation), reduce_store(store, annotation, samples=samples))
+
+
+def test_reduce_store_reads_only_new_results(tmpdir):
+    paths, annotation = _write_tables(str(tmpdir), seed=2)
+    store = ResultStore(os.path.join(str(tmpdir), 'results-store'))
+    store.ingest(paths[:5])
+    _assert_same_ranking(reduce_results(paths[:5], annotation), reduce_store(store, annotation))
+    store.ingest(paths[5:])
+    reduction = StoreReduction(store)
+    assert reduction.samples == [os.path.basename(x) for x in paths[:5]]
+    assert reduction.update(store.samples)
+    _assert_same_ranking(reduce_results(paths, annotation), reduction.rank(annotation))
+
+
+def test_reduce_store_starts_over_when_a_result_is_replaced(tmpdir):
+    paths, annotation = _write_tables(str(tmpdir), seed=3)
+    store = ResultStore(os.path.join(str(tmpdir), 'results-store'))
+    store.ingest(paths)
+    reduce_store(store, annotation)
+    df = pd.read_csv(paths[2], sep='\t', index_col=0)
+    df['padj'] = df['padj'] / 1e6
+    df.to_csv(paths[2], sep='\t', na_rep='NA')
+    store.ingest(paths[2:3])
+    _assert_same_ranking(reduce_results(paths, annotation), reduce_store(store, annotation))
+
+
+def test_reduce_store_adds_genes_new_to_the_store(tmpdir):
+    paths, annotation = _write_tables(str(tmpdir), seed=4)
+    store = ResultStore(os.path.join(str(tmpdir), 'results-store'))
+    store.ingest(paths[:3])
+    reduce_store(store, annotation)
+    df = pd.read_csv(paths[3], sep='\t', index_col=0)
+    df.index = [x.replace('ENSG', 'ENSR') for x in df.index]
+    df.to_csv(paths[3], sep='\t', na_rep='NA')
+    store.ingest(paths[3:])
+    _assert_same_ranking(reduce_results(paths, annotation), reduce_store(store, annotation))
@@ -0,0 +1,64 @@
+"""
+t-SNE of log-normalized expression
+
+Each tissue is first reduced to its top principal components (50 by default) with the randomized PCA in
+utils.pca, and t-SNE is run on the scores. The affinities are computed with the Barnes-Hut method, which only
+considers each sample's 3 * perplexity nearest neighbors; in 50 dimensions finding them is cheap, whereas in
+~20k genes it dominated the run. The embedding is initialized from PCA and seeded, so reruns reproduce it.
+
+A tissue's PCA scores are cached next to its log-matrix cache, so the t-SNE modes of tissue clustering share
+one basis and select their samples' rows from it. t-SNE is invariant to translation, so the centering of the
+shared basis doesn't matter for a subset of its samples.
+
+scores = load_pca_scores(matrix)
+x = run_tsne(scores[matrix.rows(samples)], perplexity=30.0, n_iter=1000, random_state=1)
+"""
+import logging
+import os
+
+import numpy as np
+from sklearn.manifold import TSNE
+
+from utils.pca import RandomizedPCA
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger(__name__)
+
+
+def run_tsne(x, perplexity=30.0, n_iter=1000, random_state=1, pca_components=50):
+    """
+    :param np.array x: samples x features matrix, e.g. log-normalized expression or PCA scores
+    :param float perplexity: Effective number of neighbors of each sample
+    :param int n_iter: Number of optimization iterations
+    :param int random_state: Seed of the PCA and the embedding
+    :param int pca_components: Reduce to this many principal components first if there are more features
+    :return: samples x 2 embedding
+    :rtype: np.array
+    """
+    x = np.asarray(x)
+    if x.shape[1] > pca_components:
+        x = RandomizedPCA(n_components=pca_components, random_state=random_state).fit_transform(x)
+    model = TSNE(n_components=2, perplexity=perplexity, n_iter=n_iter, random_state=random_state,
+                 method='barnes_hut', init='pca')
+    return model.fit_transform(np.asarray(x, dtype=np.float64))
+
+
+def load_pca_scores(matrix, n_components=50):
+    """
+    Returns the PCA scores of all samples of a cached log matrix, computing them only if they aren't cached
+
+    :param LogMatrix matrix: Log matrix returned by load_log_matrix
+    :param int n_components: Number of components
+    :return: samples x n_components scores, in the matrix's sample order
+    :rtype: np.array
+    """
+    path = matrix.path[:-len('.npz')] + '.pca{}.npy'.format(n_components)
+    if os.path.exists(path):
+        return np.load(path)
+    log.info('Caching PCA scores: ' + path)
+    pca = RandomizedPCA(n_components=n_components, random_state=1)
+    scores = pca.fit_transform(matrix.values)
+    tmp_path = path[:-len('.npy')] + '.tmp.npy'
+    np.save(tmp_path, scores)
+    os.rename(tmp_path, path)
+    return scores